@@ -19,9 +19,18 @@ class ArchitecturalRegisterFile(Elaboratable):
     self.o_rd1_data = Signal(32)
     self.i_rd2_idx = Signal(5)
     self.o_rd2_data = Signal(32)
+    # Operands of the second instruction in an issue group.
+    self.i_rd3_idx = Signal(5)
+    self.o_rd3_data = Signal(32)
+    self.i_rd4_idx = Signal(5)
+    self.o_rd4_data = Signal(32)
     self.i_wr_we = Signal()
     self.i_wr_idx = Signal(5)
     self.i_wr_data = Signal(32)
+    # Second write (the younger instruction of a commit group, takes precedence for the same index).
+    self.i_wr2_we = Signal()
+    self.i_wr2_idx = Signal(5)
+    self.i_wr2_data = Signal(32)
 
   def elaborate(self, platform):
     m = Module()
@@ -30,7 +39,10 @@ class ArchitecturalRegisterFile(Elaboratable):
 
     with m.If(self.i_wr_we & (self.i_wr_idx != 0)):
       m.d.sync += regs[self.i_wr_idx].eq(self.i_wr_data)
+    with m.If(self.i_wr2_we & (self.i_wr2_idx != 0)):
+      m.d.sync += regs[self.i_wr2_idx].eq(self.i_wr2_data)
 
     m.d.comb += [self.o_rd1_data.eq(regs[self.i_rd1_idx]), self.o_rd2_data.eq(regs[self.i_rd2_idx])]
+    m.d.comb += [self.o_rd3_data.eq(regs[self.i_rd3_idx]), self.o_rd4_data.eq(regs[self.i_rd4_idx])]
 
     return m
@@ -0,0 +1,201 @@
+# Copyright 2022 Markus Lavin (https://www.zzzconsulting.se/).
+#
+# This source describes Open Hardware and is licensed under the CERN-OHL-P v2.
+#
+# You may redistribute and modify this documentation and make products using it
+# under the terms of the CERN-OHL-P v2 (https:/cern.ch/cern-ohl).  This
+# documentation is distributed WITHOUT ANY EXPRESS OR IMPLIED WARRANTY,
+# INCLUDING OF MERCHANTABILITY, SATISFACTORY QUALITY AND FITNESS FOR A
+# PARTICULAR PURPOSE. Please see the CERN-OHL-P v2 for applicable conditions.
+
+from amaranth import *
+from amaranth.lib import data
+
+from components.RV32I import *
+from components.Utils import *
+
+
+PredictionTypeLayout = data.StructLayout({
+    "npc": unsigned(32),  # Next PC as predicted by fetch.
+    "bpHistory": unsigned(16),  # Speculative global history before this instruction was fetched.
+    "rasTos": unsigned(4)  # Return address stack pointer before this instruction was fetched.
+})
+
+
+class BranchPredictor(Elaboratable):
+  # Pattern history table of 2-bit saturating counters indexed by PC. With historyBits > 0 the index is XOR:ed with
+  # a global history register (gshare), otherwise it is a plain bimodal predictor. With several threads every thread
+  # has a history register of its own while the counters are shared.
+
+  def __init__(self, indexBits=6, historyBits=0, threads=1):
+    assert historyBits <= indexBits and historyBits <= PredictionTypeLayout["bpHistory"].width
+    self.indexBits = indexBits
+    self.historyBits = historyBits
+    self.threads = threads
+    self.i_thread = Signal(range(threads))  # The thread fetched from (its history is used and updated).
+    # Predict (fetch).
+    self.i_predict_pc = Signal(32)
+    self.i_predict_en = Signal()  # A conditional branch was fetched (shift prediction into speculative history).
+    self.o_predict_taken = Signal()
+    self.o_history = Signal(16)
+    # Predict second fetch slot (sees the history as updated by the first).
+    self.i_predict2_pc = Signal(32)
+    self.i_predict2_en = Signal()
+    self.o_predict2_taken = Signal()
+    self.o_history2 = Signal(16)
+    # Train (commit).
+    self.i_train_pc = Signal(32)
+    self.i_train_history = Signal(16)  # History the branch was predicted with.
+    self.i_train_taken = Signal()
+    self.i_train_en = Signal()
+    # Restore (mispredict, per thread).
+    self.i_restore_history = [Signal(16, name='i_restore{}_history'.format(t)) for t in range(threads)]
+    self.i_restore_en = [Signal(name='i_restore{}_en'.format(t)) for t in range(threads)]
+
+  def elaborate(self, platform):
+    m = Module()
+
+    # Counters start out weakly taken (matches the old static predict taken behaviour for cold branches).
+    pht = Memory(width=2, depth=2**self.indexBits, init=[0b10] * 2**self.indexBits)
+    m.submodules.pht_rp = pht_rp = pht.read_port(domain='comb')
+    m.submodules.pht_rp2 = pht_rp2 = pht.read_port(domain='comb')
+    m.submodules.pht_tp = pht_tp = pht.read_port(domain='comb')
+    m.submodules.pht_wp = pht_wp = pht.write_port()
+
+    # Speculative history is updated with the predicted direction at fetch. Every fetched instruction carries a
+    # snapshot of it so that it can be repaired when a branch turns out to be mispredicted.
+    spec_ghrs = [Signal(max(self.historyBits, 1), name='spec_ghr{}'.format(t)) for t in range(self.threads)]
+    spec_ghr = spec_ghrs[0] if self.threads == 1 else Array(spec_ghrs)[self.i_thread]
+    m.d.comb += self.o_history.eq(spec_ghr)
+
+    def index(pc, ghr):
+      idx = pc[2:2 + self.indexBits]
+      if self.historyBits > 0:
+        idx = idx ^ ghr[0:self.historyBits]
+      return idx
+
+    # Predict.
+    m.d.comb += [pht_rp.addr.eq(index(self.i_predict_pc, spec_ghr)), self.o_predict_taken.eq(pht_rp.data[1])]
+    ghr2 = Signal.like(spec_ghrs[0])
+    m.d.comb += [
+        ghr2.eq(Mux(self.i_predict_en, Cat(self.o_predict_taken, spec_ghr), spec_ghr)),
+        self.o_history2.eq(ghr2),
+        pht_rp2.addr.eq(index(self.i_predict2_pc, ghr2)),
+        self.o_predict2_taken.eq(pht_rp2.data[1])
+    ]
+    with m.If(self.i_predict2_en):
+      m.d.sync += spec_ghr.eq(Cat(self.o_predict2_taken, ghr2))
+    with m.Elif(self.i_predict_en):
+      m.d.sync += spec_ghr.eq(Cat(self.o_predict_taken, spec_ghr))
+
+    # Train.
+    ctr = pht_tp.data
+    m.d.comb += [pht_tp.addr.eq(index(self.i_train_pc, self.i_train_history)), pht_wp.addr.eq(pht_tp.addr)]
+    with m.If(self.i_train_en):
+      with m.If(self.i_train_taken & (ctr != 0b11)):
+        m.d.comb += [pht_wp.data.eq(ctr + 1), pht_wp.en.eq(1)]
+      with m.If(~self.i_train_taken & (ctr != 0b00)):
+        m.d.comb += [pht_wp.data.eq(ctr - 1), pht_wp.en.eq(1)]
+
+    # Restore (highest priority).
+    for spec_ghr, restore_en, restore_history in zip(spec_ghrs, self.i_restore_en, self.i_restore_history):
+      with m.If(restore_en):
+        m.d.sync += spec_ghr.eq(restore_history)
+
+    return m
+
+
+def isLinkReg(idx):
+  # Registers x1 and x5 are hints for call/return (see table 2.1 in the RISC-V unprivileged spec).
+  return (idx == 1) | (idx == 5)
+
+
+def rasPushPop(opcode, rd, rs1):
+  # Return (push, pop) for the return address stack given the fields of a JAL or JALR.
+  push = isLinkReg(rd)
+  pop = Mux(opcode == RV32I_OP_JALR, isLinkReg(rs1) & (~isLinkReg(rd) | (rd != rs1)), 0)
+  return push, pop
+
+
+class ReturnAddressStack(Elaboratable):
+  # Circular stack of return addresses updated at fetch. On a mispredict the stack pointer is restored from the
+  # snapshot carried by the branch (push/pop then apply on top of the restored pointer). Entries overwritten on the
+  # wrong path are not repaired.
+
+  def __init__(self, depth=4):
+    assert depth <= 2**PredictionTypeLayout["rasTos"].width
+    self.depth = depth
+    self.i_push_en = Signal()
+    self.i_push_addr = Signal(32)
+    self.i_pop_en = Signal()
+    self.o_top = Signal(32)
+    self.o_tos = Signal(4)
+    # Restore (mispredict).
+    self.i_restore_tos = Signal(4)
+    self.i_restore_en = Signal()
+
+  def elaborate(self, platform):
+    m = Module()
+
+    ras = Array([Signal(32, name='ras{}'.format(idx)) for idx in range(self.depth)])
+    tos = Signal(range(self.depth))
+    cur = Signal(range(self.depth))
+    nxt = Signal(range(self.depth))
+
+    m.d.comb += [
+        cur.eq(Mux(self.i_restore_en, self.i_restore_tos, tos)),
+        nxt.eq(Mux(cur == self.depth - 1, 0, cur + 1)),
+        self.o_top.eq(ras[tos]),
+        self.o_tos.eq(tos)
+    ]
+    with m.If(self.i_push_en & self.i_pop_en):
+      m.d.sync += [ras[cur].eq(self.i_push_addr), tos.eq(cur)]
+    with m.Elif(self.i_push_en):
+      m.d.sync += [ras[nxt].eq(self.i_push_addr), tos.eq(nxt)]
+    with m.Elif(self.i_pop_en):
+      m.d.sync += tos.eq(Mux(cur == 0, self.depth - 1, cur - 1))
+    with m.Else():
+      m.d.sync += tos.eq(cur)
+
+    return m
+
+
+IndirectTargetEntryLayout = data.StructLayout({
+    "valid": unsigned(1),
+    "tag": unsigned(30),  # PC bits above the two always zero ones.
+    "target": unsigned(32)
+})
+
+
+class IndirectTargetPredictor(Elaboratable):
+  # Direct mapped table of last seen targets for JALR that are not returns.
+
+  def __init__(self, indexBits=3):
+    self.indexBits = indexBits
+    # Predict (fetch).
+    self.i_predict_pc = Signal(32)
+    self.o_predict_hit = Signal()
+    self.o_predict_target = Signal(32)
+    self.i_predict2_pc = Signal(32)
+    self.o_predict2_hit = Signal()
+    self.o_predict2_target = Signal(32)
+    # Train (commit).
+    self.i_train_pc = Signal(32)
+    self.i_train_target = Signal(32)
+    self.i_train_en = Signal()
+
+  def elaborate(self, platform):
+    m = Module()
+
+    itp = Array([Signal(IndirectTargetEntryLayout) for _ in range(2**self.indexBits)])
+
+    for pc, hit, target in [(self.i_predict_pc, self.o_predict_hit, self.o_predict_target),
+                            (self.i_predict2_pc, self.o_predict2_hit, self.o_predict2_target)]:
+      itpe = itp[pc[2:2 + self.indexBits]]
+      m.d.comb += [hit.eq(itpe.valid & (itpe.tag == pc[2:])), target.eq(itpe.target)]
+
+    with m.If(self.i_train_en):
+      itpe = itp[self.i_train_pc[2:2 + self.indexBits]]
+      m.d.sync += [itpe.valid.eq(1), itpe.tag.eq(self.i_train_pc[2:]), itpe.target.eq(self.i_train_target)]
+
+    return m
@@ -11,8 +11,21 @@
 from amaranth import *
 from amaranth.lib import data
 
-BroadcastBusTypeLayout = data.StructLayout({
-    "valid": unsigned(1),  # Bus contents are valid.
-    "robIdx": unsigned(3),  # The ROB-idx of the result.
-    "data": unsigned(32)  # Bus data.
-})
+from components.CoreConfig import *
+
+
+def BroadcastBusTypeLayout(config):
+  return data.StructLayout({
+      "valid": unsigned(1),  # Bus contents are valid.
+      "robIdx": unsigned(config.robIdxBits),  # The ROB-idx of the result.
+      "data": unsigned(32)  # Bus data.
+  })
+
+
+# Early (tag only) wakeup for a result expected on a broadcast bus in the next cycle. This is speculative, the result
+# may be delayed (e.g. a cache miss) in which case the consumers woken by it have to wait for the real broadcast.
+def WakeupTypeLayout(config):
+  return data.StructLayout({
+      "valid": unsigned(1),  # A result is expected in the next cycle.
+      "robIdx": unsigned(config.robIdxBits)  # The ROB-idx of the result.
+  })
@@ -14,22 +14,30 @@ from enum import Enum, unique, auto
 
 from components.Utils import *
 
-cfgAddrOffsetBits = 5
-cfgAddrIndexBits = 6
-cfgAddrTagBits = 32 - cfgAddrOffsetBits - cfgAddrIndexBits
 
-AddrTypeLayout = data.StructLayout({
-    "offset": unsigned(cfgAddrOffsetBits),
-    "index": unsigned(cfgAddrIndexBits),
-    "tag": unsigned(cfgAddrTagBits)
-})
+# A cache holds 2**indexBits lines of 2**offsetBits bytes each.
+def AddrTypeLayout(indexBits, offsetBits):
+  return data.StructLayout({
+      "offset": unsigned(offsetBits),
+      "index": unsigned(indexBits),
+      "tag": unsigned(32 - offsetBits - indexBits)
+  })
 
-TagMemEntryTypeLayout = data.StructLayout({"valid": unsigned(1), "dirty": unsigned(1), "tag": unsigned(cfgAddrTagBits)})
+
+def TagMemEntryTypeLayout(indexBits, offsetBits):
+  return data.StructLayout({"valid": unsigned(1), "dirty": unsigned(1), "tag": unsigned(32 - offsetBits - indexBits)})
 
 
 class Cache(Elaboratable):
 
-  def __init__(self):
+  def __init__(self, indexBits=6, offsetBits=5, wideRead=False, prefetch=False):
+    self.indexBits = indexBits
+    self.offsetBits = offsetBits
+    # With wideRead the word following i_cpu_addr is returned on o_cpu_data2 if it is in the same cache line.
+    self.wideRead = wideRead
+    # With prefetch lines can be allocated ahead of use (i_pf_addr) and read hits are served while a line is being
+    # allocated (only for caches that are never written by the CPU).
+    self.prefetch = prefetch
     # CPU IF
     self.i_cpu_addr = Signal(32)
     self.i_cpu_data = Signal(32)
@@ -38,6 +46,12 @@ class Cache(Elaboratable):
     self.i_cpu_valid = Signal()
     self.o_cpu_rdy = Signal()
     self.o_cpu_data = Signal(32)
+    self.o_cpu_rdy2 = Signal()
+    self.o_cpu_data2 = Signal(32)
+    # Prefetch IF (o_pf_rdy when the line holding i_pf_addr is present or its allocation has started).
+    self.i_pf_addr = Signal(32)
+    self.i_pf_valid = Signal()
+    self.o_pf_rdy = Signal()
     # BUS IF
     self.o_wb_adr = Signal(32)
     self.o_wb_dat = Signal(32)
@@ -52,43 +66,68 @@ class Cache(Elaboratable):
   def elaborate(self, platform):
     m = Module()
 
+    indexBits = self.indexBits
+    offsetBits = self.offsetBits
+    addrLayout = AddrTypeLayout(indexBits, offsetBits)
+
     u_mem_rp = []
+    u_mem_rp2 = []
     u_mem_wp = []
     for idx in range(4):
-      mem = Memory(width=8, depth=2**(cfgAddrIndexBits + cfgAddrOffsetBits - 2))
+      mem = Memory(width=8, depth=2**(indexBits + offsetBits - 2))
       mem_rp = mem.read_port(domain='comb')
       mem_wp = mem.write_port()
       u_mem_rp.append(mem_rp)
       u_mem_wp.append(mem_wp)
       m.submodules += [mem_rp, mem_wp]
+      if self.wideRead:
+        mem_rp2 = mem.read_port(domain='comb')
+        u_mem_rp2.append(mem_rp2)
+        m.submodules += mem_rp2
 
     i_cpu_addr_r = Signal(32)
-    cpu_addr = Signal(AddrTypeLayout)
+    cpu_addr = Signal(addrLayout)
     m.d.comb += cpu_addr.eq(self.i_cpu_addr)
-    cpu_addr_r = Signal(AddrTypeLayout)
+    cpu_addr_r = Signal(addrLayout)
     m.d.comb += cpu_addr_r.eq(i_cpu_addr_r)
 
-    tag_mem = Array([Signal(TagMemEntryTypeLayout) for _ in range(2**cfgAddrIndexBits)])
+    tag_mem = Array([Signal(TagMemEntryTypeLayout(indexBits, offsetBits)) for _ in range(2**indexBits)])
     tag = tag_mem[cpu_addr.index]
     tag_r = tag_mem[cpu_addr_r.index]
+    pf_addr = Signal(addrLayout)
+    m.d.comb += pf_addr.eq(self.i_pf_addr)
+    pf_tag = tag_mem[pf_addr.index]
+    cpu_hit = Signal()
+    m.d.comb += cpu_hit.eq(~self.i_cpu_addr[31] & tag.valid & (tag.tag == cpu_addr.tag))
 
-    addr_cntr = Signal(cfgAddrOffsetBits - 2)
+    addr_cntr = Signal(offsetBits - 2)
 
     cpu_mem_idx = Cat(cpu_addr.offset[2:], cpu_addr.index)
     bus_mem_idx = Cat(addr_cntr, cpu_addr_r.index)
 
     u_mem_rp_data32 = Cat(u_mem_rp[0].data, u_mem_rp[1].data, u_mem_rp[2].data, u_mem_rp[3].data)
 
+    def cpuRead():
+      for idx in range(4):
+        m.d.comb += u_mem_rp[idx].addr.eq(cpu_mem_idx)
+      m.d.comb += [self.o_cpu_data.eq(u_mem_rp_data32), self.o_cpu_rdy.eq(1)]
+      if self.wideRead:
+        # The next word only shares the tag check if it is not beyond the end of the line.
+        for idx in range(4):
+          m.d.comb += u_mem_rp2[idx].addr.eq(cpu_mem_idx + 1)
+        m.d.comb += [
+            self.o_cpu_data2.eq(Cat(u_mem_rp2[0].data, u_mem_rp2[1].data, u_mem_rp2[2].data, u_mem_rp2[3].data)),
+            self.o_cpu_rdy2.eq(cpu_addr.offset[2:] != 2**(offsetBits - 2) - 1)
+        ]
+
     with m.FSM(reset='idle') as fsm:
 
       with m.State('idle'):
         with m.If(self.i_cpu_valid):
           with m.If(self.i_cpu_addr[31]):  # Cache bypass.
             m.next = 'bypass-write-0'
-          with m.Elif(tag.valid & (tag.tag == cpu_addr.tag)):  # Cache HIT.
-            for idx in range(4):
-              m.d.comb += u_mem_rp[idx].addr.eq(cpu_mem_idx)
-            m.d.comb += [self.o_cpu_data.eq(u_mem_rp_data32), self.o_cpu_rdy.eq(1)]
+          with m.Elif(cpu_hit):  # Cache HIT.
+            cpuRead()
             with m.If(self.i_cpu_we):
               m.d.sync += tag.dirty.eq(1)
               for idx in range(4):
@@ -102,7 +141,19 @@ class Cache(Elaboratable):
             with m.If(tag.valid & tag.dirty):
               m.next = 'writeback-0'
             with m.Else():
+              m.d.sync += tag.valid.eq(0)
               m.next = 'allocate-0'
+        if self.prefetch:
+          # Prefetch unless the CPU needs the bus itself.
+          with m.If(self.i_pf_valid & ~self.i_pf_addr[31] & ~(self.i_cpu_valid & ~cpu_hit)):
+            m.d.comb += self.o_pf_rdy.eq(1)
+            with m.If(~pf_tag.valid | (pf_tag.tag != pf_addr.tag)):
+              m.d.sync += [i_cpu_addr_r.eq(self.i_pf_addr), addr_cntr.eq(0)]
+              with m.If(pf_tag.valid & pf_tag.dirty):
+                m.next = 'writeback-0'
+              with m.Else():
+                m.d.sync += pf_tag.valid.eq(0)
+                m.next = 'allocate-0'
 
       with m.State('writeback-0'):
         for idx in range(4):
@@ -117,11 +168,15 @@ class Cache(Elaboratable):
         ]
         with m.If(self.i_wb_ack):
           m.d.sync += [addr_cntr.eq(addr_cntr + 1)]
-          with m.If(addr_cntr == 2**(cfgAddrOffsetBits - 2) - 1):
+          with m.If(addr_cntr == 2**(offsetBits - 2) - 1):
             m.d.sync += [tag_r.dirty.eq(0), tag_r.valid.eq(0)]
             m.next = 'allocate-0'
 
       with m.State('allocate-0'):
+        if self.prefetch:
+          # Hit under fill (the line being allocated is not valid until it is complete).
+          with m.If(self.i_cpu_valid & cpu_hit):
+            cpuRead()
         m.d.comb += [
             self.o_wb_cyc.eq(1),
             self.o_wb_stb.eq(1),
@@ -134,7 +189,7 @@ class Cache(Elaboratable):
                 u_mem_wp[idx].en.eq(1)
             ]
           m.d.sync += [addr_cntr.eq(addr_cntr + 1)]
-          with m.If(addr_cntr == 2**(cfgAddrOffsetBits - 2) - 1):
+          with m.If(addr_cntr == 2**(offsetBits - 2) - 1):
             m.d.sync += [tag_r.tag.eq(cpu_addr_r.tag), tag_r.valid.eq(1)]
             m.next = 'idle'
 
@@ -154,6 +209,44 @@ class Cache(Elaboratable):
     return m
 
 
+class StreamPrefetcher(Elaboratable):
+  # Requests the depth cache lines following the one being fetched from, one at a time in order. Fetching from outside
+  # of that window (a taken branch or a squash) restarts the stream after the new line.
+
+  def __init__(self, depth=2, offsetBits=5):
+    assert depth > 0
+    self.depth = depth
+    self.offsetBits = offsetBits  # Lines are 2**offsetBits bytes (see Cache).
+    # Ports
+    self.i_fetch_addr = Signal(32)
+    self.o_pf_addr = Signal(32)
+    self.o_pf_valid = Signal()
+    self.i_pf_rdy = Signal()
+
+  def elaborate(self, platform):
+    m = Module()
+
+    offsetBits = self.offsetBits
+    line = self.i_fetch_addr[offsetBits:32]
+    next_line = Signal(32 - offsetBits)  # Next line to request.
+    dist = Signal(32 - offsetBits)
+    m.d.comb += dist.eq(next_line - line)
+    in_stream = Signal()
+    m.d.comb += in_stream.eq((dist >= 1) & (dist <= self.depth + 1))
+
+    pf_line = Mux(in_stream, next_line, line + 1)
+    m.d.comb += [
+        self.o_pf_addr.eq(Cat(Const(0, offsetBits), pf_line)),
+        self.o_pf_valid.eq(~in_stream | (dist <= self.depth))
+    ]
+    with m.If(self.o_pf_valid & self.i_pf_rdy):
+      m.d.sync += next_line.eq(pf_line + 1)
+    with m.Elif(~in_stream):
+      m.d.sync += next_line.eq(line + 1)
+
+    return m
+
+
 class SlowMemory(Elaboratable):
 
   def __init__(self, initBin):
@@ -230,7 +323,7 @@ class Top(Elaboratable):
 
       with m.State('s2'):
         m.d.comb += [
-            u_cache.i_cpu_addr.eq(2**(cfgAddrIndexBits + cfgAddrOffsetBits) + 0x20 + cntr),
+            u_cache.i_cpu_addr.eq(2**(u_cache.indexBits + u_cache.offsetBits) + 0x20 + cntr),
             u_cache.i_cpu_valid.eq(1)
         ]
         with m.If(u_cache.o_cpu_rdy):
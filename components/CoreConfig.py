@@ -0,0 +1,57 @@
+# Copyright 2022 Markus Lavin (https://www.zzzconsulting.se/).
+#
+# This source describes Open Hardware and is licensed under the CERN-OHL-P v2.
+#
+# You may redistribute and modify this documentation and make products using it
+# under the terms of the CERN-OHL-P v2 (https:/cern.ch/cern-ohl).  This
+# documentation is distributed WITHOUT ANY EXPRESS OR IMPLIED WARRANTY,
+# INCLUDING OF MERCHANTABILITY, SATISFACTORY QUALITY AND FITNESS FOR A
+# PARTICULAR PURPOSE. Please see the CERN-OHL-P v2 for applicable conditions.
+
+
+def isPow2(n):
+  return n > 0 and n & (n - 1) == 0
+
+
+# Sizes of the core's structures. MyOoO passes it to every component that holds or refers to one of them and the
+# layouts that depend on a size (e.g. the width of a ROB-idx) are derived from it.
+class CoreConfig:
+
+  def __init__(self,
+               robEntries=8,
+               rsEntries=4,
+               lsqEntries=4,
+               iqEntries=8,
+               icacheIndexBits=6,
+               icacheOffsetBits=5,
+               dcacheIndexBits=6,
+               dcacheOffsetBits=5):
+    # The ROB, LSQ and IQ are circular buffers indexed by the low bits of their pointers.
+    assert isPow2(robEntries) and robEntries >= 2
+    assert isPow2(lsqEntries) and lsqEntries >= 2
+    assert isPow2(iqEntries) and iqEntries >= 2
+    assert rsEntries >= 2
+    # Lines hold at least one word and a cache is indexed by the address bits above the line offset.
+    assert icacheOffsetBits >= 2 and icacheIndexBits + icacheOffsetBits < 31
+    assert dcacheOffsetBits >= 2 and dcacheIndexBits + dcacheOffsetBits < 31
+    self.robEntries = robEntries  # Shared by the threads (see ReOrderBuffer).
+    self.rsEntries = rsEntries
+    self.lsqEntries = lsqEntries
+    self.iqEntries = iqEntries  # Per thread.
+    # Caches hold 2**indexBits lines of 2**offsetBits bytes each.
+    self.icacheIndexBits = icacheIndexBits
+    self.icacheOffsetBits = icacheOffsetBits
+    self.dcacheIndexBits = dcacheIndexBits
+    self.dcacheOffsetBits = dcacheOffsetBits
+
+  @property
+  def robIdxBits(self):
+    return self.robEntries.bit_length() - 1
+
+  @property
+  def lsqIdxBits(self):
+    return self.lsqEntries.bit_length() - 1
+
+  @property
+  def iqIdxBits(self):
+    return self.iqEntries.bit_length() - 1
@@ -0,0 +1,259 @@
+# Copyright 2022 Markus Lavin (https://www.zzzconsulting.se/).
+#
+# This source describes Open Hardware and is licensed under the CERN-OHL-P v2.
+#
+# You may redistribute and modify this documentation and make products using it
+# under the terms of the CERN-OHL-P v2 (https:/cern.ch/cern-ohl).  This
+# documentation is distributed WITHOUT ANY EXPRESS OR IMPLIED WARRANTY,
+# INCLUDING OF MERCHANTABILITY, SATISFACTORY QUALITY AND FITNESS FOR A
+# PARTICULAR PURPOSE. Please see the CERN-OHL-P v2 for applicable conditions.
+
+from amaranth import *
+from amaranth.lib import data
+from enum import Enum, unique, auto
+
+from components.RV32I import *
+from components.MicroOperation import *
+from components.LoadStoreQueue import *
+from components.ReOrderBuffer import *
+from components.BranchPredictor import *
+
+
+@unique
+class IssueUnit(Enum):
+  RS = auto()
+  LSQ = auto()
+
+
+# Pre-decoded instruction as stored in the IQ. Unused register operands are x0 (reads as zero and is never renamed)
+# and so is rd for instructions that do not write a register, which lets issue rename every record the same way.
+DecodedInstrLayout = data.StructLayout({
+    "valid": unsigned(1),  # Known instruction (issue stalls on anything else).
+    "unit": IssueUnit,
+    "opcode": uOPOpcode,  # For unit RS.
+    "lsqType": LSQType,  # For unit LSQ.
+    "lsqSize": LSQSize,
+    "lsqSigned": unsigned(1),
+    "robType": ROBType,
+    "rd": unsigned(5),
+    "rs1": unsigned(5),
+    "rs2": unsigned(5),
+    "op1Imm": unsigned(1),  # First operand is imm rather than rs1.
+    "op2Imm": unsigned(1),  # Second operand is imm rather than rs2.
+    "op2Pc": unsigned(1),  # Second operand is the PC rather than rs2.
+    "imm": unsigned(32),  # Sign-extended immediate (branch offset for BRANCH, address offset for LSQ).
+    "rvc": unsigned(1),  # Expanded from a compressed instruction (next instruction is at pc + 2).
+    "jalr": unsigned(1),  # Link register (pc + 4) is known at rename, the EU computes the target.
+    "rasPush": unsigned(1),
+    "rasPop": unsigned(1)
+})
+
+
+class Decoder(Elaboratable):
+
+  def __init__(self, rvm=True):
+    self.rvm = rvm  # Decode the multiply/divide (M) extension.
+    self.i_instr = Signal(32)
+    self.i_rvc = Signal()  # i_instr was expanded from a compressed instruction.
+    self.o_uop = Signal(DecodedInstrLayout)
+
+  def elaborate(self, platform):
+    m = Module()
+
+    instr_r = Signal(RTypeInstrTypeLayout)
+    m.d.comb += instr_r.eq(self.i_instr)
+    instr_u = Signal(UTypeInstrTypeLayout)
+    m.d.comb += instr_u.eq(self.i_instr)
+    instr_i = Signal(ITypeInstrTypeLayout)
+    m.d.comb += instr_i.eq(self.i_instr)
+    instr_s = Signal(STypeInstrTypeLayout)
+    m.d.comb += instr_s.eq(self.i_instr)
+    instr_b = Signal(BTypeInstrTypeLayout)
+    m.d.comb += instr_b.eq(self.i_instr)
+    instr_j = Signal(JTypeInstrTypeLayout)
+    m.d.comb += instr_j.eq(self.i_instr)
+
+    uop = self.o_uop
+    m.d.comb += [uop.valid.eq(1), uop.unit.eq(IssueUnit.RS), uop.robType.eq(ROBType.OTHER), uop.rvc.eq(self.i_rvc)]
+
+    with m.Switch(instr_r.opcode):
+      with m.Case(RV32I_OP_LUI):
+        m.d.comb += [
+            uop.opcode.eq(uOPOpcode.LUI),
+            uop.rd.eq(instr_u.rd),
+            uop.op1Imm.eq(1),
+            uop.imm.eq(instr_u.imm << 12)
+        ]
+
+      with m.Case(RV32I_OP_AUIPC):
+        m.d.comb += [
+            uop.opcode.eq(uOPOpcode.ADD),
+            uop.rd.eq(instr_u.rd),
+            uop.op1Imm.eq(1),
+            uop.op2Pc.eq(1),
+            uop.imm.eq(instr_u.imm << 12)
+        ]
+
+      with m.Case(RV32I_OP_JAL):
+        # Only the link register is computed, the target is known at fetch.
+        m.d.comb += [
+            uop.opcode.eq(uOPOpcode.ADD),
+            uop.rd.eq(instr_j.rd),
+            uop.op1Imm.eq(1),
+            uop.op2Pc.eq(1),
+            uop.imm.eq(Mux(self.i_rvc, 2, 4)),
+            uop.rasPush.eq(isLinkReg(instr_j.rd))
+        ]
+
+      with m.Case(RV32I_OP_JALR):
+        ras_push, ras_pop = rasPushPop(instr_i.opcode, instr_i.rd, instr_i.rs1)
+        m.d.comb += [
+            uop.opcode.eq(uOPOpcode.ADD),
+            uop.robType.eq(ROBType.BRANCH2),
+            uop.rd.eq(instr_i.rd),
+            uop.rs1.eq(instr_i.rs1),
+            uop.op2Imm.eq(1),
+            uop.imm.eq(instr_i.imm.as_signed()),
+            uop.jalr.eq(1),
+            uop.rasPush.eq(ras_push),
+            uop.rasPop.eq(ras_pop)
+        ]
+
+      with m.Case(RV32I_OP_IMM):
+        m.d.comb += [
+            uop.rd.eq(instr_i.rd),
+            uop.rs1.eq(instr_i.rs1),
+            uop.op2Imm.eq(1),
+            uop.imm.eq(instr_i.imm.as_signed())
+        ]
+        with m.Switch(instr_i.funct3):
+          with m.Case(0b000):  # ADDI
+            m.d.comb += uop.opcode.eq(uOPOpcode.ADD)
+          with m.Case(0b010):  # SLTI
+            m.d.comb += uop.opcode.eq(uOPOpcode.SLT)
+          with m.Case(0b011):  # SLTIU
+            m.d.comb += uop.opcode.eq(uOPOpcode.SLTU)
+          with m.Case(0b100):  # XORI
+            m.d.comb += uop.opcode.eq(uOPOpcode.XOR)
+          with m.Case(0b110):  # ORI
+            m.d.comb += uop.opcode.eq(uOPOpcode.OR)
+          with m.Case(0b111):  # ANDI
+            m.d.comb += uop.opcode.eq(uOPOpcode.AND)
+          with m.Case(0b001):  # SLLI
+            m.d.comb += uop.opcode.eq(uOPOpcode.SLL)
+          with m.Case(0b101):  # SRLI or SRAI
+            with m.If(instr_i.imm[10]):
+              m.d.comb += uop.opcode.eq(uOPOpcode.SRA)
+            with m.Else():
+              m.d.comb += uop.opcode.eq(uOPOpcode.SRL)
+
+      with m.Case(RV32I_OP_OP):
+        m.d.comb += [uop.rd.eq(instr_r.rd), uop.rs1.eq(instr_r.rs1), uop.rs2.eq(instr_r.rs2)]
+        with m.Switch(Cat(instr_r.funct3, instr_r.funct7)):
+          with m.Case(0b0000000_000):  # ADD
+            m.d.comb += uop.opcode.eq(uOPOpcode.ADD)
+          with m.Case(0b0100000_000):  # SUB
+            m.d.comb += uop.opcode.eq(uOPOpcode.SUB)
+          with m.Case(0b0000000_001):  # SLL
+            m.d.comb += uop.opcode.eq(uOPOpcode.SLL)
+          with m.Case(0b0000000_010):  # SLT
+            m.d.comb += uop.opcode.eq(uOPOpcode.SLT)
+          with m.Case(0b0000000_011):  # SLTU
+            m.d.comb += uop.opcode.eq(uOPOpcode.SLTU)
+          with m.Case(0b0000000_100):  # XOR
+            m.d.comb += uop.opcode.eq(uOPOpcode.XOR)
+          with m.Case(0b0000000_101):  # SRL
+            m.d.comb += uop.opcode.eq(uOPOpcode.SRL)
+          with m.Case(0b0100000_101):  # SRA
+            m.d.comb += uop.opcode.eq(uOPOpcode.SRA)
+          with m.Case(0b0000000_110):  # OR
+            m.d.comb += uop.opcode.eq(uOPOpcode.OR)
+          with m.Case(0b0000000_111):  # AND
+            m.d.comb += uop.opcode.eq(uOPOpcode.AND)
+          if self.rvm:
+            with m.Case(0b0000001_000):  # MUL
+              m.d.comb += uop.opcode.eq(uOPOpcode.MUL)
+            with m.Case(0b0000001_001):  # MULH
+              m.d.comb += uop.opcode.eq(uOPOpcode.MULH)
+            with m.Case(0b0000001_010):  # MULHSU
+              m.d.comb += uop.opcode.eq(uOPOpcode.MULHSU)
+            with m.Case(0b0000001_011):  # MULHU
+              m.d.comb += uop.opcode.eq(uOPOpcode.MULHU)
+            with m.Case(0b0000001_100):  # DIV
+              m.d.comb += uop.opcode.eq(uOPOpcode.DIV)
+            with m.Case(0b0000001_101):  # DIVU
+              m.d.comb += uop.opcode.eq(uOPOpcode.DIVU)
+            with m.Case(0b0000001_110):  # REM
+              m.d.comb += uop.opcode.eq(uOPOpcode.REM)
+            with m.Case(0b0000001_111):  # REMU
+              m.d.comb += uop.opcode.eq(uOPOpcode.REMU)
+
+      with m.Case(RV32I_OP_LOAD):
+        m.d.comb += [
+            uop.unit.eq(IssueUnit.LSQ),
+            uop.lsqType.eq(LSQType.LOAD),
+            uop.rd.eq(instr_i.rd),
+            uop.rs1.eq(instr_i.rs1),
+            uop.imm.eq(instr_i.imm.as_signed())
+        ]
+        with m.Switch(instr_i.funct3):
+          with m.Case(0b000):  # BYTE
+            m.d.comb += [uop.lsqSize.eq(LSQSize.BYTE), uop.lsqSigned.eq(1)]
+          with m.Case(0b001):  # HALF
+            m.d.comb += [uop.lsqSize.eq(LSQSize.HALF), uop.lsqSigned.eq(1)]
+          with m.Case(0b010):  # WORD
+            m.d.comb += [uop.lsqSize.eq(LSQSize.WORD), uop.lsqSigned.eq(1)]
+          with m.Case(0b100):  # BYTE unsigned
+            m.d.comb += [uop.lsqSize.eq(LSQSize.BYTE), uop.lsqSigned.eq(0)]
+          with m.Case(0b101):  # HALF unsigned
+            m.d.comb += [uop.lsqSize.eq(LSQSize.HALF), uop.lsqSigned.eq(0)]
+
+      with m.Case(RV32I_OP_STORE):
+        m.d.comb += [
+            uop.unit.eq(IssueUnit.LSQ),
+            uop.lsqType.eq(LSQType.STORE),
+            uop.robType.eq(ROBType.STORE),
+            uop.rs1.eq(instr_s.rs1),
+            uop.rs2.eq(instr_s.rs2),
+            uop.imm.eq(Cat(instr_s.imm_4_0, instr_s.imm_11_5).as_signed())
+        ]
+        with m.Switch(instr_s.funct3):
+          with m.Case(0b000):  # BYTE
+            m.d.comb += uop.lsqSize.eq(LSQSize.BYTE)
+          with m.Case(0b001):  # HALF
+            m.d.comb += uop.lsqSize.eq(LSQSize.HALF)
+          with m.Case(0b010):  # WORD
+            m.d.comb += uop.lsqSize.eq(LSQSize.WORD)
+
+      with m.Case(RV32I_OP_MISC_MEM):
+        m.d.comb += [uop.unit.eq(IssueUnit.LSQ), uop.lsqType.eq(LSQType.FENCE), uop.robType.eq(ROBType.FENCE)]
+
+      with m.Case(RV32I_OP_BRANCH):
+        m.d.comb += [
+            uop.robType.eq(ROBType.BRANCH),
+            uop.rs1.eq(instr_b.rs1),
+            uop.rs2.eq(instr_b.rs2),
+            uop.imm.eq(Cat(Const(0, unsigned(1)), instr_b.imm_4_1, instr_b.imm_10_5, instr_b.imm_11,
+                           instr_b.imm_12).as_signed())
+        ]
+        with m.Switch(instr_b.funct3):
+          with m.Case(0b000):  # BEQ
+            m.d.comb += uop.opcode.eq(uOPOpcode.BEQ)
+          with m.Case(0b001):  # BNE
+            m.d.comb += uop.opcode.eq(uOPOpcode.BNE)
+          with m.Case(0b100):  # BLT
+            m.d.comb += uop.opcode.eq(uOPOpcode.BLT)
+          with m.Case(0b101):  # BGE
+            m.d.comb += uop.opcode.eq(uOPOpcode.BGE)
+          with m.Case(0b110):  # BLTU
+            m.d.comb += uop.opcode.eq(uOPOpcode.BLTU)
+          with m.Case(0b111):  # BGEU
+            m.d.comb += uop.opcode.eq(uOPOpcode.BGEU)
+
+      with m.Case(RV32I_OP_SYSTEM):
+        m.d.comb += [uop.opcode.eq(uOPOpcode.EBREAK), uop.robType.eq(ROBType.EBREAK)]
+
+      with m.Default():
+        m.d.comb += uop.valid.eq(0)
+
+    return m
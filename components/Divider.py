@@ -0,0 +1,108 @@
+# Copyright 2022 Markus Lavin (https://www.zzzconsulting.se/).
+#
+# This source describes Open Hardware and is licensed under the CERN-OHL-P v2.
+#
+# You may redistribute and modify this documentation and make products using it
+# under the terms of the CERN-OHL-P v2 (https:/cern.ch/cern-ohl).  This
+# documentation is distributed WITHOUT ANY EXPRESS OR IMPLIED WARRANTY,
+# INCLUDING OF MERCHANTABILITY, SATISFACTORY QUALITY AND FITNESS FOR A
+# PARTICULAR PURPOSE. Please see the CERN-OHL-P v2 for applicable conditions.
+
+from amaranth import *
+
+from components.BroadCast import *
+from components.Utils import *
+from components.MicroOperation import *
+
+
+# Iterative divider for the DIV uOP class (same ports as ExecutionUnit). One uOP at a time is divided, a quotient bit
+# per cycle, on the magnitudes of the operands and the signs are applied to the result. A uOP is broadcast 33 cycles
+# after dispatch and the next one can be dispatched in the cycle it is broadcast.
+class Divider(Elaboratable):
+
+  def __init__(self, latencies={}, threads=1, config=CoreConfig()):
+    self.config = config
+    self.o_dispatch_rdy = Signal(maxLatency(latencies) + 1)  # Any uOP can be dispatched if set (see ExecutionUnit).
+    self.i_dispatch_en = Signal()
+    self.i_dispatch_uop = Signal(MicroOperationTypeLayout(config))
+    self.o_broadcast = Signal(BroadcastBusTypeLayout(config))
+    self.o_wakeup = Signal(WakeupTypeLayout(config))  # The uOP broadcast in the next cycle (unless halted).
+    # Squash (per thread, all uops of the thread younger than i_squash_robidx).
+    self.i_squash_en = [Signal(name='i_squash{}_en'.format(t)) for t in range(threads)]
+    self.i_squash_robidx = [Signal(config.robIdxBits, name='i_squash{}_robidx'.format(t)) for t in range(threads)]
+    self.i_head_robidx = [Signal(config.robIdxBits, name='i_head{}_robidx'.format(t)) for t in range(threads)]
+    self.i_halt_en = Signal()
+
+  def elaborate(self, platform):
+    m = Module()
+
+    uop = Signal(MicroOperationTypeLayout(self.config))  # The uOP being divided.
+    count = Signal(range(33))  # Quotient bits left to compute (the result is broadcast when zero).
+    rem = Signal(32)  # Partial remainder.
+    quo = Signal(32)  # Dividend bits not yet shifted into rem followed by the quotient bits computed so far.
+    divisor = Signal(32)
+    neg_quo = Signal()
+    neg_rem = Signal()
+
+    done = uop.valid & (count == 0)
+    m.d.comb += self.o_dispatch_rdy.eq(Mux(~uop.valid | (done & ~self.i_halt_en), (1 << len(self.o_dispatch_rdy)) - 1,
+                                           0))
+
+    # Broadcast.
+    m.d.comb += [
+        self.o_broadcast.valid.eq(done),
+        self.o_broadcast.robIdx.eq(uop.robidx),
+        self.o_broadcast.data.eq(
+            Mux((uop.opcode == uOPOpcode.REM) | (uop.opcode == uOPOpcode.REMU), Mux(neg_rem, -rem, rem),
+                Mux(neg_quo, -quo, quo)))
+    ]
+    with m.If(done & ~self.i_halt_en):
+      m.d.sync += uop.valid.eq(0)
+
+    m.d.comb += [
+        self.o_wakeup.valid.eq(uop.valid & ((count == 1) | (done & self.i_halt_en))),
+        self.o_wakeup.robIdx.eq(uop.robidx)
+    ]
+
+    # Restoring division step.
+    with m.If(uop.valid & (count != 0)):
+      shifted = Cat(quo[31], rem)
+      diff = Signal(34)
+      m.d.comb += diff.eq(shifted - divisor)
+      with m.If(~diff[33]):
+        m.d.sync += [rem.eq(diff), quo.eq(Cat(Const(1, 1), quo[0:31]))]
+      with m.Else():
+        m.d.sync += [rem.eq(shifted), quo.eq(Cat(Const(0, 1), quo[0:31]))]
+      m.d.sync += count.eq(count - 1)
+
+    # Dispatch. Division by zero gives a quotient with all bits set (not negated) and the dividend as remainder, the
+    # overflowing signed division (-2^31 / -1) gives -2^31 and zero.
+    op1 = self.i_dispatch_uop.op1
+    op2 = self.i_dispatch_uop.op2
+    signed = (self.i_dispatch_uop.opcode == uOPOpcode.DIV) | (self.i_dispatch_uop.opcode == uOPOpcode.REM)
+    neg1 = signed & op1[31]
+    neg2 = signed & op2[31]
+    with m.If(self.i_dispatch_en):
+      m.d.sync += [
+          uop.eq(self.i_dispatch_uop),
+          count.eq(32),
+          rem.eq(0),
+          quo.eq(Mux(neg1, -op1, op1)),
+          divisor.eq(Mux(neg2, -op2, op2)),
+          neg_quo.eq((neg1 ^ neg2) & (op2 != 0)),
+          neg_rem.eq(neg1)
+      ]
+
+    # Squash (highest priority).
+    def younger(uop):
+      return isSquashed(uop.robidx, self.i_squash_en, self.i_squash_robidx, self.i_head_robidx)
+
+    with m.If(Cat(self.i_squash_en).any()):
+      with m.If(self.i_dispatch_en):
+        m.d.sync += uop.valid.eq(self.i_dispatch_uop.valid & ~younger(self.i_dispatch_uop))
+      with m.Elif(younger(uop)):
+        m.d.sync += uop.valid.eq(0)
+
+    addDebugSignals(m, uop)
+
+    return m
@@ -18,150 +18,107 @@ from components.MicroOperation import *
 
 class ExecutionUnit(Elaboratable):
 
-  def __init__(self):
-    self.o_dispatch_rdy = Signal()
+  def __init__(self, classes=(uOPClass.ALU, uOPClass.BRANCH), latencies={}, threads=1, config=CoreConfig()):
+    self.config = config
+    self.classes = classes  # The uOP classes this unit executes (see uOPClassOf).
+    self.latencies = latencies  # Latency of the uOPs that take more than one cycle (see latencyOf).
+    self.o_dispatch_rdy = Signal(maxLatency(latencies) + 1)  # A uOP with latency n can be dispatched if bit n is set.
     self.i_dispatch_en = Signal()
-    self.i_dispatch_uop = Signal(MicroOperationTypeLayout)
-    self.o_broadcast = Signal(BroadcastBusTypeLayout)
-    self.i_flush_en = Signal()
+    self.i_dispatch_uop = Signal(MicroOperationTypeLayout(config))
+    self.o_broadcast = Signal(BroadcastBusTypeLayout(config))
+    self.o_wakeup = Signal(WakeupTypeLayout(config))  # The uOP broadcast in the next cycle (unless halted).
+    # Squash (per thread, all uops of the thread younger than i_squash_robidx).
+    self.i_squash_en = [Signal(name='i_squash{}_en'.format(t)) for t in range(threads)]
+    self.i_squash_robidx = [Signal(config.robIdxBits, name='i_squash{}_robidx'.format(t)) for t in range(threads)]
+    self.i_head_robidx = [Signal(config.robIdxBits, name='i_head{}_robidx'.format(t)) for t in range(threads)]
     self.i_halt_en = Signal()
 
   def elaborate(self, platform):
     m = Module()
 
-    m.d.comb += self.o_dispatch_rdy.eq(~self.i_halt_en)
+    # A uOP with latency n enters the pipe n stages before its end (where the result is computed and broadcast) so it
+    # is broadcast n cycles after dispatch. It can not be dispatched if the stage it enters is taken by the uOP moving
+    # up from the stage before.
+    depth = maxLatency(self.latencies)
+    pipe = Array([Signal(MicroOperationTypeLayout(self.config), name='pipe{}'.format(idx)) for idx in range(depth)])
+    out = pipe[depth - 1]
+    latency = latencyOf(self.i_dispatch_uop.opcode, self.latencies)
 
-    pipe = Array([Signal(MicroOperationTypeLayout) for _ in range(4)])
+    for n in range(1, depth + 1):
+      m.d.comb += self.o_dispatch_rdy[n].eq(~self.i_halt_en & ((n == depth) | ~pipe[depth - n - 1].valid))
     with m.If(~self.i_halt_en):
-      m.d.sync += [
-          pipe[0].eq(Mux(self.i_dispatch_en, self.i_dispatch_uop, 0)), pipe[1].eq(pipe[0]), pipe[2].eq(pipe[1]),
-          pipe[3].eq(pipe[2])
-      ]
+      for idx in range(depth):
+        m.d.sync += pipe[idx].eq(pipe[idx - 1] if idx > 0 else 0)
+        with m.If(self.i_dispatch_en & (latency == depth - idx)):
+          m.d.sync += pipe[idx].eq(self.i_dispatch_uop)
+
+    # The latency is fixed so the uOP that reaches the end of the pipe in the next cycle is known.
+    def wakeup(valid, uop):
+      m.d.comb += [self.o_wakeup.valid.eq(valid), self.o_wakeup.robIdx.eq(uop.robidx)]
+
+    if depth > 1:
+      wakeup(pipe[depth - 2].valid, pipe[depth - 2])
+    with m.If(self.i_dispatch_en & (latency == 1)):
+      wakeup(self.i_dispatch_uop.valid, self.i_dispatch_uop)
+    with m.If(self.i_halt_en):
+      wakeup(out.valid, out)
 
     m.d.comb += [self.o_broadcast.valid.eq(0), self.o_broadcast.robIdx.eq(0), self.o_broadcast.data.eq(0)]
 
-    with m.Switch(pipe[3].opcode):
-      with m.Case(uOPOpcode.LUI):
-        m.d.comb += [
-            self.o_broadcast.valid.eq(pipe[3].valid),
-            self.o_broadcast.robIdx.eq(pipe[3].robidx),
-            self.o_broadcast.data.eq(pipe[3].op1)
-        ]
-      with m.Case(uOPOpcode.ADD):
-        m.d.comb += [
-            self.o_broadcast.valid.eq(pipe[3].valid),
-            self.o_broadcast.robIdx.eq(pipe[3].robidx),
-            self.o_broadcast.data.eq(pipe[3].op1 + pipe[3].op2)
-        ]
-      with m.Case(uOPOpcode.SUB):
-        m.d.comb += [
-            self.o_broadcast.valid.eq(pipe[3].valid),
-            self.o_broadcast.robIdx.eq(pipe[3].robidx),
-            self.o_broadcast.data.eq(pipe[3].op1 - pipe[3].op2)
-        ]
-      with m.Case(uOPOpcode.SLL):
-        m.d.comb += [
-            self.o_broadcast.valid.eq(pipe[3].valid),
-            self.o_broadcast.robIdx.eq(pipe[3].robidx),
-            self.o_broadcast.data.eq(pipe[3].op1 << pipe[3].op2[0:5])
-        ]
-      with m.Case(uOPOpcode.SLT):  # XXX: signed
-        m.d.comb += [
-            self.o_broadcast.valid.eq(pipe[3].valid),
-            self.o_broadcast.robIdx.eq(pipe[3].robidx),
-            self.o_broadcast.data.eq(Mux(pipe[3].op1.as_signed() < pipe[3].op2.as_signed(), 1, 0))
-        ]
-      with m.Case(uOPOpcode.SLTU):  # XXX: unsigned
-        m.d.comb += [
-            self.o_broadcast.valid.eq(pipe[3].valid),
-            self.o_broadcast.robIdx.eq(pipe[3].robidx),
-            self.o_broadcast.data.eq(Mux(pipe[3].op1 < pipe[3].op2, 1, 0))
-        ]
-      with m.Case(uOPOpcode.XOR):
-        m.d.comb += [
-            self.o_broadcast.valid.eq(pipe[3].valid),
-            self.o_broadcast.robIdx.eq(pipe[3].robidx),
-            self.o_broadcast.data.eq(pipe[3].op1 ^ pipe[3].op2)
-        ]
-      with m.Case(uOPOpcode.SRL):
-        m.d.comb += [
-            self.o_broadcast.valid.eq(pipe[3].valid),
-            self.o_broadcast.robIdx.eq(pipe[3].robidx),
-            self.o_broadcast.data.eq(pipe[3].op1 >> pipe[3].op2[0:5])
-        ]
-      with m.Case(uOPOpcode.SRA):  # XXX: arithmetic
-        m.d.comb += [
-            self.o_broadcast.valid.eq(pipe[3].valid),
-            self.o_broadcast.robIdx.eq(pipe[3].robidx),
-            self.o_broadcast.data.eq(pipe[3].op1.as_signed() >> pipe[3].op2[0:5])
-        ]
-      with m.Case(uOPOpcode.OR):
-        m.d.comb += [
-            self.o_broadcast.valid.eq(pipe[3].valid),
-            self.o_broadcast.robIdx.eq(pipe[3].robidx),
-            self.o_broadcast.data.eq(pipe[3].op1 | pipe[3].op2)
-        ]
-      with m.Case(uOPOpcode.AND):
-        m.d.comb += [
-            self.o_broadcast.valid.eq(pipe[3].valid),
-            self.o_broadcast.robIdx.eq(pipe[3].robidx),
-            self.o_broadcast.data.eq(pipe[3].op1 & pipe[3].op2)
-        ]
-
-      with m.Case(uOPOpcode.BEQ):
-        m.d.comb += [
-            self.o_broadcast.valid.eq(pipe[3].valid),
-            self.o_broadcast.robIdx.eq(pipe[3].robidx),
-            self.o_broadcast.data.eq(Mux(pipe[3].op1 == pipe[3].op2, (pipe[3].imm << 1).as_signed(), 4))
-        ]
-      with m.Case(uOPOpcode.BNE):
-        m.d.comb += [
-            self.o_broadcast.valid.eq(pipe[3].valid),
-            self.o_broadcast.robIdx.eq(pipe[3].robidx),
-            self.o_broadcast.data.eq(Mux(pipe[3].op1 != pipe[3].op2, (pipe[3].imm << 1).as_signed(), 4))
-        ]
-      with m.Case(uOPOpcode.BLT):
-        m.d.comb += [
-            self.o_broadcast.valid.eq(pipe[3].valid),
-            self.o_broadcast.robIdx.eq(pipe[3].robidx),
-            self.o_broadcast.data.eq(
-                Mux(pipe[3].op1.as_signed() < pipe[3].op2.as_signed(), (pipe[3].imm << 1).as_signed(), 4))
-        ]
-      with m.Case(uOPOpcode.BGE):
-        m.d.comb += [
-            self.o_broadcast.valid.eq(pipe[3].valid),
-            self.o_broadcast.robIdx.eq(pipe[3].robidx),
-            self.o_broadcast.data.eq(
-                Mux(pipe[3].op1.as_signed() >= pipe[3].op2.as_signed(), (pipe[3].imm << 1).as_signed(), 4))
-        ]
-      with m.Case(uOPOpcode.BLTU):
-        m.d.comb += [
-            self.o_broadcast.valid.eq(pipe[3].valid),
-            self.o_broadcast.robIdx.eq(pipe[3].robidx),
-            self.o_broadcast.data.eq(
-                Mux(pipe[3].op1.as_unsigned() < pipe[3].op2.as_unsigned(), (pipe[3].imm << 1).as_signed(), 4))
-        ]
-      with m.Case(uOPOpcode.BGEU):
-        m.d.comb += [
-            self.o_broadcast.valid.eq(pipe[3].valid),
-            self.o_broadcast.robIdx.eq(pipe[3].robidx),
-            self.o_broadcast.data.eq(
-                Mux(pipe[3].op1.as_unsigned() >= pipe[3].op2.as_unsigned(), (pipe[3].imm << 1).as_signed(), 4))
-        ]
-
-      with m.Case(uOPOpcode.EBREAK):
-        m.d.comb += [
-            self.o_broadcast.valid.eq(pipe[3].valid),
-            self.o_broadcast.robIdx.eq(pipe[3].robidx),
-            self.o_broadcast.data.eq(0)
-        ]
-
-    # Flush (highest priority).
-    with m.If(self.i_flush_en):
-      for idx in range(4):
-        m.d.sync += pipe[idx].valid.eq(0)
-
-    addDebugSignals(m, pipe[3], name='pipe3')
+    op1 = out.op1
+    op2 = out.op2
+
+    # Branches produce the PC increment (size of the instruction if not taken).
+    def branch(taken):
+      return Mux(taken, (out.imm << 1).as_signed(), Mux(out.rvc, 2, 4))
+
+    results = {
+        uOPOpcode.LUI: op1,
+        uOPOpcode.ADD: op1 + op2,
+        uOPOpcode.SUB: op1 - op2,
+        uOPOpcode.SLL: op1 << op2[0:5],
+        uOPOpcode.SLT: Mux(op1.as_signed() < op2.as_signed(), 1, 0),
+        uOPOpcode.SLTU: Mux(op1 < op2, 1, 0),
+        uOPOpcode.XOR: op1 ^ op2,
+        uOPOpcode.SRL: op1 >> op2[0:5],
+        uOPOpcode.SRA: op1.as_signed() >> op2[0:5],
+        uOPOpcode.OR: op1 | op2,
+        uOPOpcode.AND: op1 & op2,
+        uOPOpcode.BEQ: branch(op1 == op2),
+        uOPOpcode.BNE: branch(op1 != op2),
+        uOPOpcode.BLT: branch(op1.as_signed() < op2.as_signed()),
+        uOPOpcode.BGE: branch(op1.as_signed() >= op2.as_signed()),
+        uOPOpcode.BLTU: branch(op1.as_unsigned() < op2.as_unsigned()),
+        uOPOpcode.BGEU: branch(op1.as_unsigned() >= op2.as_unsigned()),
+        uOPOpcode.EBREAK: 0
+    }
+
+    with m.Switch(out.opcode):
+      for opcode, result in results.items():
+        if uOPClassOf(opcode) in self.classes:
+          with m.Case(opcode):
+            m.d.comb += [
+                self.o_broadcast.valid.eq(out.valid),
+                self.o_broadcast.robIdx.eq(out.robidx),
+                self.o_broadcast.data.eq(result)
+            ]
+
+    # Squash (highest priority). Note that the valid bits are computed for the state after this cycle so that a uop
+    # dispatched in the same cycle is also caught.
+    def younger(uop):
+      return isSquashed(uop.robidx, self.i_squash_en, self.i_squash_robidx, self.i_head_robidx)
+
+    with m.If(Cat(self.i_squash_en).any()):
+      with m.If(~self.i_halt_en):
+        for idx in range(depth):
+          m.d.sync += pipe[idx].valid.eq((pipe[idx - 1].valid & ~younger(pipe[idx - 1])) if idx > 0 else 0)
+          with m.If(self.i_dispatch_en & (latency == depth - idx)):
+            m.d.sync += pipe[idx].valid.eq(self.i_dispatch_uop.valid & ~younger(self.i_dispatch_uop))
+      with m.Else():
+        for idx in range(depth):
+          m.d.sync += pipe[idx].valid.eq(pipe[idx].valid & ~younger(pipe[idx]))
+
+    addDebugSignals(m, out)
     addDebugSignals(m, self.i_dispatch_uop)
 
     return m
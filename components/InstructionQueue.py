@@ -11,45 +11,67 @@
 from amaranth import *
 from amaranth.lib import data
 
+from components.BranchPredictor import *
+from components.Decoder import *
+from components.CoreConfig import *
+
 InstructionQueueEntryLayout = data.StructLayout({
-    "instr": unsigned(32),
-    "pc": unsigned(32)  # PC of the corresponding instruction.
+    "uop": DecodedInstrLayout,  # Decoded at fetch.
+    "pc": unsigned(32),  # PC of the corresponding instruction.
+    "pred": PredictionTypeLayout  # Fetch prediction state (needed to detect and recover from mispredicts).
 })
 
 
 class InstructionQueue(Elaboratable):
 
-  def __init__(self):
+  def __init__(self, config=CoreConfig()):
+    self.config = config
     # Write.
     self.o_w_rdy = Signal()
     self.i_w_data = Signal(InstructionQueueEntryLayout)
     self.i_w_en = Signal()
+    # Second write (the entry following i_w_data, only together with i_w_en).
+    self.o_w2_rdy = Signal()
+    self.i_w2_data = Signal(InstructionQueueEntryLayout)
+    self.i_w2_en = Signal()
     # Read.
     self.o_r_rdy = Signal()
     self.o_r_data = Signal(InstructionQueueEntryLayout)
     self.i_r_en = Signal()
+    # Second read (the entry following o_r_data, only consumed together with it).
+    self.o_r2_rdy = Signal()
+    self.o_r2_data = Signal(InstructionQueueEntryLayout)
+    self.i_r2_en = Signal()
+    self.o_count = Signal(config.iqIdxBits + 1)  # Entries in the queue.
     # Flush.
     self.i_flush_en = Signal()
 
   def elaborate(self, platform):
     m = Module()
 
-    iq = Array([Signal(InstructionQueueEntryLayout) for _ in range(8)])
-    rp = Signal(4)
-    wp = Signal(4)
+    bits = self.config.iqIdxBits
+    iq = Array([Signal(InstructionQueueEntryLayout) for _ in range(self.config.iqEntries)])
+    rp = Signal(bits + 1)
+    wp = Signal(bits + 1)
     empty = Signal()
     full = Signal()
 
-    m.d.comb += empty.eq((rp[0:3] == wp[0:3]) & (rp[3] == wp[3]))
-    m.d.comb += full.eq((rp[0:3] == wp[0:3]) & (rp[3] != wp[3]))
+    m.d.comb += empty.eq((rp[0:bits] == wp[0:bits]) & (rp[bits] == wp[bits]))
+    m.d.comb += full.eq((rp[0:bits] == wp[0:bits]) & (rp[bits] != wp[bits]))
+    m.d.comb += self.o_count.eq(wp - rp)
 
     # Write
-    m.d.comb += [self.o_w_rdy.eq(~full)]
-    with m.If(~full & self.i_w_en):
-      m.d.sync += [iq[wp[0:3]].eq(self.i_w_data), wp.eq(wp + 1)]
+    m.d.comb += [self.o_w_rdy.eq(~full), self.o_w2_rdy.eq((wp - rp)[0:bits + 1] < len(iq) - 1)]
+    with m.If(self.o_w2_rdy & self.i_w_en & self.i_w2_en):
+      m.d.sync += [iq[wp[0:bits]].eq(self.i_w_data), iq[(wp + 1)[0:bits]].eq(self.i_w2_data), wp.eq(wp + 2)]
+    with m.Elif(~full & self.i_w_en):
+      m.d.sync += [iq[wp[0:bits]].eq(self.i_w_data), wp.eq(wp + 1)]
     # Read.
-    m.d.comb += [self.o_r_data.eq(iq[rp[0:3]]), self.o_r_rdy.eq(~empty)]
-    with m.If(~empty & self.i_r_en):
+    m.d.comb += [self.o_r_data.eq(iq[rp[0:bits]]), self.o_r_rdy.eq(~empty)]
+    m.d.comb += [self.o_r2_data.eq(iq[(rp + 1)[0:bits]]), self.o_r2_rdy.eq((wp - rp)[0:bits + 1] >= 2)]
+    with m.If(self.o_r2_rdy & self.i_r_en & self.i_r2_en):
+      m.d.sync += [rp.eq(rp + 2)]
+    with m.Elif(~empty & self.i_r_en):
       m.d.sync += [rp.eq(rp + 1)]
 
     with m.If(self.i_flush_en):
@@ -14,7 +14,9 @@ from enum import Enum, unique, auto
 
 from components.BroadCast import *
 from components.Cache import *
+from components.StoreSetPredictor import *
 from components.Utils import *
+from components.CoreConfig import *
 
 
 @unique
@@ -39,38 +41,67 @@ class LSQStatus(Enum):
   COMMITTED = auto()
 
 
-LoadStoreQueueEntryLayout = data.StructLayout({
-    "type": LSQType,
-    "addr_valid": unsigned(1),
-    "addr_robidx": unsigned(3),
-    "addr_offset": unsigned(12),
-    "addr": unsigned(32),
-    "data_valid": unsigned(1),
-    "data_robidx": unsigned(3),
-    "data": unsigned(32),
-    "size": LSQSize,
-    "signed": unsigned(1),
-    "robidx": unsigned(3),
-    "status": LSQStatus
-})
+def LoadStoreQueueEntryLayout(config):
+  return data.StructLayout({
+      "type": LSQType,
+      "addr_valid": unsigned(1),
+      "addr_robidx": unsigned(config.robIdxBits),
+      "addr_offset": unsigned(12),
+      "addr": unsigned(32),
+      "data_valid": unsigned(1),
+      "data_robidx": unsigned(config.robIdxBits),
+      "data": unsigned(32),
+      "size": LSQSize,
+      "signed": unsigned(1),
+      "robidx": unsigned(config.robIdxBits),
+      "pc": unsigned(32),  # Of the instruction (the StoreSetPredictor is indexed by it).
+      "status": LSQStatus
+  })
 
 
 class LoadStoreQueue(Elaboratable):
 
-  def __init__(self):
+  def __init__(self,
+               broadcastBuses=1,
+               threads=1,
+               forwarding=False,
+               speculation=False,
+               storeSetBits=0,
+               config=CoreConfig()):
+    assert storeSetBits == 0 or speculation
+    self.threads = threads
+    # Loads behind the head whose bytes are all written by older stores take them from the stores (see elaborate).
+    self.forwarding = forwarding
+    # Loads behind the head read the cache ahead of older stores with unknown addresses (see elaborate).
+    self.speculation = speculation
+    self.storeSetBits = storeSetBits  # Index bits of the StoreSetPredictor, zero lets every load go ahead.
+    self.config = config
     # Broadcast.
-    self.i_broadcast = Signal(BroadcastBusTypeLayout)
-    self.o_broadcast = Signal(BroadcastBusTypeLayout)
+    self.i_broadcast = [
+        Signal(BroadcastBusTypeLayout(config), name='i_broadcast{}'.format(idx)) for idx in range(broadcastBuses)
+    ]
+    self.o_broadcast = Signal(BroadcastBusTypeLayout(config))
+    self.o_wakeup = Signal(WakeupTypeLayout(config))  # A load expected to hit in the cache in the next cycle.
     # Allocate.
     self.o_issue_rdy = Signal()
-    self.o_issue_idx = Signal(2)
-    self.i_issue = Signal(LoadStoreQueueEntryLayout)
+    self.o_issue_idx = Signal(config.lsqIdxBits)
+    self.i_issue = Signal(LoadStoreQueueEntryLayout(config))
     self.i_issue_en = Signal()
+    # Second allocate (may be used with or without the first, o_issue2_rdy if there is room for both).
+    self.o_issue2_rdy = Signal()
+    self.o_issue2_idx = Signal(config.lsqIdxBits)
+    self.i_issue2 = Signal(LoadStoreQueueEntryLayout(config))
+    self.i_issue2_en = Signal()
     # Commit.
-    self.i_commit_idx = Signal(2)
+    self.i_commit_idx = Signal(config.lsqIdxBits)
     self.i_commit_en = Signal()
-    # Flush.
-    self.i_flush_en = Signal()
+    # Squash (per thread, all entries of the thread younger than i_squash_robidx).
+    self.i_squash_en = [Signal(name='i_squash{}_en'.format(t)) for t in range(threads)]
+    self.i_squash_robidx = [Signal(config.robIdxBits, name='i_squash{}_robidx'.format(t)) for t in range(threads)]
+    self.i_head_robidx = [Signal(config.robIdxBits, name='i_head{}_robidx'.format(t)) for t in range(threads)]
+    # Replay (per thread, a load that was executed too early and has to be replayed by the ROB).
+    self.o_replay_en = [Signal(name='o_replay{}_en'.format(t)) for t in range(threads)]
+    self.o_replay_robidx = [Signal(config.robIdxBits, name='o_replay{}_robidx'.format(t)) for t in range(threads)]
     # BUS IF
     self.o_wb_adr = Signal(32)
     self.o_wb_dat = Signal(32)
@@ -85,7 +116,8 @@ class LoadStoreQueue(Elaboratable):
   def elaborate(self, platform):
     m = Module()
 
-    m.submodules.u_dcache = u_dcache = Cache()
+    m.submodules.u_dcache = u_dcache = Cache(indexBits=self.config.dcacheIndexBits,
+                                            offsetBits=self.config.dcacheOffsetBits)
 
     m.d.comb += [
         self.o_wb_adr.eq(u_dcache.o_wb_adr),
@@ -99,91 +131,276 @@ class LoadStoreQueue(Elaboratable):
         u_dcache.i_wb_ack.eq(self.i_wb_ack)
     ] # yapf: disable
 
-    lsq = Array([Signal(LoadStoreQueueEntryLayout) for _ in range(4)])
-    rp = Signal(3)
-    wp = Signal(3)
+    bits = self.config.lsqIdxBits
+    lsq = Array([Signal(LoadStoreQueueEntryLayout(self.config)) for _ in range(self.config.lsqEntries)])
+    rp = Signal(bits + 1)
+    wp = Signal(bits + 1)
     empty = Signal()
     full = Signal()
 
-    m.d.comb += empty.eq((rp[0:2] == wp[0:2]) & (rp[2] == wp[2]))
-    m.d.comb += full.eq((rp[0:2] == wp[0:2]) & (rp[2] != wp[2]))
+    m.d.comb += empty.eq((rp[0:bits] == wp[0:bits]) & (rp[bits] == wp[bits]))
+    m.d.comb += full.eq((rp[0:bits] == wp[0:bits]) & (rp[bits] != wp[bits]))
 
     # Allocate.
-    m.d.comb += [self.o_issue_rdy.eq(~full), self.o_issue_idx.eq(wp)]
-    lsq_wp = lsq[wp[0:2]]
-    with m.If(~full & self.i_issue_en):
-      m.d.sync += [lsq_wp.eq(self.i_issue), lsq_wp.status.eq(LSQStatus.ALLOCATED), wp.eq(wp + 1)]
+    wp2 = Signal(bits + 1)
+    m.d.comb += wp2.eq(wp + self.i_issue_en)
+    m.d.comb += [
+        self.o_issue_rdy.eq(~full),
+        self.o_issue_idx.eq(wp),
+        self.o_issue2_rdy.eq((wp - rp)[0:bits + 1] < len(lsq) - 1),
+        self.o_issue2_idx.eq(wp2)
+    ]
+
+    def issue(lsqe, uop):
+      m.d.sync += [lsqe.eq(uop), lsqe.status.eq(LSQStatus.ALLOCATED)]
       # If broadcast happens at the same time as issue then check no valid operands and possibly override.
-      with m.If(self.i_broadcast.valid & ~self.i_issue.addr_valid
-                & (self.i_issue.addr_robidx == self.i_broadcast.robIdx)):
-        m.d.sync += [lsq_wp.addr.eq(self.i_broadcast.data), lsq_wp.addr_valid.eq(1)]
-      with m.If(self.i_broadcast.valid & ~self.i_issue.data_valid
-                & (self.i_issue.data_robidx == self.i_broadcast.robIdx)):
-        m.d.sync += [lsq_wp.data.eq(self.i_broadcast.data), lsq_wp.data_valid.eq(1)]
+      for broadcast in self.i_broadcast:
+        with m.If(broadcast.valid & ~uop.addr_valid & (uop.addr_robidx == broadcast.robIdx)):
+          m.d.sync += [lsqe.addr.eq(broadcast.data), lsqe.addr_valid.eq(1)]
+        with m.If(broadcast.valid & ~uop.data_valid & (uop.data_robidx == broadcast.robIdx)):
+          m.d.sync += [lsqe.data.eq(broadcast.data), lsqe.data_valid.eq(1)]
+
+    issue1 = ~full & self.i_issue_en
+    issue2 = Mux(self.i_issue_en, self.o_issue2_rdy, ~full) & self.i_issue2_en
+    with m.If(issue1):
+      issue(lsq[wp[0:bits]], self.i_issue)
+    with m.If(issue2):
+      issue(lsq[wp2[0:bits]], self.i_issue2)
+    m.d.sync += wp.eq(wp + issue1 + issue2)
 
     # Generate broadcast bus monitoring logic.
     for lsqe in lsq:
-      with m.If(self.i_broadcast.valid & (lsqe.status == LSQStatus.ALLOCATED) & ~lsqe.addr_valid
-                & (lsqe.addr_robidx == self.i_broadcast.robIdx)):
-        m.d.sync += [lsqe.addr.eq(self.i_broadcast.data), lsqe.addr_valid.eq(1)]
-      with m.If(self.i_broadcast.valid & (lsqe.status == LSQStatus.ALLOCATED) & ~lsqe.data_valid
-                & (lsqe.data_robidx == self.i_broadcast.robIdx)):
-        m.d.sync += [lsqe.data.eq(self.i_broadcast.data), lsqe.data_valid.eq(1)]
-
-    lsq_rp = lsq[rp[0:2]]
-    with m.If(~empty & ~self.i_flush_en & (lsq_rp.status == LSQStatus.ALLOCATED)):
+      for broadcast in self.i_broadcast:
+        with m.If(broadcast.valid & (lsqe.status == LSQStatus.ALLOCATED) & ~lsqe.addr_valid
+                  & (lsqe.addr_robidx == broadcast.robIdx)):
+          m.d.sync += [lsqe.addr.eq(broadcast.data), lsqe.addr_valid.eq(1)]
+        with m.If(broadcast.valid & (lsqe.status == LSQStatus.ALLOCATED) & ~lsqe.data_valid
+                  & (lsqe.data_robidx == broadcast.robIdx)):
+          m.d.sync += [lsqe.data.eq(broadcast.data), lsqe.data_valid.eq(1)]
+
+    def byteMask(lsqe, addr):
+      # The bytes of the word holding addr that are accessed.
+      return Mux(lsqe.size == LSQSize.BYTE, 0b1 << addr[0:2],
+                 Mux(lsqe.size == LSQSize.HALF, Mux(addr[1], 0b1100, 0b0011), 0b1111))
+
+    def storeData(lsqe):
+      # The data of a store in every byte lane that it may write.
+      # XXX: Repl and aggregate data structure fields cause problems in RTLIL generation (for Verilog) for some reason.
+      return Mux(lsqe.size == LSQSize.BYTE, Cat(lsqe.data[0:8], lsqe.data[0:8], lsqe.data[0:8], lsqe.data[0:8]),
+                 Mux(lsqe.size == LSQSize.HALF, Cat(lsqe.data[0:16], lsqe.data[0:16]), lsqe.data))
+
+    def sameThread(lsqe, other):
+      return (threadOf(lsqe.robidx, self.threads) == threadOf(other.robidx, self.threads)) if self.threads > 1 else 1
+
+    def broadcastLoad(lsqe, addr, word):
+      # Broadcast the result of a load from the word holding addr.
+      m.d.comb += [self.o_broadcast.valid.eq(1), self.o_broadcast.robIdx.eq(lsqe.robidx)]
+      with m.Switch(lsqe.size):
+        with m.Case(LSQSize.BYTE):
+          data = word.word_select(addr[0:2], 8)
+          m.d.comb += self.o_broadcast.data.eq(Mux(lsqe.signed, 0 + data.as_signed(), data))
+        with m.Case(LSQSize.HALF):
+          data = word.word_select(addr[1], 16)
+          m.d.comb += self.o_broadcast.data.eq(Mux(lsqe.signed, 0 + data.as_signed(), data))
+        with m.Case(LSQSize.WORD):
+          m.d.comb += self.o_broadcast.data.eq(word)
+
+    lsq_rp = lsq[rp[0:bits]]
+    advance = Signal()  # The head entry leaves the queue.
+    head_broadcast = Signal()  # The head entry is broadcast.
+    head_busy = Signal()  # The head entry accesses the cache or is broadcast (whether the cache is ready or not).
+    with m.If(~empty & (lsq_rp.status == LSQStatus.ALLOCATED)):
       addr = lsq_rp.addr + lsq_rp.addr_offset.as_signed()
       with m.If((lsq_rp.type == LSQType.LOAD) & lsq_rp.addr_valid):
-        m.d.comb += [u_dcache.i_cpu_addr.eq(addr), u_dcache.i_cpu_valid.eq(1)]
+        m.d.comb += [u_dcache.i_cpu_addr.eq(addr), u_dcache.i_cpu_valid.eq(1), head_busy.eq(1)]
         with m.If(u_dcache.o_cpu_rdy):
-          m.d.comb += [self.o_broadcast.valid.eq(1), self.o_broadcast.robIdx.eq(lsq_rp.robidx)]
+          broadcastLoad(lsq_rp, addr, u_dcache.o_cpu_data)
           m.d.sync += [lsq_rp.status.eq(LSQStatus.INVALID), rp.eq(rp + 1)]
-          with m.Switch(lsq_rp.size):
-            with m.Case(LSQSize.BYTE):
-              data = u_dcache.o_cpu_data.word_select(addr[0:2], 8)
-              m.d.comb += self.o_broadcast.data.eq(Mux(lsq_rp.signed, 0 + data.as_signed(), data))
-            with m.Case(LSQSize.HALF):
-              data = u_dcache.o_cpu_data.word_select(addr[1], 16)
-              m.d.comb += self.o_broadcast.data.eq(Mux(lsq_rp.signed, 0 + data.as_signed(), data))
-            with m.Case(LSQSize.WORD):
-              m.d.comb += self.o_broadcast.data.eq(u_dcache.o_cpu_data)
+          m.d.comb += [advance.eq(1), head_broadcast.eq(1)]
       with m.Elif((lsq_rp.type == LSQType.STORE) & lsq_rp.addr_valid & lsq_rp.data_valid):
-        m.d.comb += [self.o_broadcast.valid.eq(1), self.o_broadcast.robIdx.eq(lsq_rp.robidx)]
+        m.d.comb += [self.o_broadcast.valid.eq(1), self.o_broadcast.robIdx.eq(lsq_rp.robidx), head_broadcast.eq(1)]
+        m.d.comb += head_busy.eq(1)
         m.d.sync += [lsq_rp.status.eq(LSQStatus.DONE)]
       with m.Elif((lsq_rp.type == LSQType.FENCE)):
-        m.d.comb += [self.o_broadcast.valid.eq(1), self.o_broadcast.robIdx.eq(lsq_rp.robidx)]
+        m.d.comb += [self.o_broadcast.valid.eq(1), self.o_broadcast.robIdx.eq(lsq_rp.robidx), head_broadcast.eq(1)]
+        m.d.comb += head_busy.eq(1)
         m.d.sync += [lsq_rp.status.eq(LSQStatus.INVALID), rp.eq(rp + 1)]
-    with m.Elif(~empty & ~self.i_flush_en & (lsq_rp.status == LSQStatus.COMMITTED)):
+        m.d.comb += advance.eq(1)
+    with m.Elif(~empty & (lsq_rp.status == LSQStatus.COMMITTED)):
       addr = lsq_rp.addr + lsq_rp.addr_offset.as_signed()
-      with m.Switch(lsq_rp.size):
-        with m.Case(LSQSize.BYTE):
-          # XXX: Repl and aggregate data structure fields cause problems in RTLIL generation (for Verilog) for some reason.
-          # m.d.comb += [u_dcache.i_cpu_wsel.eq(0b1 << addr[0:2]), u_dcache.i_cpu_data.eq(Repl(lsq_rp.data[0:8], 4))]
-          m.d.comb += [
-              u_dcache.i_cpu_wsel.eq(0b1 << addr[0:2]),
-              u_dcache.i_cpu_data.eq(Cat(lsq_rp.data[0:8], lsq_rp.data[0:8], lsq_rp.data[0:8], lsq_rp.data[0:8]))
-          ]
-          pass
-        with m.Case(LSQSize.HALF):
-          m.d.comb += [
-              u_dcache.i_cpu_wsel.eq(Mux(addr[1], 0b1100, 0b0011)),
-              # u_dcache.i_cpu_data.eq(Repl(lsq_rp.data[0:16], 2))
-              u_dcache.i_cpu_data.eq(Cat(lsq_rp.data[0:16], lsq_rp.data[0:16]))
-          ]
-        with m.Case(LSQSize.WORD):
-          m.d.comb += [u_dcache.i_cpu_wsel.eq(0b1111), u_dcache.i_cpu_data.eq(lsq_rp.data)]
+      m.d.comb += [u_dcache.i_cpu_wsel.eq(byteMask(lsq_rp, addr)), u_dcache.i_cpu_data.eq(storeData(lsq_rp))]
       m.d.comb += [u_dcache.i_cpu_addr.eq(addr), u_dcache.i_cpu_we.eq(1), u_dcache.i_cpu_valid.eq(1)]
+      m.d.comb += head_busy.eq(1)
       with m.If(u_dcache.o_cpu_rdy):
         m.d.sync += [lsq_rp.status.eq(LSQStatus.INVALID), rp.eq(rp + 1)]
+        m.d.comb += advance.eq(1)
+    with m.Elif(~empty & ((lsq_rp.status == LSQStatus.INVALID)
+                          | ((lsq_rp.status == LSQStatus.DONE) & (lsq_rp.type == LSQType.LOAD)))):
+      # Squashed entry left behind by an older entry of another thread (see squash below) or a load that was executed
+      # ahead of older stores (see speculation below).
+      m.d.sync += rp.eq(rp + 1)
+      m.d.comb += advance.eq(1)
+
+    # Loads behind the head. The older entries are searched in age order from the head.
+    #
+    # Store-to-load forwarding. A load whose bytes are all written by older stores of its thread takes every byte from
+    # the youngest store writing it (if its data is known) and is broadcast without accessing the cache, leaving a hole
+    # that the head skips. All older stores must have known addresses (and there may be no older fence) so that no byte
+    # can be written by a store that was not considered.
+    #
+    # Speculation. A load reads the cache (if the head does not use it) once no older store with a known address writes
+    # any of its bytes, also ahead of older stores of its thread with unknown addresses unless the StoreSetPredictor
+    # puts it in the same store set as one of them (stores of other threads are not ordered with it). The load is then
+    # DONE until it reaches the head. If the address of one of those stores turns out to overlap it the load is
+    # executed again, the ROB is told to replay it (everything after it is squashed when it commits) and the predictor
+    # is trained. Loads that bypass the cache are never executed ahead of the head.
+    #
+    # The oldest load that can be forwarded, or otherwise read from the cache, is broadcast if the head entry is not.
+    if self.forwarding or self.speculation:
+      if self.storeSetBits > 0:
+        m.submodules.u_ssp = u_ssp = StoreSetPredictor(indexBits=self.storeSetBits, readPorts=len(lsq))
+      count = (wp - rp)[0:bits + 1]
+      older = []  # The (entry, live, address, byte mask, store set) of the entries older than the one considered.
+      fenced = Const(0)  # There is an older fence.
+      forwards = []
+      reads = []
+      violations = []
+      for k in range(len(lsq)):
+        lsqe = lsq[(rp + k)[0:bits]]
+        live = (k < count) & ((lsqe.status == LSQStatus.ALLOCATED) | (lsqe.status == LSQStatus.DONE)
+                              | (lsqe.status == LSQStatus.COMMITTED))
+        addr = lsqe.addr + lsqe.addr_offset.as_signed()
+        mask = byteMask(lsqe, addr)
+        ssid = (0, 0)
+        if self.storeSetBits > 0:
+          m.d.comb += u_ssp.i_rd_pc[k].eq(lsqe.pc)
+          ssid = (u_ssp.o_rd_valid[k], u_ssp.o_rd_ssid[k])
+        if k > 0:
+          covered = []
+          lanes = []
+          for lane in range(4):
+            usable = Const(0)  # The youngest older store writing the byte has its data and is of the same thread.
+            data = Const(0, 8)
+            for store, store_live, store_addr, store_mask, _ in older:
+              match = store_live & (store.type == LSQType.STORE) & store_mask[lane] & (store_addr[2:32] == addr[2:32])
+              usable = Mux(match, store.data_valid & sameThread(store, lsqe), usable)
+              data = Mux(match, storeData(store)[8 * lane:8 * (lane + 1)], data)
+            covered.append(~mask[lane] | usable)
+            lanes.append(data)
+
+          unknown = Const(0)  # There is an older store with an unknown address.
+          overlapped = Const(0)  # An older store with a known address writes some of the bytes.
+          dependent = Const(0)  # An older store of the thread with an unknown address is in the same store set.
+          violation = Const(0)  # The address of an older store of the thread arrives and it writes some of the bytes.
+          violation_pc = Const(0, 32)
+          for store, store_live, store_addr, store_mask, store_ssid in older:
+            same = sameThread(store, lsqe)
+            is_store = store_live & (store.type == LSQType.STORE)
+            unknown |= is_store & ~store.addr_valid
+            overlapped |= (is_store & store.addr_valid & (store_addr[2:32] == addr[2:32]) & (store_mask & mask).any())
+            if self.storeSetBits > 0:
+              dependent |= (is_store & ~store.addr_valid & same & ssid[0] & store_ssid[0] & (ssid[1] == store_ssid[1]))
+            for broadcast in self.i_broadcast:
+              resolved = broadcast.data + store.addr_offset.as_signed()
+              hit = (is_store & ~store.addr_valid & same & broadcast.valid & (store.addr_robidx == broadcast.robIdx)
+                     & (resolved[2:32] == addr[2:32]) & (byteMask(store, resolved) & mask).any())
+              violation |= hit
+              violation_pc = Mux(hit, store.pc, violation_pc)
+
+          load = live & (lsqe.type == LSQType.LOAD) & (lsqe.status == LSQStatus.ALLOCATED) & lsqe.addr_valid & ~fenced
+          if self.forwarding:
+            forward = Signal(name='forward{}'.format(k))
+            m.d.comb += forward.eq(load & ~unknown & Cat(covered).all())
+            forwards.append((forward, lsqe, addr, Cat(lanes)))
+          if self.speculation:
+            read = Signal(name='read{}'.format(k))
+            read_done = Signal(name='read{}_done'.format(k))  # The load is broadcast from the cache.
+            violated = Signal(name='violated{}'.format(k))
+            m.d.comb += [
+                read.eq(load & ~overlapped & ~dependent & ~addr[31]),
+                violated.eq(live & (lsqe.type == LSQType.LOAD) & ((lsqe.status == LSQStatus.DONE) | read_done)
+                            & violation)
+            ]
+            reads.append((read, read_done, lsqe, addr))
+            violations.append((violated, lsqe, violation_pc))
+        older.append((lsqe, live, addr, mask, ssid))
+        fenced |= live & (lsqe.type == LSQType.FENCE)
+
+      with m.If(~head_broadcast):
+        with m.If(0):
+          pass
+        for forward, lsqe, addr, word in forwards:
+          with m.Elif(forward):
+            broadcastLoad(lsqe, addr, word)
+            m.d.sync += lsqe.status.eq(LSQStatus.INVALID)
+      with m.If(~head_busy & ~Cat(forward for forward, _, _, _ in forwards).any()):
+        with m.If(0):
+          pass
+        for read, read_done, lsqe, addr in reads:
+          with m.Elif(read):
+            m.d.comb += [u_dcache.i_cpu_addr.eq(addr), u_dcache.i_cpu_valid.eq(1)]
+            with m.If(u_dcache.o_cpu_rdy):
+              broadcastLoad(lsqe, addr, u_dcache.o_cpu_data)
+              m.d.sync += lsqe.status.eq(LSQStatus.DONE)
+              m.d.comb += read_done.eq(1)
+
+      # Memory order violations. Every violated load is executed again, the oldest one of each thread is replayed and
+      # the oldest one trains the predictor.
+      for t in range(self.threads):
+        with m.If(0):
+          pass
+        for violated, lsqe, _ in violations:
+          with m.Elif(violated & ((threadOf(lsqe.robidx, self.threads) == t) if self.threads > 1 else 1)):
+            m.d.comb += [self.o_replay_en[t].eq(1), self.o_replay_robidx[t].eq(lsqe.robidx)]
+      if self.storeSetBits > 0:
+        with m.If(0):
+          pass
+        for violated, lsqe, violation_pc in violations:
+          with m.Elif(violated):
+            m.d.comb += [
+                u_ssp.i_train_en.eq(1),
+                u_ssp.i_train_load_pc.eq(lsqe.pc),
+                u_ssp.i_train_store_pc.eq(violation_pc)
+            ]
+      for violated, lsqe, _ in violations:
+        with m.If(violated):
+          m.d.sync += lsqe.status.eq(LSQStatus.ALLOCATED)
+
+    # Early wakeup for the head entry of the next cycle if it is a load with a known address (it accesses the cache
+    # then and is assumed to hit). A load at the head that missed in this cycle is not woken up again.
+    lsq_next = lsq[(rp + advance)[0:bits]]
+    missed = ~empty & (lsq_rp.status == LSQStatus.ALLOCATED) & (lsq_rp.type == LSQType.LOAD) & lsq_rp.addr_valid
+    missed &= ~advance
+    addr_next = lsq_next.addr_valid | Cat(b.valid & (b.robIdx == lsq_next.addr_robidx) for b in self.i_broadcast).any()
+    m.d.comb += [
+        self.o_wakeup.valid.eq(((wp - rp)[0:bits + 1] > advance) & (lsq_next.status == LSQStatus.ALLOCATED)
+                               & (lsq_next.type == LSQType.LOAD) & addr_next & ~missed),
+        self.o_wakeup.robIdx.eq(lsq_next.robidx)
+    ]
 
     with m.If(self.i_commit_en):
       lsq_p = lsq[self.i_commit_idx]
       m.d.sync += lsq_p.status.eq(LSQStatus.COMMITTED)
 
-    with m.If(self.i_flush_en):
+    # Squash (highest priority). Entries are allocated in program order so the younger ones of a thread always follow
+    # its kept ones and wp simply moves back to the entry after the last kept one (with several threads squashed
+    # entries before it are left as holes that the head skips). Committed stores are never squashed (their ROB-idx may
+    # already have been reused). The head entry may leave in the same cycle, if it is kept it is counted in keep and
+    # otherwise (a younger load or fence broadcasting on another bus, or a hole) it is still left behind. If another
+    # thread issues in the same cycle wp is not moved back and all squashed entries are left as holes.
+    with m.If(Cat(self.i_squash_en).any()):
+      keep = []
       for lsqe in lsq:
-        m.d.sync += lsqe.status.eq(LSQStatus.INVALID)
-      m.d.sync += wp.eq(rp)
+        uncommitted = (lsqe.status == LSQStatus.ALLOCATED) | (lsqe.status == LSQStatus.DONE)
+        younger = uncommitted & isSquashed(lsqe.robidx, self.i_squash_en, self.i_squash_robidx, self.i_head_robidx)
+        keep.append((uncommitted | (lsqe.status == LSQStatus.COMMITTED)) & ~younger)
+        with m.If(younger):
+          m.d.sync += lsqe.status.eq(LSQStatus.INVALID)
+      kept = Const(0, bits + 1)
+      for idx in range(len(lsq)):
+        kept = Mux(Array(keep)[(rp + idx)[0:bits]], idx + 1, kept)
+      with m.If(~issue1 & ~issue2):
+        m.d.sync += wp.eq(rp + Mux(advance & (kept == 0), 1, kept))
 
     for idx in range(len(lsq)):
       addDebugSignals(m, lsq[idx], name='lsq{}'.format(idx))
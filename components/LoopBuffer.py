@@ -0,0 +1,69 @@
+# Copyright 2022 Markus Lavin (https://www.zzzconsulting.se/).
+#
+# This source describes Open Hardware and is licensed under the CERN-OHL-P v2.
+#
+# You may redistribute and modify this documentation and make products using it
+# under the terms of the CERN-OHL-P v2 (https:/cern.ch/cern-ohl).  This
+# documentation is distributed WITHOUT ANY EXPRESS OR IMPLIED WARRANTY,
+# INCLUDING OF MERCHANTABILITY, SATISFACTORY QUALITY AND FITNESS FOR A
+# PARTICULAR PURPOSE. Please see the CERN-OHL-P v2 for applicable conditions.
+
+from amaranth import *
+
+
+class LoopBuffer(Elaboratable):
+  # Holds the body of the most recent short backward taken branch (from its target up to and including the branch).
+  # The body is captured word by word as it is fetched from the I-cache. Once captured, fetch reads it from here
+  # instead of the I-cache so a loop keeps streaming while the I-cache (or the bus) is busy.
+
+  def __init__(self, depth=8):
+    assert depth & (depth - 1) == 0
+    self.depth = depth
+    # Lookup (fetch) of the word holding i_pc. Second port looks up the word after it.
+    self.i_pc = Signal(32)
+    self.o_hit = Signal()
+    self.o_data = Signal(32)
+    self.o_hit2 = Signal()
+    self.o_data2 = Signal(32)
+    # Capture the words read from the I-cache at i_pc (and the word after it).
+    self.i_capture_data = Signal(32)
+    self.i_capture_en = Signal()
+    self.i_capture2_data = Signal(32)
+    self.i_capture2_en = Signal()
+    # Detect (a backward taken branch at i_loop_pc to i_loop_target was fetched).
+    self.i_loop_pc = Signal(32)
+    self.i_loop_target = Signal(32)
+    self.i_loop_en = Signal()
+
+  def elaborate(self, platform):
+    m = Module()
+
+    bits = (self.depth - 1).bit_length()
+    buf = Array([Signal(32, name='lb{}'.format(idx)) for idx in range(self.depth)])
+    valid = Signal(self.depth)
+    start = Signal(32)
+    last = Signal(range(self.depth))  # Word offset of the branch.
+
+    def lookup(pc, hit, data):
+      offset = (pc - start)[2:32]
+      inside = offset <= last
+      m.d.comb += [hit.eq(inside & valid.bit_select(offset[0:bits], 1)), data.eq(buf[offset[0:bits]])]
+      return offset[0:bits], inside
+
+    idx, inside = lookup(self.i_pc, self.o_hit, self.o_data)
+    idx2, inside2 = lookup(self.i_pc + 4, self.o_hit2, self.o_data2)
+
+    # Capture (words outside of the loop body are ignored).
+    with m.If(self.i_capture_en & inside):
+      m.d.sync += [buf[idx].eq(self.i_capture_data), valid.bit_select(idx, 1).eq(1)]
+    with m.If(self.i_capture2_en & inside2):
+      m.d.sync += [buf[idx2].eq(self.i_capture2_data), valid.bit_select(idx2, 1).eq(1)]
+
+    # Detect a new loop (highest priority). The body is kept as whole words, the last one being the word holding the
+    # end of the branch (which may straddle a word boundary if it is not compressed).
+    target = Cat(Const(0, 2), self.i_loop_target[2:32])
+    body = (self.i_loop_pc + 2 - target)[2:32]
+    with m.If(self.i_loop_en & (body < self.depth) & ((target != start) | (body != last))):
+      m.d.sync += [start.eq(target), last.eq(body), valid.eq(0)]
+
+    return m
@@ -0,0 +1,91 @@
+# Copyright 2022 Markus Lavin (https://www.zzzconsulting.se/).
+#
+# This source describes Open Hardware and is licensed under the CERN-OHL-P v2.
+#
+# You may redistribute and modify this documentation and make products using it
+# under the terms of the CERN-OHL-P v2 (https:/cern.ch/cern-ohl).  This
+# documentation is distributed WITHOUT ANY EXPRESS OR IMPLIED WARRANTY,
+# INCLUDING OF MERCHANTABILITY, SATISFACTORY QUALITY AND FITNESS FOR A
+# PARTICULAR PURPOSE. Please see the CERN-OHL-P v2 for applicable conditions.
+
+from amaranth import *
+
+from components.MicroOperation import *
+from components.Decoder import *
+from components.InstructionQueue import *
+
+
+class MacroOpFusion(Elaboratable):
+  # Combines two adjacent IQ entries into a single one when the second one only refines the result of the first (which
+  # it overwrites). The fused entry is issued instead of the pair and so takes a single ROB entry, RS entry and EU slot.
+  #
+  #   LUI rd, hi; ADDI rd, rd, lo       -> LUI rd, hi + lo
+  #   AUIPC rd, hi; ADDI rd, rd, lo     -> AUIPC rd, hi + lo
+  #   AUIPC rd, hi; JALR rd, lo(rd)     -> JALR rd, pc + hi + lo (no register dependency)
+  #   SLLI rd, rs, n; SRLI rd, rd, n    -> ANDI rd, rs, 0xffffffff >> n
+  #
+  # The entries are matched on the decoded records, so JAL (which computes its link register the same way as AUIPC)
+  # also takes part in the AUIPC pairs. That is fine as the fused values only depend on the pair being executed in
+  # order, not on where the second instruction is located.
+
+  def __init__(self, luiAddi=True, auipcAddi=True, auipcJalr=True, slliSrli=True):
+    self.luiAddi = luiAddi
+    self.auipcAddi = auipcAddi
+    self.auipcJalr = auipcJalr
+    self.slliSrli = slliSrli
+    # Ports
+    self.i_entry = Signal(InstructionQueueEntryLayout)
+    self.i_entry2 = Signal(InstructionQueueEntryLayout)
+    self.o_fuse = Signal()  # Issue o_entry in place of both i_entry and i_entry2.
+    self.o_entry = Signal(InstructionQueueEntryLayout)
+
+  def elaborate(self, platform):
+    m = Module()
+
+    a = self.i_entry.uop
+    b = self.i_entry2.uop
+    out = self.o_entry.uop
+
+    # The second instruction reads the result of the first and overwrites it.
+    chained = a.valid & b.valid & (a.unit == IssueUnit.RS) & (b.unit == IssueUnit.RS) & (a.rd != 0) & (
+        b.rs1 == a.rd) & (b.rd == a.rd)
+    lui = (a.opcode == uOPOpcode.LUI) & a.op1Imm
+    auipc = (a.opcode == uOPOpcode.ADD) & a.op1Imm & a.op2Pc
+    slli = (a.opcode == uOPOpcode.SLL) & a.op2Imm
+    addi = (b.opcode == uOPOpcode.ADD) & b.op2Imm & ~b.op1Imm & ~b.op2Pc & ~b.jalr
+    jalr = b.jalr
+    srli = (b.opcode == uOPOpcode.SRL) & b.op2Imm & (b.imm[0:5] == a.imm[0:5])
+
+    m.d.comb += self.o_entry.eq(self.i_entry)
+    with m.If(chained):
+      if self.luiAddi or self.auipcAddi:
+        with m.If((lui if self.luiAddi else 0) | (auipc if self.auipcAddi else 0)):
+          with m.If(addi):
+            m.d.comb += [
+                self.o_fuse.eq(1),
+                out.imm.eq(a.imm + b.imm),
+                out.rvc.eq(0),
+                out.rasPush.eq(0),
+                out.rasPop.eq(0)
+            ]
+      if self.auipcJalr:
+        # The target is relative to the PC of the JALR (the entry that is issued).
+        with m.If(auipc & jalr):
+          m.d.comb += [
+              self.o_fuse.eq(1),
+              self.o_entry.eq(self.i_entry2),
+              out.rs1.eq(0),
+              out.op1Imm.eq(1),
+              out.op2Imm.eq(0),
+              out.op2Pc.eq(1),
+              out.imm.eq(a.imm + b.imm + self.i_entry.pc - self.i_entry2.pc)
+          ]
+      if self.slliSrli:
+        with m.If(slli & srli):
+          m.d.comb += [
+              self.o_fuse.eq(1),
+              out.opcode.eq(uOPOpcode.AND),
+              out.imm.eq(Const(0xffffffff, 32) >> a.imm[0:5])
+          ]
+
+    return m
@@ -13,6 +13,8 @@ from amaranth.lib import data
 
 from enum import Enum, unique, auto
 
+from components.CoreConfig import *
+
 # uOPs - meaning operations for the micro-architecture
 
 
@@ -58,13 +60,64 @@ class uOPOpcode(Enum):
   FENCE = auto()
   ECALL = auto()
   EBREAK = auto()
+  # M extension.
+  MUL = auto()
+  MULH = auto()
+  MULHSU = auto()
+  MULHU = auto()
+  DIV = auto()
+  DIVU = auto()
+  REM = auto()
+  REMU = auto()
+
+
+# Kinds of execution units, every uOP executes on a unit of one class.
+@unique
+class uOPClass(Enum):
+  ALU = auto()
+  BRANCH = auto()  # Conditional branches (and EBREAK).
+  MUL = auto()  # Multiplications (see Multiplier).
+  DIV = auto()  # Divisions and remainders (see Divider).
+
+
+def uOPClassOf(opcode):
+  if opcode in [
+      uOPOpcode.BEQ, uOPOpcode.BNE, uOPOpcode.BLT, uOPOpcode.BGE, uOPOpcode.BLTU, uOPOpcode.BGEU, uOPOpcode.EBREAK
+  ]:
+    return uOPClass.BRANCH
+  if opcode in [uOPOpcode.MUL, uOPOpcode.MULH, uOPOpcode.MULHSU, uOPOpcode.MULHU]:
+    return uOPClass.MUL
+  if opcode in [uOPOpcode.DIV, uOPOpcode.DIVU, uOPOpcode.REM, uOPOpcode.REMU]:
+    return uOPClass.DIV
+  return uOPClass.ALU
+
+
+def isClass(opcode, classes):
+  # True if the opcode signal is a uOP that executes on a unit of any of the classes.
+  return Cat(opcode == op for op in uOPOpcode if uOPClassOf(op) in classes).any()
+
+
+# Execution latency (cycles from dispatch to broadcast) is one cycle for every uOP unless given otherwise in a dict
+# (uOPOpcode -> cycles).
+def maxLatency(latencies):
+  return max([1] + list(latencies.values()))
+
+
+def latencyOf(opcode, latencies):
+  # The latency of the opcode signal.
+  latency = Const(1, range(maxLatency(latencies) + 1))
+  for op, cycles in latencies.items():
+    latency = Mux(opcode == op, cycles, latency)
+  return latency
 
 
-MicroOperationTypeLayout = data.StructLayout({
-    "robidx": unsigned(3),
-    "imm": unsigned(12),
-    "op2": unsigned(32),
-    "op1": unsigned(32),
-    "opcode": uOPOpcode,
-    "valid": unsigned(1)
-})
+def MicroOperationTypeLayout(config):
+  return data.StructLayout({
+      "robidx": unsigned(config.robIdxBits),
+      "imm": unsigned(12),
+      "rvc": unsigned(1),
+      "op2": unsigned(32),
+      "op1": unsigned(32),
+      "opcode": uOPOpcode,
+      "valid": unsigned(1)
+  })
@@ -0,0 +1,86 @@
+# Copyright 2022 Markus Lavin (https://www.zzzconsulting.se/).
+#
+# This source describes Open Hardware and is licensed under the CERN-OHL-P v2.
+#
+# You may redistribute and modify this documentation and make products using it
+# under the terms of the CERN-OHL-P v2 (https:/cern.ch/cern-ohl).  This
+# documentation is distributed WITHOUT ANY EXPRESS OR IMPLIED WARRANTY,
+# INCLUDING OF MERCHANTABILITY, SATISFACTORY QUALITY AND FITNESS FOR A
+# PARTICULAR PURPOSE. Please see the CERN-OHL-P v2 for applicable conditions.
+
+from amaranth import *
+
+from components.BroadCast import *
+from components.Utils import *
+from components.MicroOperation import *
+
+
+# Pipelined multiplier for the MUL uOP class (same ports as ExecutionUnit). A uOP can be dispatched every cycle and is
+# broadcast three cycles later. The first stage holds the operands, the second the products of the first operand with
+# the lower and upper half of the second one and the last one their sum.
+class Multiplier(Elaboratable):
+
+  def __init__(self, latencies={}, threads=1, config=CoreConfig()):
+    self.config = config
+    self.o_dispatch_rdy = Signal(maxLatency(latencies) + 1)  # Any uOP can be dispatched if set (see ExecutionUnit).
+    self.i_dispatch_en = Signal()
+    self.i_dispatch_uop = Signal(MicroOperationTypeLayout(config))
+    self.o_broadcast = Signal(BroadcastBusTypeLayout(config))
+    self.o_wakeup = Signal(WakeupTypeLayout(config))  # The uOP broadcast in the next cycle (unless halted).
+    # Squash (per thread, all uops of the thread younger than i_squash_robidx).
+    self.i_squash_en = [Signal(name='i_squash{}_en'.format(t)) for t in range(threads)]
+    self.i_squash_robidx = [Signal(config.robIdxBits, name='i_squash{}_robidx'.format(t)) for t in range(threads)]
+    self.i_head_robidx = [Signal(config.robIdxBits, name='i_head{}_robidx'.format(t)) for t in range(threads)]
+    self.i_halt_en = Signal()
+
+  def elaborate(self, platform):
+    m = Module()
+
+    pipe = [Signal(MicroOperationTypeLayout(self.config), name='pipe{}'.format(idx)) for idx in range(3)]
+    out = pipe[2]
+    pp_lo = Signal(signed(50))
+    pp_hi = Signal(signed(50))
+    product = Signal(signed(67))
+
+    # Operands are extended to 33 bits so that signed and unsigned multiplications are the same.
+    op1 = Cat(pipe[0].op1, pipe[0].op1[31] & ((pipe[0].opcode == uOPOpcode.MULH) |
+                                              (pipe[0].opcode == uOPOpcode.MULHSU))).as_signed()
+    op2 = Cat(pipe[0].op2, pipe[0].op2[31] & (pipe[0].opcode == uOPOpcode.MULH)).as_signed()
+
+    m.d.comb += self.o_dispatch_rdy.eq(Mux(self.i_halt_en, 0, (1 << len(self.o_dispatch_rdy)) - 1))
+    with m.If(~self.i_halt_en):
+      m.d.sync += [
+          pipe[0].eq(Mux(self.i_dispatch_en, self.i_dispatch_uop, 0)),
+          pipe[1].eq(pipe[0]),
+          pipe[2].eq(pipe[1]),
+          pp_lo.eq(op1 * op2[0:16]),
+          pp_hi.eq(op1 * op2[16:33].as_signed()),
+          product.eq(pp_lo + (pp_hi << 16))
+      ]
+
+    m.d.comb += [self.o_wakeup.valid.eq(pipe[1].valid), self.o_wakeup.robIdx.eq(pipe[1].robidx)]
+    with m.If(self.i_halt_en):
+      m.d.comb += [self.o_wakeup.valid.eq(out.valid), self.o_wakeup.robIdx.eq(out.robidx)]
+
+    m.d.comb += [
+        self.o_broadcast.valid.eq(out.valid),
+        self.o_broadcast.robIdx.eq(out.robidx),
+        self.o_broadcast.data.eq(Mux(out.opcode == uOPOpcode.MUL, product[0:32], product[32:64]))
+    ]
+
+    # Squash (highest priority).
+    def younger(uop):
+      return isSquashed(uop.robidx, self.i_squash_en, self.i_squash_robidx, self.i_head_robidx)
+
+    with m.If(Cat(self.i_squash_en).any()):
+      with m.If(~self.i_halt_en):
+        m.d.sync += pipe[0].valid.eq(self.i_dispatch_en & self.i_dispatch_uop.valid & ~younger(self.i_dispatch_uop))
+        for idx in range(1, len(pipe)):
+          m.d.sync += pipe[idx].valid.eq(pipe[idx - 1].valid & ~younger(pipe[idx - 1]))
+      with m.Else():
+        for idx in range(len(pipe)):
+          m.d.sync += pipe[idx].valid.eq(pipe[idx].valid & ~younger(pipe[idx]))
+
+    addDebugSignals(m, out)
+
+    return m
@@ -0,0 +1,146 @@
+# Copyright 2022 Markus Lavin (https://www.zzzconsulting.se/).
+#
+# This source describes Open Hardware and is licensed under the CERN-OHL-P v2.
+#
+# You may redistribute and modify this documentation and make products using it
+# under the terms of the CERN-OHL-P v2 (https:/cern.ch/cern-ohl).  This
+# documentation is distributed WITHOUT ANY EXPRESS OR IMPLIED WARRANTY,
+# INCLUDING OF MERCHANTABILITY, SATISFACTORY QUALITY AND FITNESS FOR A
+# PARTICULAR PURPOSE. Please see the CERN-OHL-P v2 for applicable conditions.
+
+from amaranth import *
+
+
+# Unified physical register file. Every renamed destination register is allocated a physical register from the free
+# list and its value is written once (at rename if already known, otherwise from a broadcast bus). The physical
+# register previously committed to the same architectural register is returned to the free list on commit.
+class PhysicalRegisterFile(Elaboratable):
+
+  def __init__(self, registers=40, checkpoints=4, writePorts=1, readPorts=0):
+    assert 34 <= registers <= 64  # Physical register indexes are 6 bits.
+    assert (registers - 32) & (registers - 33) == 0  # The free list holds a power of two registers.
+    assert checkpoints > 0  # Allocations are only undone by restoring a checkpoint.
+    self.registers = registers
+    self.checkpoints = checkpoints
+    # Read (at rename, ready if the register has been written since it was allocated).
+    self.i_rd1_idx = Signal(6)
+    self.o_rd1_data = Signal(32)
+    self.o_rd1_ready = Signal()
+    self.i_rd2_idx = Signal(6)
+    self.o_rd2_data = Signal(32)
+    self.o_rd2_ready = Signal()
+    # Operands of the second instruction in an issue group.
+    self.i_rd3_idx = Signal(6)
+    self.o_rd3_data = Signal(32)
+    self.o_rd3_ready = Signal()
+    self.i_rd4_idx = Signal(6)
+    self.o_rd4_data = Signal(32)
+    self.o_rd4_ready = Signal()
+    # Read (operands at dispatch).
+    self.i_read_idx = [Signal(6, name='i_read{}_idx'.format(idx)) for idx in range(readPorts)]
+    self.o_read_data = [Signal(32, name='o_read{}_data'.format(idx)) for idx in range(readPorts)]
+    # Write (the register becomes ready).
+    self.i_wr_en = [Signal(name='i_wr{}_en'.format(idx)) for idx in range(writePorts)]
+    self.i_wr_idx = [Signal(6, name='i_wr{}_idx'.format(idx)) for idx in range(writePorts)]
+    self.i_wr_data = [Signal(32, name='i_wr{}_data'.format(idx)) for idx in range(writePorts)]
+    # Allocate (the register is not ready until written).
+    self.o_alloc_rdy = Signal()
+    self.o_alloc_idx = Signal(6)
+    self.i_alloc_en = Signal()
+    # Second allocate (may be used with or without the first, o_alloc2_rdy if there are free registers for both).
+    self.o_alloc2_rdy = Signal()
+    self.o_alloc2_idx = Signal(6)
+    self.i_alloc2_en = Signal()
+    # Commit (i_commit_preg now holds x<i_commit_rd>, the register that held it before is freed).
+    self.i_commit_en = Signal()
+    self.i_commit_rd = Signal(5)
+    self.i_commit_preg = Signal(6)
+    # Second commit (the instruction following the first one).
+    self.i_commit2_en = Signal()
+    self.i_commit2_rd = Signal(5)
+    self.i_commit2_preg = Signal(6)
+    # Checkpoint (the free list state, taken together with RAT checkpoint i_checkpoint_idx).
+    self.i_checkpoint_en = Signal()
+    self.i_checkpoint_idx = Signal(range(checkpoints))
+    # Restore (from checkpoint i_restore_idx, registers allocated since are freed).
+    self.i_restore_en = Signal()
+    self.i_restore_idx = Signal(range(checkpoints))
+    # Flush (when nothing is in flight, every register that is not committed is freed).
+    self.i_flush_en = Signal()
+    # The committed mapping (x<idx> is held by physical register o_committed[idx]).
+    self.o_committed = [Signal(6, name='o_committed{}'.format(idx)) for idx in range(32)]
+
+  def elaborate(self, platform):
+    m = Module()
+
+    self.regs = regs = Array([Signal(32, name='p{}'.format(idx)) for idx in range(self.registers)])
+    ready = Array([Signal(reset=1, name='p{}_ready'.format(idx)) for idx in range(self.registers)])
+    # The committed mapping (x<idx> is held by physical register committed[idx], initially p<idx>).
+    self.committed = committed = Array([Signal(6, reset=idx, name='committed{}'.format(idx)) for idx in range(32)])
+
+    for rd_idx, rd_data, rd_ready in [(self.i_rd1_idx, self.o_rd1_data, self.o_rd1_ready),
+                                      (self.i_rd2_idx, self.o_rd2_data, self.o_rd2_ready),
+                                      (self.i_rd3_idx, self.o_rd3_data, self.o_rd3_ready),
+                                      (self.i_rd4_idx, self.o_rd4_data, self.o_rd4_ready)]:
+      m.d.comb += [rd_data.eq(regs[rd_idx]), rd_ready.eq(ready[rd_idx])]
+    m.d.comb += [o_committed.eq(committed[idx]) for idx, o_committed in enumerate(self.o_committed)]
+    for read_idx, read_data in zip(self.i_read_idx, self.o_read_data):
+      m.d.comb += read_data.eq(regs[read_idx])
+
+    # Free list (the registers not holding a committed or in-flight value).
+    size = self.registers - 32
+    bits = size.bit_length() - 1
+    free = Array([Signal(6, reset=32 + idx, name='free{}'.format(idx)) for idx in range(size)])
+    rp = Signal(bits + 1)
+    wp = Signal(bits + 1, reset=size)
+    count = Signal(bits + 1)
+
+    # Allocate.
+    rp2 = Signal(bits + 1)
+    m.d.comb += [count.eq(wp - rp), rp2.eq(rp + self.i_alloc_en)]
+    m.d.comb += [
+        self.o_alloc_rdy.eq(count != 0),
+        self.o_alloc_idx.eq(free[rp[0:bits]]),
+        self.o_alloc2_rdy.eq(count >= 2),
+        self.o_alloc2_idx.eq(free[rp2[0:bits]])
+    ]
+    alloc1 = self.o_alloc_rdy & self.i_alloc_en
+    alloc2 = Mux(self.i_alloc_en, self.o_alloc2_rdy, self.o_alloc_rdy) & self.i_alloc2_en
+    with m.If(alloc1):
+      m.d.sync += ready[self.o_alloc_idx].eq(0)
+    with m.If(alloc2):
+      m.d.sync += ready[self.o_alloc2_idx].eq(0)
+    rp_next = Signal(bits + 1)
+    m.d.comb += rp_next.eq(rp + alloc1 + alloc2)
+    m.d.sync += rp.eq(rp_next)
+
+    # Write (a register allocated and written in the same cycle is ready).
+    for wr_en, wr_idx, wr_data in zip(self.i_wr_en, self.i_wr_idx, self.i_wr_data):
+      with m.If(wr_en & (wr_idx != 0)):
+        m.d.sync += [regs[wr_idx].eq(wr_data), ready[wr_idx].eq(1)]
+
+    # Commit. If both commits are to the same architectural register the first one's register is freed right away.
+    old = committed[self.i_commit_rd]
+    old2 = Mux(self.i_commit_en & (self.i_commit_rd == self.i_commit2_rd), self.i_commit_preg,
+               committed[self.i_commit2_rd])
+    with m.If(self.i_commit_en):
+      m.d.sync += [committed[self.i_commit_rd].eq(self.i_commit_preg), free[wp[0:bits]].eq(old)]
+    wp2 = (wp + self.i_commit_en)[0:bits]
+    with m.If(self.i_commit2_en):
+      m.d.sync += [committed[self.i_commit2_rd].eq(self.i_commit2_preg), free[wp2].eq(old2)]
+    m.d.sync += wp.eq(wp + self.i_commit_en + self.i_commit2_en)
+
+    # Checkpoint (including the allocations of the same cycle).
+    ckpt = Array([Signal(bits + 1, name='ckpt{}'.format(c)) for c in range(self.checkpoints)])
+    with m.If(self.i_checkpoint_en):
+      m.d.sync += ckpt[self.i_checkpoint_idx].eq(rp_next)
+
+    # Restore (highest priority). Registers are allocated in program order so the ones allocated after the checkpoint
+    # are still in the free list right behind its read pointer (commits can not have wrapped around to them).
+    with m.If(self.i_restore_en):
+      m.d.sync += rp.eq(ckpt[self.i_restore_idx])
+    # With nothing in flight the free list holds every register that is not committed.
+    with m.If(self.i_flush_en):
+      m.d.sync += rp.eq(wp - size)
+
+    return m
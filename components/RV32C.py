@@ -0,0 +1,159 @@
+# Copyright 2022 Markus Lavin (https://www.zzzconsulting.se/).
+#
+# This source describes Open Hardware and is licensed under the CERN-OHL-P v2.
+#
+# You may redistribute and modify this documentation and make products using it
+# under the terms of the CERN-OHL-P v2 (https:/cern.ch/cern-ohl).  This
+# documentation is distributed WITHOUT ANY EXPRESS OR IMPLIED WARRANTY,
+# INCLUDING OF MERCHANTABILITY, SATISFACTORY QUALITY AND FITNESS FOR A
+# PARTICULAR PURPOSE. Please see the CERN-OHL-P v2 for applicable conditions.
+
+from amaranth import *
+
+from components.RV32I import *
+
+
+def isCompressed(instr):
+  # Instructions with the two lowest bits other than 0b11 are 16 bits long.
+  return instr[0:2] != 0b11
+
+
+# Encoders for the base instruction formats (immediates are the full width value, bit 0 included where relevant).
+def rType(opcode, rd, funct3, rs1, rs2, funct7):
+  return Cat(Const(opcode, 7), rd, Const(funct3, 3), rs1, rs2, Const(funct7, 7))
+
+
+def iType(opcode, rd, funct3, rs1, imm):
+  return Cat(Const(opcode, 7), rd, Const(funct3, 3), rs1, imm[0:12])
+
+
+def sType(opcode, funct3, rs1, rs2, imm):
+  return Cat(Const(opcode, 7), imm[0:5], Const(funct3, 3), rs1, rs2, imm[5:12])
+
+
+def bType(opcode, funct3, rs1, rs2, imm):
+  return Cat(Const(opcode, 7), imm[11], imm[1:5], Const(funct3, 3), rs1, rs2, imm[5:11], imm[12])
+
+
+def uType(opcode, rd, imm):
+  return Cat(Const(opcode, 7), rd, imm[12:32])
+
+
+def jType(opcode, rd, imm):
+  return Cat(Const(opcode, 7), rd, imm[12:20], imm[11], imm[1:11], imm[20])
+
+
+class CompressedExpander(Elaboratable):
+  # Expands a 16-bit RV32C instruction into the equivalent 32-bit RV32I one. Reserved and unsupported encodings
+  # (floating point loads/stores) expand to zero, which is not a valid instruction either.
+
+  def __init__(self):
+    self.i_instr = Signal(16)
+    self.o_instr = Signal(32)
+
+  def elaborate(self, platform):
+    m = Module()
+
+    c = self.i_instr
+    rd = c[7:12]  # Also rs1 for most formats.
+    rs2 = c[2:7]
+    rd_ = Cat(c[2:5], Const(0b01, 2))  # rd'/rs2' in CIW, CL, CS and CA formats.
+    rs1_ = Cat(c[7:10], Const(0b01, 2))  # rs1'/rd' in CL, CS, CA and CB formats.
+    x0 = Const(0, 5)
+    x1 = Const(1, 5)
+    x2 = Const(2, 5)
+
+    imm6 = Signal(32)  # CI format immediate (sign-extended).
+    m.d.comb += imm6.eq(Cat(c[2:7], c[12]).as_signed())
+    shamt = Cat(c[2:7], Const(0, 7))
+    jimm = Signal(32)
+    m.d.comb += jimm.eq(Cat(Const(0, 1), c[3:6], c[11], c[2], c[7], c[6], c[9:11], c[8], c[12]).as_signed())
+    bimm = Signal(32)
+    m.d.comb += bimm.eq(Cat(Const(0, 1), c[3:5], c[10:12], c[2], c[5:7], c[12]).as_signed())
+    lwimm = Cat(Const(0, 2), c[6], c[10:13], c[5], Const(0, 5))
+    lwspimm = Cat(Const(0, 2), c[4:7], c[12], c[2:4], Const(0, 4))
+    swspimm = Cat(Const(0, 2), c[9:13], c[7:9], Const(0, 4))
+    addi4spnimm = Cat(Const(0, 2), c[6], c[5], c[11:13], c[7:11], Const(0, 2))
+    addi16spimm = Signal(32)
+    m.d.comb += addi16spimm.eq(Cat(Const(0, 4), c[6], c[2], c[5], c[3:5], c[12]).as_signed())
+    luiimm = Signal(32)
+    m.d.comb += luiimm.eq(Cat(Const(0, 12), c[2:7], c[12]).as_signed())
+
+    out = self.o_instr
+    m.d.comb += out.eq(0)
+    with m.Switch(Cat(c[0:2], c[13:16])):
+      # Quadrant 0.
+      with m.Case(0b000_00):  # C.ADDI4SPN
+        with m.If(c[5:13] != 0):
+          m.d.comb += out.eq(iType(RV32I_OP_IMM, rd_, 0b000, x2, addi4spnimm))
+      with m.Case(0b010_00):  # C.LW
+        m.d.comb += out.eq(iType(RV32I_OP_LOAD, rd_, 0b010, rs1_, lwimm))
+      with m.Case(0b110_00):  # C.SW
+        m.d.comb += out.eq(sType(RV32I_OP_STORE, 0b010, rs1_, rd_, lwimm))
+
+      # Quadrant 1.
+      with m.Case(0b000_01):  # C.ADDI (C.NOP)
+        m.d.comb += out.eq(iType(RV32I_OP_IMM, rd, 0b000, rd, imm6))
+      with m.Case(0b001_01):  # C.JAL
+        m.d.comb += out.eq(jType(RV32I_OP_JAL, x1, jimm))
+      with m.Case(0b010_01):  # C.LI
+        m.d.comb += out.eq(iType(RV32I_OP_IMM, rd, 0b000, x0, imm6))
+      with m.Case(0b011_01):
+        with m.If(rd == 2):  # C.ADDI16SP
+          with m.If(addi16spimm != 0):
+            m.d.comb += out.eq(iType(RV32I_OP_IMM, x2, 0b000, x2, addi16spimm))
+        with m.Elif(luiimm != 0):  # C.LUI
+          m.d.comb += out.eq(uType(RV32I_OP_LUI, rd, luiimm))
+      with m.Case(0b100_01):
+        with m.Switch(c[10:12]):
+          with m.Case(0b00):  # C.SRLI
+            with m.If(~c[12]):
+              m.d.comb += out.eq(iType(RV32I_OP_IMM, rs1_, 0b101, rs1_, shamt))
+          with m.Case(0b01):  # C.SRAI
+            with m.If(~c[12]):
+              m.d.comb += out.eq(iType(RV32I_OP_IMM, rs1_, 0b101, rs1_, shamt | 0b0100000_00000))
+          with m.Case(0b10):  # C.ANDI
+            m.d.comb += out.eq(iType(RV32I_OP_IMM, rs1_, 0b111, rs1_, imm6))
+          with m.Case(0b11):
+            with m.If(~c[12]):
+              with m.Switch(c[5:7]):
+                with m.Case(0b00):  # C.SUB
+                  m.d.comb += out.eq(rType(RV32I_OP_OP, rs1_, 0b000, rs1_, rd_, 0b0100000))
+                with m.Case(0b01):  # C.XOR
+                  m.d.comb += out.eq(rType(RV32I_OP_OP, rs1_, 0b100, rs1_, rd_, 0b0000000))
+                with m.Case(0b10):  # C.OR
+                  m.d.comb += out.eq(rType(RV32I_OP_OP, rs1_, 0b110, rs1_, rd_, 0b0000000))
+                with m.Case(0b11):  # C.AND
+                  m.d.comb += out.eq(rType(RV32I_OP_OP, rs1_, 0b111, rs1_, rd_, 0b0000000))
+      with m.Case(0b101_01):  # C.J
+        m.d.comb += out.eq(jType(RV32I_OP_JAL, x0, jimm))
+      with m.Case(0b110_01):  # C.BEQZ
+        m.d.comb += out.eq(bType(RV32I_OP_BRANCH, 0b000, rs1_, x0, bimm))
+      with m.Case(0b111_01):  # C.BNEZ
+        m.d.comb += out.eq(bType(RV32I_OP_BRANCH, 0b001, rs1_, x0, bimm))
+
+      # Quadrant 2.
+      with m.Case(0b000_10):  # C.SLLI
+        with m.If(~c[12]):
+          m.d.comb += out.eq(iType(RV32I_OP_IMM, rd, 0b001, rd, shamt))
+      with m.Case(0b010_10):  # C.LWSP
+        with m.If(rd != 0):
+          m.d.comb += out.eq(iType(RV32I_OP_LOAD, rd, 0b010, x2, lwspimm))
+      with m.Case(0b100_10):
+        with m.If(~c[12]):
+          with m.If(rs2 == 0):  # C.JR
+            with m.If(rd != 0):
+              m.d.comb += out.eq(iType(RV32I_OP_JALR, x0, 0b000, rd, Const(0, 12)))
+          with m.Else():  # C.MV
+            m.d.comb += out.eq(rType(RV32I_OP_OP, rd, 0b000, x0, rs2, 0b0000000))
+        with m.Else():
+          with m.If((rd == 0) & (rs2 == 0)):  # C.EBREAK
+            m.d.comb += out.eq(iType(RV32I_OP_SYSTEM, x0, 0b000, x0, Const(1, 12)))
+          with m.Elif(rs2 == 0):  # C.JALR
+            m.d.comb += out.eq(iType(RV32I_OP_JALR, x1, 0b000, rd, Const(0, 12)))
+          with m.Else():  # C.ADD
+            m.d.comb += out.eq(rType(RV32I_OP_OP, rd, 0b000, rd, rs2, 0b0000000))
+      with m.Case(0b110_10):  # C.SWSP
+        m.d.comb += out.eq(sType(RV32I_OP_STORE, 0b010, x2, rs2, swspimm))
+
+    return m
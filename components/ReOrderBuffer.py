@@ -14,7 +14,9 @@ from amaranth.lib import data
 from enum import Enum, unique, auto
 
 from components.BroadCast import *
+from components.BranchPredictor import *
 from components.Utils import *
+from components.CoreConfig import *
 
 
 @unique
@@ -27,86 +29,161 @@ class ROBType(Enum):
   BRANCH2 = auto()
 
 
-ReOrderBufferEntryLayout = data.StructLayout({
-    "done": unsigned(1),  # The ROB-entry is done and ready to be committed.
-    "type": ROBType,
-    "lsqidx": unsigned(2),  # For STORE this is index into LSQ.
-    "rd": unsigned(5),  # The destination register idx to commit to.
-    "rdValue": unsigned(32),  # The contents to write to rd.
-    "pc": unsigned(32)  # PC of the corresponding instruction.
-})
+def ReOrderBufferEntryLayout(config):
+  return data.StructLayout({
+      "done": unsigned(1),  # The ROB-entry is done and ready to be committed.
+      "type": ROBType,
+      "lsqidx": unsigned(config.lsqIdxBits),  # For STORE this is index into LSQ.
+      "rd": unsigned(5),  # The destination register idx to commit to.
+      "preg": unsigned(6),  # The physical register allocated to rd (with a PhysicalRegisterFile).
+      "rdValue": unsigned(32),  # The contents to write to rd (for BRANCH2 the link register, known at allocation).
+      "target": unsigned(32),  # For BRANCH2 the broadcast jump target.
+      "rasPush": unsigned(1),  # For JAL and BRANCH2 pc+4 was pushed to the return address stack.
+      "rasPop": unsigned(1),  # For BRANCH2 the return address stack was popped.
+      "ckpt": unsigned(config.robIdxBits),  # For BRANCH and BRANCH2 the RAT checkpoint taken at rename.
+      "pc": unsigned(32),  # PC of the corresponding instruction.
+      "rvc": unsigned(1),  # Compressed instruction (the next one is at pc + 2).
+      "replay": unsigned(1),  # A load that was executed too early, everything after it is squashed at commit.
+      "pred": PredictionTypeLayout  # Fetch prediction state (BRANCH and BRANCH2 compare their target with pred.npc).
+  })
 
 
 class ReOrderBuffer(Elaboratable):
 
-  def __init__(self):
-    # Broadcast.
-    self.i_broadcast = Signal(BroadcastBusTypeLayout)
-    # Allocate.
+  def __init__(self, broadcastBuses=1, results=True, threads=1, thread=0, config=CoreConfig()):
+    self.config = config
+    # Keep results in rdValue until commit. Otherwise they are kept in a physical register file and only the results
+    # of branches (needed at commit) are recorded.
+    self.results = results
+    # With several threads the ROB-idxs are partitioned between them and this ROB holds the entries of thread (the
+    # ROB-idxs whose top bits are thread, see threadOf). Broadcasts for other threads are ignored.
+    self.threads = threads
+    self.thread = thread
+    # Broadcast (the entry that each broadcast is for).
+    self.i_broadcast = [
+        Signal(BroadcastBusTypeLayout(config), name='i_broadcast{}'.format(idx)) for idx in range(broadcastBuses)
+    ]
+    self.o_broadcast_entry = [
+        Signal(ReOrderBufferEntryLayout(config), name='o_broadcast{}_entry'.format(idx))
+        for idx in range(broadcastBuses)
+    ]
+    # Allocate (done is set if the result, rdValue, is already known and no broadcast will follow).
     self.o_alloc_rdy = Signal()
-    self.o_alloc_idx = Signal(3)
-    self.i_alloc_rd = Signal(5)
-    self.i_alloc_pc = Signal(32)
-    self.i_alloc_type = Signal(ROBType)
-    self.i_alloc_lsqidx = Signal(2)
+    self.o_alloc_idx = Signal(config.robIdxBits)
+    self.i_alloc = Signal(ReOrderBufferEntryLayout(config))
     self.i_alloc_en = Signal()
+    # Second allocate (the entry following i_alloc, only together with i_alloc_en).
+    self.o_alloc2_rdy = Signal()
+    self.o_alloc2_idx = Signal(config.robIdxBits)
+    self.i_alloc2 = Signal(ReOrderBufferEntryLayout(config))
+    self.i_alloc2_en = Signal()
     # Commit.
     self.o_commit_rdy = Signal()
-    self.o_commit = Signal(ReOrderBufferEntryLayout)
-    self.o_commit_robidx = Signal(3)
+    self.o_commit = Signal(ReOrderBufferEntryLayout(config))
+    self.o_commit_robidx = Signal(config.robIdxBits)
     self.i_commit_en = Signal()
-    # Flush.
-    self.i_flush_en = Signal()
+    # Second commit (the entry following o_commit, only together with i_commit_en).
+    self.o_commit2_rdy = Signal()
+    self.o_commit2 = Signal(ReOrderBufferEntryLayout(config))
+    self.o_commit2_robidx = Signal(config.robIdxBits)
+    self.i_commit2_en = Signal()
+    self.o_empty = Signal()
+    # Squash (all entries younger than i_squash_robidx).
+    self.i_squash_en = Signal()
+    self.i_squash_robidx = Signal(config.robIdxBits)
+    # Replay (the load i_replay_robidx is not done until broadcast again, see LoadStoreQueue).
+    self.i_replay_en = Signal()
+    self.i_replay_robidx = Signal(config.robIdxBits)
     # Read rd.
-    self.i_rd1_idx = Signal(3)
+    self.i_rd1_idx = Signal(config.robIdxBits)
     self.o_rd1_data = Signal(32)
     self.o_rd1_valid = Signal()
-    self.i_rd2_idx = Signal(3)
+    self.i_rd2_idx = Signal(config.robIdxBits)
     self.o_rd2_data = Signal(32)
     self.o_rd2_valid = Signal()
+    self.i_rd3_idx = Signal(config.robIdxBits)
+    self.o_rd3_data = Signal(32)
+    self.o_rd3_valid = Signal()
+    self.i_rd4_idx = Signal(config.robIdxBits)
+    self.o_rd4_data = Signal(32)
+    self.o_rd4_valid = Signal()
 
   def elaborate(self, platform):
     m = Module()
 
-    rob = Array([Signal(ReOrderBufferEntryLayout) for _ in range(8)])
-    rp = Signal(3)
-    wp = Signal(3)
-    rp_ = Signal(4)
-    wp_ = Signal(4)
+    bits = self.config.robIdxBits - threadBits(self.threads)
+    size = 2**bits
+    rob = Array([Signal(ReOrderBufferEntryLayout(self.config)) for _ in range(size)])
+    rp = Signal(bits)
+    wp = Signal(bits)
+    rp_ = Signal(bits + 1)
+    wp_ = Signal(bits + 1)
     empty = Signal()
     full = Signal()
 
-    m.d.comb += [
-        rp.eq(rp_[0:3]),
-        wp.eq(wp_[0:3]),
-        self.o_rd1_data.eq(rob[self.i_rd1_idx].rdValue),
-        self.o_rd1_valid.eq(rob[self.i_rd1_idx].done),
-        self.o_rd2_data.eq(rob[self.i_rd2_idx].rdValue),
-        self.o_rd2_valid.eq(rob[self.i_rd2_idx].done)
-    ]
-
-    m.d.comb += empty.eq((rp_[0:3] == wp_[0:3]) & (rp_[3] == wp_[3]))
-    m.d.comb += full.eq((rp_[0:3] == wp_[0:3]) & (rp_[3] != wp_[3]))
+    def robidx(idx):
+      return Cat(idx[0:bits], Const(self.thread, self.config.robIdxBits - bits))
+
+    m.d.comb += [rp.eq(rp_[0:bits]), wp.eq(wp_[0:bits])]
+    for rd_idx, rd_data, rd_valid in [(self.i_rd1_idx, self.o_rd1_data, self.o_rd1_valid),
+                                      (self.i_rd2_idx, self.o_rd2_data, self.o_rd2_valid),
+                                      (self.i_rd3_idx, self.o_rd3_data, self.o_rd3_valid),
+                                      (self.i_rd4_idx, self.o_rd4_data, self.o_rd4_valid)]:
+      # The link register of BRANCH2 is known from allocation.
+      rd_entry = rob[rd_idx[0:bits]]
+      m.d.comb += [rd_data.eq(rd_entry.rdValue), rd_valid.eq(rd_entry.done | (rd_entry.type == ROBType.BRANCH2))]
+
+    m.d.comb += empty.eq((rp_[0:bits] == wp_[0:bits]) & (rp_[bits] == wp_[bits]))
+    m.d.comb += full.eq((rp_[0:bits] == wp_[0:bits]) & (rp_[bits] != wp_[bits]))
+    m.d.comb += self.o_empty.eq(empty)
     # Broadcast.
-    with m.If(self.i_broadcast.valid):
-      m.d.sync += [
-          rob[self.i_broadcast.robIdx].done.eq(1), rob[self.i_broadcast.robIdx].rdValue.eq(self.i_broadcast.data)
-      ]
+    for broadcast, broadcast_entry in zip(self.i_broadcast, self.o_broadcast_entry):
+      rob_bc = rob[broadcast.robIdx[0:bits]]
+      m.d.comb += broadcast_entry.eq(rob_bc)
+      with m.If(broadcast.valid & (threadOf(broadcast.robIdx, self.threads) == self.thread)):
+        m.d.sync += rob_bc.done.eq(1)
+        with m.If(broadcast_entry.type == ROBType.BRANCH2):
+          m.d.sync += rob_bc.target.eq(broadcast.data)
+        if self.results:
+          with m.Else():
+            m.d.sync += rob_bc.rdValue.eq(broadcast.data)
+        else:
+          with m.Elif(broadcast_entry.type == ROBType.BRANCH):
+            m.d.sync += rob_bc.rdValue.eq(broadcast.data)
+    # Replay (after broadcast, the load may have been broadcast in the same cycle).
+    with m.If(self.i_replay_en):
+      m.d.sync += [rob[self.i_replay_robidx[0:bits]].done.eq(0), rob[self.i_replay_robidx[0:bits]].replay.eq(1)]
     # Allocate.
-    m.d.comb += [self.o_alloc_rdy.eq(~full), self.o_alloc_idx.eq(wp)]
-    with m.If(~full & self.i_alloc_en):
-      m.d.sync += [
-          rob[wp].done.eq(0), rob[wp].rd.eq(self.i_alloc_rd), rob[wp].pc.eq(self.i_alloc_pc),
-          rob[wp].type.eq(self.i_alloc_type), rob[wp].lsqidx.eq(self.i_alloc_lsqidx),
-          wp_.eq(wp_ + 1)
-      ]
+    m.d.comb += [
+        self.o_alloc_rdy.eq(~full),
+        self.o_alloc_idx.eq(robidx(wp)),
+        self.o_alloc2_rdy.eq((wp_ - rp_)[0:bits + 1] < size - 1),
+        self.o_alloc2_idx.eq(robidx(wp + 1))
+    ]
+    with m.If(self.o_alloc2_rdy & self.i_alloc_en & self.i_alloc2_en):
+      m.d.sync += [rob[wp].eq(self.i_alloc), rob[(wp + 1)[0:bits]].eq(self.i_alloc2), wp_.eq(wp_ + 2)]
+    with m.Elif(~full & self.i_alloc_en):
+      m.d.sync += [rob[wp].eq(self.i_alloc), wp_.eq(wp_ + 1)]
     # Commit.
-    m.d.comb += [self.o_commit.eq(rob[rp]), self.o_commit_robidx.eq(rp), self.o_commit_rdy.eq(~empty & rob[rp].done)]
-    with m.If(~empty & self.i_commit_en):
+    m.d.comb += [
+        self.o_commit.eq(rob[rp]),
+        self.o_commit_robidx.eq(robidx(rp)),
+        self.o_commit_rdy.eq(~empty & rob[rp].done)
+    ]
+    rp2 = (rp + 1)[0:bits]
+    m.d.comb += [
+        self.o_commit2.eq(rob[rp2]),
+        self.o_commit2_robidx.eq(robidx(rp2)),
+        self.o_commit2_rdy.eq(((wp_ - rp_)[0:bits + 1] >= 2) & rob[rp2].done)
+    ]
+    with m.If(self.o_commit2_rdy & self.i_commit_en & self.i_commit2_en):
+      m.d.sync += [rp_.eq(rp_ + 2)]
+    with m.Elif(~empty & self.i_commit_en):
       m.d.sync += [rp_.eq(rp_ + 1)]
 
-    with m.If(self.i_flush_en):
-      m.d.sync += wp_.eq(rp_)
+    # Squash (drop everything after the squashing entry).
+    with m.If(self.i_squash_en):
+      m.d.sync += wp_.eq(rp_ + (self.i_squash_robidx[0:bits] - rp)[0:bits] + 1)
 
     addDebugSignals(m, self.o_commit)
 
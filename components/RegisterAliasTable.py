@@ -12,59 +12,168 @@ from amaranth import *
 from amaranth.lib import data
 
 from components.Utils import *
+from components.CoreConfig import *
 
-RegisterAliasTableEntryLayout = data.StructLayout({
-    "valid": unsigned(1),  # Entry maps to ROB not ARF.
-    "robIdx": unsigned(3)  # The ROB-Idx that currently hold this register (the RAT-idx of this entry itself).
-})
+
+def RegisterAliasTableEntryLayout(config):
+  return data.StructLayout({
+      "valid": unsigned(1),  # Entry maps to ROB not ARF.
+      "robIdx": unsigned(config.robIdxBits),  # The ROB-Idx that currently hold this register.
+      "preg": unsigned(6)  # The physical register that holds this register (with a PhysicalRegisterFile).
+  })
 
 
 class RegisterAliasTable(Elaboratable):
 
-  def __init__(self):
+  def __init__(self, checkpoints=4, threads=1, config=CoreConfig()):
+    assert checkpoints <= config.robEntries  # Never more branches in flight than there are ROB entries.
+    self.config = config
+    self.checkpoints = checkpoints
+    self.threads = threads  # The ROB-idxs are those of one thread's ROB partition (see ReOrderBuffer).
     # Ports
     self.i_rd1_idx = Signal(5)
-    self.o_rd1_robidx = Signal(3)
+    self.o_rd1_robidx = Signal(config.robIdxBits)
     self.o_rd1_valid = Signal()
+    self.o_rd1_preg = Signal(6)
 
     self.i_rd2_idx = Signal(5)
-    self.o_rd2_robidx = Signal(3)
+    self.o_rd2_robidx = Signal(config.robIdxBits)
     self.o_rd2_valid = Signal()
+    self.o_rd2_preg = Signal(6)
+    # Operands of the second instruction in an issue group.
+    self.i_rd3_idx = Signal(5)
+    self.o_rd3_robidx = Signal(config.robIdxBits)
+    self.o_rd3_valid = Signal()
+    self.o_rd3_preg = Signal(6)
+
+    self.i_rd4_idx = Signal(5)
+    self.o_rd4_robidx = Signal(config.robIdxBits)
+    self.o_rd4_valid = Signal()
+    self.o_rd4_preg = Signal(6)
 
     self.i_commit_en = Signal()
     self.i_commit_idx = Signal(5)
-    self.i_commit_robidx = Signal(3)
+    self.i_commit_robidx = Signal(config.robIdxBits)
+    # Second commit (the ROB entry following i_commit_robidx).
+    self.i_commit2_en = Signal()
+    self.i_commit2_idx = Signal(5)
+    self.i_commit2_robidx = Signal(config.robIdxBits)
 
     self.i_alloc_en = Signal()
     self.i_alloc_idx = Signal(5)
-    self.i_alloc_robidx = Signal(3)
-    # Flush
+    self.i_alloc_robidx = Signal(config.robIdxBits)
+    self.i_alloc_preg = Signal(6)
+    # Second allocation (the younger instruction of an issue group, takes precedence for the same index).
+    self.i_alloc2_en = Signal()
+    self.i_alloc2_idx = Signal(5)
+    self.i_alloc2_robidx = Signal(config.robIdxBits)
+    self.i_alloc2_preg = Signal(6)
+    # Checkpoint (snapshot of the table taken when a branch is renamed, freed in allocation order on commit).
+    self.o_checkpoint_rdy = Signal()
+    self.o_checkpoint_idx = Signal(config.robIdxBits)
+    self.i_checkpoint_en = Signal()
+    self.i_checkpoint_free_en = Signal()
+    # Restore (from checkpoint i_restore_idx taken by branch i_restore_robidx, younger checkpoints are freed).
+    self.i_restore_en = Signal()
+    self.i_restore_idx = Signal(config.robIdxBits)
+    self.i_restore_robidx = Signal(config.robIdxBits)
+    self.i_head_robidx = Signal(config.robIdxBits)
+    # Flush (when nothing is in flight, every register is then read from the ARF, or with a PhysicalRegisterFile from
+    # its committed register i_flush_preg).
     self.i_flush_en = Signal()
+    self.i_flush_preg = [Signal(6, reset=idx, name='i_flush_preg{}'.format(idx)) for idx in range(32)]
 
   def elaborate(self, platform):
     m = Module()
 
-    rat = Array([Signal(RegisterAliasTableEntryLayout) for _ in range(32)])
+    # Initially x<idx> is held by physical register p<idx>.
+    layout = RegisterAliasTableEntryLayout(self.config)
+    rat = Array([Signal(layout, reset={'preg': idx}) for idx in range(32)])
+
+    allocs = [(self.i_alloc_en, self.i_alloc_idx, self.i_alloc_robidx, self.i_alloc_preg),
+              (self.i_alloc2_en, self.i_alloc2_idx, self.i_alloc2_robidx, self.i_alloc2_preg)]
 
     # Allocating a new translation has priority over commit (for a given index).
-    with m.If(self.i_alloc_en & (self.i_alloc_idx != 0)):
-      m.d.sync += [rat[self.i_alloc_idx].robIdx.eq(self.i_alloc_robidx), rat[self.i_alloc_idx].valid.eq(1)]
-    with m.If(self.i_commit_en & (rat[self.i_commit_idx].robIdx == self.i_commit_robidx)):
-      # Note that this conflict dectection essentially adds another read port (so 3 in total).
-      with m.If(~self.i_alloc_en | (self.i_alloc_idx != self.i_commit_idx)):
-        m.d.sync += rat[self.i_commit_idx].valid.eq(0)
+    for alloc_en, alloc_idx, alloc_robidx, alloc_preg in allocs:
+      with m.If(alloc_en & (alloc_idx != 0)):
+        m.d.sync += [
+            rat[alloc_idx].robIdx.eq(alloc_robidx),
+            rat[alloc_idx].preg.eq(alloc_preg),
+            rat[alloc_idx].valid.eq(1)
+        ]
+    commits = [(self.i_commit_en, self.i_commit_idx, self.i_commit_robidx),
+               (self.i_commit2_en, self.i_commit2_idx, self.i_commit2_robidx)]
+    for commit_en, commit_idx, commit_robidx in commits:
+      with m.If(commit_en & (rat[commit_idx].robIdx == commit_robidx)):
+        # Note that this conflict dectection essentially adds another read port (so 3 in total).
+        with m.If((~self.i_alloc_en | (self.i_alloc_idx != commit_idx))
+                  & (~self.i_alloc2_en | (self.i_alloc2_idx != commit_idx))):
+          m.d.sync += rat[commit_idx].valid.eq(0)
 
     m.d.comb += [
         self.o_rd1_robidx.eq(rat[self.i_rd1_idx].robIdx),
         self.o_rd1_valid.eq(rat[self.i_rd1_idx].valid),
+        self.o_rd1_preg.eq(rat[self.i_rd1_idx].preg),
         self.o_rd2_robidx.eq(rat[self.i_rd2_idx].robIdx),
-        self.o_rd2_valid.eq(rat[self.i_rd2_idx].valid)
+        self.o_rd2_valid.eq(rat[self.i_rd2_idx].valid),
+        self.o_rd2_preg.eq(rat[self.i_rd2_idx].preg),
+        self.o_rd3_robidx.eq(rat[self.i_rd3_idx].robIdx),
+        self.o_rd3_valid.eq(rat[self.i_rd3_idx].valid),
+        self.o_rd3_preg.eq(rat[self.i_rd3_idx].preg),
+        self.o_rd4_robidx.eq(rat[self.i_rd4_idx].robIdx),
+        self.o_rd4_valid.eq(rat[self.i_rd4_idx].valid),
+        self.o_rd4_preg.eq(rat[self.i_rd4_idx].preg)
     ]
 
-    # Flush (highest priority).
+    if self.checkpoints > 0:
+      ckpt = [[Signal(layout, name='ckpt{}_{}'.format(c, idx)) for idx in range(32)] for c in range(self.checkpoints)]
+      rp = Signal(range(self.checkpoints))
+      wp = Signal(range(self.checkpoints))
+      count = Signal(range(self.checkpoints + 1))
+
+      def inc(p):
+        return Mux(p == self.checkpoints - 1, 0, p + 1)
+
+      m.d.comb += [self.o_checkpoint_rdy.eq(count != self.checkpoints), self.o_checkpoint_idx.eq(wp)]
+      # The checkpoint includes the translations allocated in the same cycle (JALR writes its link register and the
+      # branch is the last instruction of its issue group).
+      with m.If(self.i_checkpoint_en):
+        for c in range(self.checkpoints):
+          with m.If(wp == c):
+            m.d.sync += [ckpt[c][idx].eq(rat[idx]) for idx in range(32)]
+            for alloc_en, alloc_idx, alloc_robidx, alloc_preg in allocs:
+              with m.If(alloc_en & (alloc_idx != 0)):
+                e = Array(ckpt[c])[alloc_idx]
+                m.d.sync += [e.robIdx.eq(alloc_robidx), e.preg.eq(alloc_preg), e.valid.eq(1)]
+        m.d.sync += wp.eq(inc(wp))
+      with m.If(self.i_checkpoint_free_en):
+        m.d.sync += rp.eq(inc(rp))
+      m.d.sync += count.eq(count + self.i_checkpoint_en - self.i_checkpoint_free_en)
+
+      # Restore. Mappings to ROB entries that have committed since the checkpoint was taken are recognized by their
+      # ROB-idx no longer being older than the branch (or being the one committing right now) and are dropped.
+      with m.If(self.i_restore_en):
+        for idx in range(1, 32):
+          e = Array([ckpt[c][idx] for c in range(self.checkpoints)])[self.i_restore_idx]
+          committed = isYounger(e.robIdx, self.i_restore_robidx, self.i_head_robidx, self.threads)
+          for commit_en, commit_idx, commit_robidx in commits:
+            committed |= commit_en & (e.robIdx == commit_robidx)
+          m.d.sync += [rat[idx].robIdx.eq(e.robIdx), rat[idx].preg.eq(e.preg), rat[idx].valid.eq(e.valid & ~committed)]
+        # Free the checkpoints of the squashed branches (the restored one lives until its branch commits).
+        m.d.sync += [
+            wp.eq(inc(self.i_restore_idx)),
+            count.eq(Mux(self.i_restore_idx >= rp, self.i_restore_idx - rp, self.i_restore_idx + self.checkpoints - rp)
+                     + 1 - self.i_checkpoint_free_en)
+        ]
+    else:
+      m.d.comb += self.o_checkpoint_rdy.eq(1)
+
+    # Flush (highest priority). The checkpoints left are those of squashed branches.
     with m.If(self.i_flush_en):
-      for rate in rat:
-        m.d.sync += rate.valid.eq(0)
+      for rate, flush_preg in zip(rat, self.i_flush_preg):
+        m.d.sync += [rate.valid.eq(0), rate.preg.eq(flush_preg)]
+      if self.checkpoints > 0:
+        m.d.sync += [wp.eq(rp), count.eq(0)]
 
     for idx in range(len(rat)):
       addDebugSignals(m, rat[idx], name='rat{}'.format(idx))
@@ -14,88 +14,229 @@ from amaranth.lib import data
 from components.BroadCast import *
 from components.Utils import *
 from components.MicroOperation import *
+from components.CoreConfig import *
 
-ReservationStationEntryLayout = data.StructLayout({
-    "busy": unsigned(1),  # This entry is busy.
-    "opcode": uOPOpcode,  # The op-code.
-    "robIdx": unsigned(3),  # The ROB-idx corresponding to this RS entry.
-    "rs1Value": unsigned(32),  # The value of rs1 operand if rs1ValueValid=1.
-    "rs2Value": unsigned(32),  # The value of rs2 operand if rs2ValueValid=1.
-    "rs1ValueValid": unsigned(1),
-    "rs2ValueValid": unsigned(1),
-    "rs1RobIdx": unsigned(3),  # The ROB-idx to whose result should fill rs1Value if rs1ValueValid=0.
-    "rs2RobIdx": unsigned(3),  # The ROB-idx to whose result should fill rs2Value if rs2ValueValid=0.
-    "imm": unsigned(12)
-})
+
+def ReservationStationEntryLayout(config):
+  return data.StructLayout({
+      "busy": unsigned(1),  # This entry is busy.
+      "opcode": uOPOpcode,  # The op-code.
+      "robIdx": unsigned(config.robIdxBits),  # The ROB-idx corresponding to this RS entry.
+      "rs1Value": unsigned(32),  # The value of rs1 operand if rs1ValueValid=1.
+      "rs2Value": unsigned(32),  # The value of rs2 operand if rs2ValueValid=1.
+      "rs1ValueValid": unsigned(1),
+      "rs2ValueValid": unsigned(1),
+      "rs1RobIdx": unsigned(config.robIdxBits),  # The ROB-idx whose result should fill rs1Value if rs1ValueValid=0.
+      "rs2RobIdx": unsigned(config.robIdxBits),  # The ROB-idx whose result should fill rs2Value if rs2ValueValid=0.
+      "rs1Reg": unsigned(1),  # With tagsOnly rs1 is read from physical register rs1Preg (rs1Value is a constant if 0).
+      "rs2Reg": unsigned(1),
+      "rs1Preg": unsigned(6),
+      "rs2Preg": unsigned(6),
+      "imm": unsigned(12),
+      "rvc": unsigned(1)  # Compressed instruction (a branch not taken continues at pc + 2).
+  })
 
 
 class ReservationStation(Elaboratable):
 
-  def __init__(self):
+  def __init__(self,
+               units=((uOPClass.ALU, uOPClass.BRANCH),),
+               broadcastBuses=1,
+               latencies={},
+               wakeups=0,
+               selectPolicy='first',
+               tagsOnly=False,
+               threads=1,
+               config=CoreConfig()):
+    assert selectPolicy in ['first', 'oldest']
+    self.units = units  # The uOP classes executed by each execution unit (one dispatch port per unit).
+    self.latencies = latencies
+    self.wakeups = wakeups  # Number of early wakeup ports, zero selects on the broadcast results only.
+    self.selectPolicy = selectPolicy  # Dispatch the lowest-indexed ('first') or the oldest ready entry.
+    # Register operands are read from a physical register file at dispatch (entries only track their readiness).
+    self.tagsOnly = tagsOnly
+    self.threads = threads  # The threads sharing the RS (the top bits of a ROB-idx are the thread, see threadOf).
+    self.config = config
     # Ports
     self.i_issue_en = Signal()
-    self.i_issue = Signal(ReservationStationEntryLayout)
+    self.i_issue = Signal(ReservationStationEntryLayout(config))
     self.o_issue_rdy = Signal()
-    self.i_broadcast = Signal(BroadcastBusTypeLayout)
-    self.i_dispatch_rdy = Signal()
-    self.o_dispatch_en = Signal()
-    self.o_dispatch_uop = Signal(MicroOperationTypeLayout)
-    self.i_flush_en = Signal()
+    # Second issue (may be used with or without the first, o_issue2_rdy if there is room for both).
+    self.i_issue2_en = Signal()
+    self.i_issue2 = Signal(ReservationStationEntryLayout(config))
+    self.o_issue2_rdy = Signal()
+    self.i_broadcast = [
+        Signal(BroadcastBusTypeLayout(config), name='i_broadcast{}'.format(idx)) for idx in range(broadcastBuses)
+    ]
+    self.i_wakeup = [Signal(WakeupTypeLayout(config), name='i_wakeup{}'.format(idx)) for idx in range(wakeups)]
+    # A uOP with latency n can be dispatched to the unit if bit n is set (see ExecutionUnit).
+    self.i_dispatch_rdy = [
+        Signal(maxLatency(latencies) + 1, name='i_dispatch{}_rdy'.format(idx)) for idx in range(len(units))
+    ]
+    self.o_dispatch_en = [Signal(name='o_dispatch{}_en'.format(idx)) for idx in range(len(units))]
+    self.o_dispatch_uop = [
+        Signal(MicroOperationTypeLayout(config), name='o_dispatch{}_uop'.format(idx)) for idx in range(len(units))
+    ]
+    # Physical register file read (with tagsOnly, rs1 and rs2 of the uOP dispatched to each unit).
+    reads = 2 * len(units) if tagsOnly else 0
+    self.o_read_idx = [Signal(6, name='o_read{}_idx'.format(idx)) for idx in range(reads)]
+    self.i_read_data = [Signal(32, name='i_read{}_data'.format(idx)) for idx in range(reads)]
+    # Squash (per thread, all entries of the thread younger than i_squash_robidx).
+    self.i_squash_en = [Signal(name='i_squash{}_en'.format(t)) for t in range(threads)]
+    self.i_squash_robidx = [Signal(config.robIdxBits, name='i_squash{}_robidx'.format(t)) for t in range(threads)]
+    self.i_head_robidx = [Signal(config.robIdxBits, name='i_head{}_robidx'.format(t)) for t in range(threads)]
+    # Entries held by each thread.
+    self.o_count = [Signal(range(config.rsEntries + 1), name='o_count{}'.format(t)) for t in range(threads)]
 
   def elaborate(self, platform):
     m = Module()
 
     addDebugSignals(m, self.i_issue)
-    addDebugSignals(m, self.o_dispatch_uop)
-    rs = Array([Signal(ReservationStationEntryLayout) for _ in range(4)])
+    for dispatch_uop in self.o_dispatch_uop:
+      addDebugSignals(m, dispatch_uop)
+    rs = Array([Signal(ReservationStationEntryLayout(self.config)) for _ in range(self.config.rsEntries)])
 
-    # Issue side.
-    all_busy = Signal(4)
+    # Issue side. The first issue goes to the first free entry and the second one to the free entry after that.
+    all_busy = Signal(len(rs))
     for idx in range(len(rs)):
       m.d.comb += all_busy[idx].eq(rs[idx].busy)
-    m.d.comb += self.o_issue_rdy.eq(~all_busy.all())
-    with m.If(0):
-      pass
+    free = Signal(range(len(rs) + 1))
+    m.d.comb += free.eq(sum(~rse.busy for rse in rs))
+    m.d.comb += [self.o_issue_rdy.eq(~all_busy.all()), self.o_issue2_rdy.eq(free >= 2)]
+    for thread, count in enumerate(self.o_count):
+      same = [(threadOf(rse.robIdx, self.threads) == thread) if self.threads > 1 else 1 for rse in rs]
+      m.d.comb += count.eq(sum((rse.busy & s for rse, s in zip(rs, same)), Const(0, range(len(rs) + 1))))
+
+    # Operands woken up by an early wakeup in the previous cycle (their result should be on a broadcast bus now).
+    woken = [(Signal(name='rs{}_rs1Woken'.format(idx)), Signal(name='rs{}_rs2Woken'.format(idx)))
+             for idx in range(len(rs))]
+
+    def wakeup(valid, robidx):
+      return Cat(~valid & w.valid & (robidx == w.robIdx) for w in self.i_wakeup).any()
+
+    def capture(value, valid, data):
+      m.d.sync += valid.eq(1)
+      if not self.tagsOnly:
+        m.d.sync += value.eq(data)
+
+    def issue(rse, rse_woken, uop):
+      m.d.sync += [rse.eq(uop), rse.busy.eq(1)]
+      m.d.sync += [
+          rse_woken[0].eq(wakeup(uop.rs1ValueValid, uop.rs1RobIdx)),
+          rse_woken[1].eq(wakeup(uop.rs2ValueValid, uop.rs2RobIdx))
+      ]
+      # If broadcast happens at the same time as issue then check no valid operands and possibly override.
+      for broadcast in self.i_broadcast:
+        with m.If(broadcast.valid & ~uop.rs1ValueValid & (uop.rs1RobIdx == broadcast.robIdx)):
+          capture(rse.rs1Value, rse.rs1ValueValid, broadcast.data)
+        with m.If(broadcast.valid & ~uop.rs2ValueValid & (uop.rs2RobIdx == broadcast.robIdx)):
+          capture(rse.rs2Value, rse.rs2ValueValid, broadcast.data)
+
     for idx in range(len(rs)):
-      with m.Elif(~rs[idx].busy):
-        with m.If(self.i_issue_en):
-          m.d.sync += [rs[idx].eq(self.i_issue), rs[idx].busy.eq(1)]
-          # If broadcast happens at the same time as issue then check no valid operands and possibly override.
-          with m.If(self.i_broadcast.valid & ~self.i_issue.rs1ValueValid
-                    & (self.i_issue.rs1RobIdx == self.i_broadcast.robIdx)):
-            m.d.sync += [rs[idx].rs1Value.eq(self.i_broadcast.data), rs[idx].rs1ValueValid.eq(1)]
-          with m.If(self.i_broadcast.valid & ~self.i_issue.rs2ValueValid
-                    & (self.i_issue.rs2RobIdx == self.i_broadcast.robIdx)):
-            m.d.sync += [rs[idx].rs2Value.eq(self.i_broadcast.data), rs[idx].rs2ValueValid.eq(1)]
+      free_before = sum((~rse.busy for rse in rs[:idx]), Const(0, range(len(rs) + 1)))
+      with m.If(~rs[idx].busy):
+        with m.If(self.i_issue_en & (free_before == 0)):
+          issue(rs[idx], woken[idx], self.i_issue)
+        with m.If(self.i_issue2_en & (free_before == self.i_issue_en)):
+          issue(rs[idx], woken[idx], self.i_issue2)
 
     # Generate broadcast bus monitoring logic.
-    for rse in rs:
-      with m.If(self.i_broadcast.valid & rse.busy & ~rse.rs1ValueValid & (rse.rs1RobIdx == self.i_broadcast.robIdx)):
-        m.d.sync += [rse.rs1Value.eq(self.i_broadcast.data), rse.rs1ValueValid.eq(1)]
-      with m.If(self.i_broadcast.valid & rse.busy & ~rse.rs2ValueValid & (rse.rs2RobIdx == self.i_broadcast.robIdx)):
-        m.d.sync += [rse.rs2Value.eq(self.i_broadcast.data), rse.rs2ValueValid.eq(1)]
-
-    # Dispatch.
-    with m.If(self.i_dispatch_rdy):
-      with m.If(0):
-        pass
-      for idx in range(len(rs)):
-        with m.Elif(rs[idx].busy & rs[idx].rs1ValueValid & rs[idx].rs2ValueValid):
+    for rse, rse_woken in zip(rs, woken):
+      with m.If(rse.busy):
+        m.d.sync += [
+            rse_woken[0].eq(wakeup(rse.rs1ValueValid, rse.rs1RobIdx)),
+            rse_woken[1].eq(wakeup(rse.rs2ValueValid, rse.rs2RobIdx))
+        ]
+      for broadcast in self.i_broadcast:
+        with m.If(broadcast.valid & rse.busy & ~rse.rs1ValueValid & (rse.rs1RobIdx == broadcast.robIdx)):
+          capture(rse.rs1Value, rse.rs1ValueValid, broadcast.data)
+        with m.If(broadcast.valid & rse.busy & ~rse.rs2ValueValid & (rse.rs2RobIdx == broadcast.robIdx)):
+          capture(rse.rs2Value, rse.rs2ValueValid, broadcast.data)
+
+    # Operands that are broadcast in this cycle are bypassed to dispatch (so a uOP can be dispatched in the cycle after
+    # the one it depends on).
+    def bypass(name, valid, robidx, value):
+      o_valid = Signal(name=name + '_valid')
+      o_value = Signal(32, name=name + '_value')
+      m.d.comb += [o_valid.eq(valid), o_value.eq(value)]
+      for broadcast in self.i_broadcast:
+        with m.If(~valid & broadcast.valid & (robidx == broadcast.robIdx)):
+          m.d.comb += [o_valid.eq(1), o_value.eq(broadcast.data)]
+      return o_valid, o_value
+
+    # With early wakeups an entry is selected on its registered state only (operands valid or woken up) rather than on
+    # the broadcast results. If a woken operand is not broadcast after all the selected entry is not dispatched (the
+    # dispatch slot is lost) and it waits for the real broadcast.
+    operands = []
+    for idx, (rse, rse_woken) in enumerate(zip(rs, woken)):
+      rs1_valid, rs1_value = bypass('rs{}_op1'.format(idx), rse.rs1ValueValid, rse.rs1RobIdx, rse.rs1Value)
+      rs2_valid, rs2_value = bypass('rs{}_op2'.format(idx), rse.rs2ValueValid, rse.rs2RobIdx, rse.rs2Value)
+      if self.wakeups > 0:
+        ready = (rse.rs1ValueValid | rse_woken[0]) & (rse.rs2ValueValid | rse_woken[1])
+      else:
+        ready = rs1_valid & rs2_valid
+      operands.append((ready, rs1_valid & rs2_valid, rs1_value, rs2_value))
+
+    # Dispatch. Every unit takes the first (or oldest, relative to the ROB head) ready entry of its classes that was not
+    # taken by a unit before it. Entries of different threads are ordered by thread.
+    def younger(robidx, than_robidx):
+      if self.threads == 1:
+        return isYounger(robidx, than_robidx, self.i_head_robidx[0])
+      thread = threadOf(robidx, self.threads)
+      than_thread = threadOf(than_robidx, self.threads)
+      head = Array(self.i_head_robidx)[thread]
+      return Mux(thread == than_thread, isYounger(robidx, than_robidx, head, self.threads), thread > than_thread)
+
+    taken = [Const(0) for _ in rs]
+    for unit, classes in enumerate(self.units):
+      selected = [Signal(name='dispatch{}_rs{}'.format(unit, idx)) for idx in range(len(rs))]
+      candidates = [
+          rs[idx].busy & ready & ~taken[idx] & isClass(rs[idx].opcode, classes)
+          & self.i_dispatch_rdy[unit].bit_select(latencyOf(rs[idx].opcode, self.latencies), 1)
+          for idx, (ready, _, _, _) in enumerate(operands)
+      ]
+      if self.selectPolicy == 'first':
+        with m.If(0):
+          pass
+        for idx, candidate in enumerate(candidates):
+          with m.Elif(candidate):
+            m.d.comb += selected[idx].eq(1)
+      else:
+        for idx, candidate in enumerate(candidates):
+          older = [
+              ~other | younger(rs[other_idx].robIdx, rs[idx].robIdx)
+              for other_idx, other in enumerate(candidates)
+              if other_idx != idx
+          ]
+          m.d.comb += selected[idx].eq(candidate & Cat(older).all())
+      for idx, (ready, available, op1, op2) in enumerate(operands):
+        if self.tagsOnly:
+          # Operands that were valid before this cycle have been written to the physical register file.
+          read1, read2 = self.o_read_idx[2 * unit:2 * unit + 2]
+          data1, data2 = self.i_read_data[2 * unit:2 * unit + 2]
+          with m.If(selected[idx]):
+            m.d.comb += [read1.eq(rs[idx].rs1Preg), read2.eq(rs[idx].rs2Preg)]
+          op1 = Mux(rs[idx].rs1Reg & rs[idx].rs1ValueValid, data1, op1)
+          op2 = Mux(rs[idx].rs2Reg & rs[idx].rs2ValueValid, data2, op2)
+        with m.If(selected[idx] & available):
           m.d.comb += [
-              self.o_dispatch_en.eq(1),
-              self.o_dispatch_uop.robidx.eq(rs[idx].robIdx),
-              self.o_dispatch_uop.opcode.eq(rs[idx].opcode),
-              self.o_dispatch_uop.op1.eq(rs[idx].rs1Value),
-              self.o_dispatch_uop.op2.eq(rs[idx].rs2Value),
-              self.o_dispatch_uop.imm.eq(rs[idx].imm),
-              self.o_dispatch_uop.valid.eq(1)
+              self.o_dispatch_en[unit].eq(1),
+              self.o_dispatch_uop[unit].robidx.eq(rs[idx].robIdx),
+              self.o_dispatch_uop[unit].opcode.eq(rs[idx].opcode),
+              self.o_dispatch_uop[unit].op1.eq(op1),
+              self.o_dispatch_uop[unit].op2.eq(op2),
+              self.o_dispatch_uop[unit].imm.eq(rs[idx].imm),
+              self.o_dispatch_uop[unit].rvc.eq(rs[idx].rvc),
+              self.o_dispatch_uop[unit].valid.eq(1)
           ]
           m.d.sync += rs[idx].busy.eq(0)
+      taken = [t | s for t, s in zip(taken, selected)]
 
-    # Flush (highest priority)
-    with m.If(self.i_flush_en):
+    # Squash (highest priority). Only busy entries, the free ones may be issued to by another thread in this cycle.
+    with m.If(Cat(self.i_squash_en).any()):
       for rse in rs:
-        m.d.sync += rse.busy.eq(0)
+        with m.If(rse.busy & isSquashed(rse.robIdx, self.i_squash_en, self.i_squash_robidx, self.i_head_robidx)):
+          m.d.sync += rse.busy.eq(0)
 
     for idx in range(len(rs)):
       addDebugSignals(m, rs[idx], name='rs{}'.format(idx))
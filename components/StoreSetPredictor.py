@@ -0,0 +1,75 @@
+# Copyright 2022 Markus Lavin (https://www.zzzconsulting.se/).
+#
+# This source describes Open Hardware and is licensed under the CERN-OHL-P v2.
+#
+# You may redistribute and modify this documentation and make products using it
+# under the terms of the CERN-OHL-P v2 (https:/cern.ch/cern-ohl).  This
+# documentation is distributed WITHOUT ANY EXPRESS OR IMPLIED WARRANTY,
+# INCLUDING OF MERCHANTABILITY, SATISFACTORY QUALITY AND FITNESS FOR A
+# PARTICULAR PURPOSE. Please see the CERN-OHL-P v2 for applicable conditions.
+
+from amaranth import *
+from amaranth.lib import data
+
+from components.Utils import *
+
+
+def StoreSetEntryLayout(indexBits):
+  return data.StructLayout({
+      "valid": unsigned(1),  # The instruction belongs to a store set.
+      "ssid": unsigned(indexBits)  # The store set (the index of the load that it was created for).
+  })
+
+
+class StoreSetPredictor(Elaboratable):
+  # Memory dependence prediction with store sets (Chrysos and Emer). The store set ID table (SSIT) is indexed by the PC
+  # of a load or store and tells which store set, if any, it belongs to. A load waits for the older stores of its set
+  # instead of being executed ahead of them (see LoadStoreQueue). A memory order violation puts the load and the store
+  # in the same set, the one with the lowest ID if both already belong to one. Every 2**clearBits cycles the table is
+  # cleared so that sets do not keep growing.
+
+  def __init__(self, indexBits=6, readPorts=1, clearBits=16):
+    self.indexBits = indexBits
+    self.clearBits = clearBits
+    # Read.
+    self.i_rd_pc = [Signal(32, name='i_rd{}_pc'.format(idx)) for idx in range(readPorts)]
+    self.o_rd_valid = [Signal(name='o_rd{}_valid'.format(idx)) for idx in range(readPorts)]
+    self.o_rd_ssid = [Signal(indexBits, name='o_rd{}_ssid'.format(idx)) for idx in range(readPorts)]
+    # Train (a load executed ahead of an older store that wrote the same bytes).
+    self.i_train_en = Signal()
+    self.i_train_load_pc = Signal(32)
+    self.i_train_store_pc = Signal(32)
+
+  def elaborate(self, platform):
+    m = Module()
+
+    ssit = Array([Signal(StoreSetEntryLayout(self.indexBits)) for _ in range(2**self.indexBits)])
+
+    def index(pc):
+      return pc[2:2 + self.indexBits]
+
+    for rd_pc, rd_valid, rd_ssid in zip(self.i_rd_pc, self.o_rd_valid, self.o_rd_ssid):
+      m.d.comb += [rd_valid.eq(ssit[index(rd_pc)].valid), rd_ssid.eq(ssit[index(rd_pc)].ssid)]
+
+    with m.If(self.i_train_en):
+      load = ssit[index(self.i_train_load_pc)]
+      store = ssit[index(self.i_train_store_pc)]
+      ssid = Signal(self.indexBits)
+      with m.If(load.valid & store.valid):
+        m.d.comb += ssid.eq(Mux(load.ssid < store.ssid, load.ssid, store.ssid))
+      with m.Elif(load.valid):
+        m.d.comb += ssid.eq(load.ssid)
+      with m.Elif(store.valid):
+        m.d.comb += ssid.eq(store.ssid)
+      with m.Else():
+        m.d.comb += ssid.eq(index(self.i_train_load_pc))
+      m.d.sync += [load.valid.eq(1), load.ssid.eq(ssid), store.valid.eq(1), store.ssid.eq(ssid)]
+
+    # Clear (highest priority).
+    cycles = Signal(self.clearBits)
+    m.d.sync += cycles.eq(cycles + 1)
+    with m.If(cycles == 2**self.clearBits - 1):
+      for ssite in ssit:
+        m.d.sync += ssite.valid.eq(0)
+
+    return m
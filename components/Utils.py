@@ -31,3 +31,29 @@ def addDebugSignals(mod, sig, name=None):
   for a, b in sig._View__layout._fields.items():
     dbgSig = Signal(b.shape, name='{}${}'.format(sig._View__target.name, a))
     mod.d.comb += dbgSig.eq(Value.cast(sig)[b.offset:b.offset + b.width])
+
+
+def isYounger(robidx, than_robidx, head_robidx, threads=1):
+  # True if ROB-idx robidx was allocated after than_robidx given the ROB-idx of the oldest entry (the ROB head). With
+  # several threads the ROB is partitioned between them and only ROB-idxs of the same thread can be compared.
+  width = len(head_robidx) - threadBits(threads)
+  return (robidx - head_robidx)[0:width] > (than_robidx - head_robidx)[0:width]
+
+
+def threadBits(threads):
+  # The top bits of a ROB-idx select the ROB partition (and thereby the thread) that it belongs to.
+  return (threads - 1).bit_length()
+
+
+def threadOf(robidx, threads):
+  return robidx[len(robidx) - threadBits(threads):]
+
+
+def isSquashed(robidx, squash_en, squash_robidx, head_robidx):
+  # True if ROB-idx robidx is younger than the squashing ROB-idx of its thread (one squash port per thread).
+  threads = len(squash_en)
+  squashed = []
+  for thread, (en, than_robidx, head) in enumerate(zip(squash_en, squash_robidx, head_robidx)):
+    same = (threadOf(robidx, threads) == thread) if threads > 1 else 1
+    squashed.append(en & same & isYounger(robidx, than_robidx, head, threads))
+  return Cat(squashed).any()
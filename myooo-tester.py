@@ -55,6 +55,13 @@ def run_test(inputBinPath):
   failed = False
   cycles = 0
 
+  def readReg(idx):
+    # Committed architectural register (with a physical register file in the register it is committed to).
+    if dut.u_myooo.physicalRegisters > 0:
+      preg = yield dut.u_myooo.u_prf.committed[idx]
+      return (yield dut.u_myooo.u_prf.regs[preg])
+    return (yield dut.u_myooo.u_arf.regs[idx])
+
   def bench():
     # Simulate for at most N cycles or until EBREAK occurs.
     nonlocal cycles
@@ -68,13 +75,13 @@ def run_test(inputBinPath):
 
     nonlocal failed
     failed = False
-    x11 = yield dut.u_myooo.u_arf.regs[11]
-    x12 = yield dut.u_myooo.u_arf.regs[12]
-    x13 = yield dut.u_myooo.u_arf.regs[13]
+    x11 = yield from readReg(11)
+    x12 = yield from readReg(12)
+    x13 = yield from readReg(13)
     if x11 != ord('O') or x12 != ord('K') or x13 != ord('\n'):
       failed = True
-      for idx in range(len(dut.u_myooo.u_arf.regs)):
-        r = yield dut.u_myooo.u_arf.regs[idx]
+      for idx in range(32):
+        r = yield from readReg(idx)
         print('  x{} = {}'.format(idx, hex(r)))
 
   sim = Simulator(dut)
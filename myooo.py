@@ -18,21 +18,113 @@ from amaranth.lib.fifo import SyncFIFO
 import pdb
 
 from components.RV32I import *
+from components.CoreConfig import *
 from components.Utils import *
 from components.InstructionQueue import *
 from components.ReservationStation import *
 from components.RegisterAliasTable import *
 from components.ReOrderBuffer import *
 from components.ArchitecturalRegisterFile import *
+from components.PhysicalRegisterFile import *
 from components.MicroOperation import *
 from components.ExecutionUnit import *
+from components.Multiplier import *
+from components.Divider import *
 from components.LoadStoreQueue import *
 from components.Cache import *
+from components.BranchPredictor import *
+from components.Decoder import *
+from components.LoopBuffer import *
+from components.RV32C import *
+from components.MacroOpFusion import *
 
 
 class MyOoO(Elaboratable):
 
-  def __init__(self):
+  def __init__(self,
+               rvc=True,
+               rvm=True,
+               fetchWidth=1,
+               loopBufferDepth=8,
+               icachePrefetchDepth=2,
+               bpIndexBits=6,
+               bpHistoryBits=0,
+               rasDepth=4,
+               itpIndexBits=3,
+               ratCheckpoints=4,
+               fuseLuiAddi=True,
+               fuseAuipcAddi=True,
+               fuseAuipcJalr=True,
+               fuseSlliSrli=True,
+               renameElimination=True,
+               issueWidth=1,
+               commitWidth=1,
+               physicalRegisters=0,
+               executionUnits=((uOPClass.ALU, uOPClass.BRANCH), (uOPClass.MUL,), (uOPClass.DIV,)),
+               broadcastBuses=2,
+               latencies={},
+               earlyWakeup=True,
+               rsSelectPolicy='oldest',
+               storeForwarding=True,
+               speculativeLoads=True,
+               storeSetBits=6,
+               threads=1,
+               fetchPolicy='icount',
+               resetPcs=(0, 0),
+               config=CoreConfig()):
+    assert fetchWidth in [1, 2]
+    assert issueWidth in [1, 2]
+    assert commitWidth in [1, 2]
+    assert physicalRegisters == 0 or ratCheckpoints > 0  # Physical registers are recovered with the RAT checkpoints.
+    needed = [uOPClass.ALU, uOPClass.BRANCH] + ([uOPClass.MUL, uOPClass.DIV] if rvm else [])
+    assert all(any(c in classes for classes in executionUnits) for c in needed)
+    # Multiplications and divisions are executed by units of their own (a Multiplier and a Divider).
+    assert all(classes in [(uOPClass.MUL,), (uOPClass.DIV,)] for classes in executionUnits
+               if uOPClass.MUL in classes or uOPClass.DIV in classes)
+    assert broadcastBuses >= 1
+    assert threads in [1, 2] and len(resetPcs) >= threads
+    assert fetchPolicy in ['roundrobin', 'icount']
+    # Every thread uses an RS and LSQ issue port of its own and has architectural registers of its own.
+    assert threads == 1 or (issueWidth == 1 and physicalRegisters == 0)
+    assert config.robEntries >= 2 * threads  # Every thread needs a ROB partition of at least two entries.
+    self.rvc = rvc  # Support the compressed (C) extension.
+    self.rvm = rvm  # Support the multiply/divide (M) extension.
+    self.fetchWidth = fetchWidth  # Instructions fetched per cycle.
+    self.loopBufferDepth = loopBufferDepth  # Longest loop body (in words) replayed by fetch, zero disables.
+    self.icachePrefetchDepth = icachePrefetchDepth  # I-cache lines prefetched ahead of fetch, zero disables.
+    self.bpIndexBits = bpIndexBits
+    self.bpHistoryBits = bpHistoryBits  # Zero selects a bimodal predictor, non-zero gshare.
+    self.rasDepth = rasDepth
+    self.itpIndexBits = itpIndexBits
+    self.ratCheckpoints = ratCheckpoints  # Zero disables checkpoints (RAT is recovered by draining the ROB).
+    # Macro-op fusion of adjacent instruction pairs at issue (see MacroOpFusion).
+    self.fuseLuiAddi = fuseLuiAddi
+    self.fuseAuipcAddi = fuseAuipcAddi
+    self.fuseAuipcJalr = fuseAuipcJalr
+    self.fuseSlliSrli = fuseSlliSrli
+    self.renameElimination = renameElimination  # Resolve constants, moves and zero idioms at rename.
+    self.issueWidth = issueWidth  # Instructions renamed and issued per cycle.
+    self.commitWidth = commitWidth  # ROB entries committed per cycle.
+    # Zero keeps results in the ROB until they are committed to the ARF, otherwise the size of a unified physical
+    # register file that results are written to once (RS entries then only hold operand tags).
+    self.physicalRegisters = physicalRegisters
+    self.executionUnits = executionUnits  # The uOP classes of each execution unit, e.g. ((ALU,), (ALU, BRANCH)).
+    self.broadcastBuses = broadcastBuses  # Results written back per cycle (by the LSQ and the execution units).
+    self.latencies = latencies  # Execution latency of uOPs that take more than one cycle (uOPOpcode -> cycles).
+    self.earlyWakeup = earlyWakeup  # Wake up RS entries from result tags sent a cycle ahead of the broadcast.
+    self.rsSelectPolicy = rsSelectPolicy  # Dispatch the 'first' (lowest-indexed) or the 'oldest' ready RS entry.
+    self.storeForwarding = storeForwarding  # Loads take their data from older stores in the LSQ (if they can).
+    # Loads are executed ahead of older stores with unknown addresses, unless a store set predictor with 2**storeSetBits
+    # entries (zero disables it) has seen them depend on one. A load found to have been executed too early is replayed
+    # (see commit).
+    self.speculativeLoads = speculativeLoads
+    self.storeSetBits = storeSetBits
+    # Simultaneous multithreading. Every thread has its own PC, IQ, RAT, ARF and ROB partition while the RS, the
+    # execution units, the LSQ and the caches are shared.
+    self.threads = threads
+    self.fetchPolicy = fetchPolicy  # Fetch from the threads in turn ('roundrobin') or the least busy one ('icount').
+    self.resetPcs = resetPcs  # The PC that each thread starts at.
+    self.config = config  # Sizes of the ROB, RS, LSQ, IQs and caches (see CoreConfig).
     self.o_ebreak = Signal()
     # BUS IF
     self.o_wb_adr = Signal(32)
@@ -48,15 +140,82 @@ class MyOoO(Elaboratable):
   def elaborate(self, platform):
     m = Module()
 
-    m.submodules.u_iq = u_iq = InstructionQueue()
-    m.submodules.u_arf = u_arf = ArchitecturalRegisterFile()
-    m.submodules.u_rat = u_rat = RegisterAliasTable()
-    m.submodules.u_rs = u_rs = ReservationStation()
-    m.submodules.u_rob = u_rob = ReOrderBuffer()
-    m.submodules.u_eu = u_eu = ExecutionUnit()
-    m.submodules.u_lsq = u_lsq = LoadStoreQueue()
-    m.submodules.u_icache = u_icache = Cache()
-    self.u_arf = u_arf
+    def named(name, thread):
+      # Units and signals of each thread are numbered with several threads.
+      return name if self.threads == 1 else '{}{}'.format(name, thread)
+
+    u_iqs = []
+    u_rats = []
+    u_robs = []
+    u_fuses = []
+    for t in range(self.threads):
+      m.submodules[named('u_iq', t)] = u_iq = InstructionQueue(config=self.config)
+      m.submodules[named('u_rat', t)] = u_rat = RegisterAliasTable(checkpoints=self.ratCheckpoints,
+                                                                   threads=self.threads,
+                                                                   config=self.config)
+      m.submodules[named('u_rob', t)] = u_rob = ReOrderBuffer(broadcastBuses=self.broadcastBuses,
+                                                              results=self.physicalRegisters == 0,
+                                                              threads=self.threads,
+                                                              thread=t,
+                                                              config=self.config)
+      m.submodules[named('u_fuse', t)] = u_fuse = MacroOpFusion(luiAddi=self.fuseLuiAddi,
+                                                                auipcAddi=self.fuseAuipcAddi,
+                                                                auipcJalr=self.fuseAuipcJalr,
+                                                                slliSrli=self.fuseSlliSrli)
+      u_iqs.append(u_iq)
+      u_rats.append(u_rat)
+      u_robs.append(u_rob)
+      u_fuses.append(u_fuse)
+    if self.physicalRegisters > 0:
+      m.submodules.u_prf = u_prf = PhysicalRegisterFile(registers=self.physicalRegisters,
+                                                        checkpoints=self.ratCheckpoints,
+                                                        writePorts=self.broadcastBuses + self.issueWidth,
+                                                        readPorts=2 * len(self.executionUnits))
+      self.u_prf = u_prf
+    else:
+      u_arfs = []
+      for t in range(self.threads):
+        m.submodules[named('u_arf', t)] = u_arf = ArchitecturalRegisterFile()
+        u_arfs.append(u_arf)
+      self.u_arfs = u_arfs
+      self.u_arf = u_arfs[0]
+    m.submodules.u_rs = u_rs = ReservationStation(units=self.executionUnits,
+                                                  broadcastBuses=self.broadcastBuses,
+                                                  latencies=self.latencies,
+                                                  wakeups=len(self.executionUnits) + 1 if self.earlyWakeup else 0,
+                                                  selectPolicy=self.rsSelectPolicy,
+                                                  tagsOnly=self.physicalRegisters > 0,
+                                                  threads=self.threads,
+                                                  config=self.config)
+    u_eus = []
+    for idx, classes in enumerate(self.executionUnits):
+      if classes == (uOPClass.MUL,):
+        u_eu = Multiplier(latencies=self.latencies, threads=self.threads, config=self.config)
+      elif classes == (uOPClass.DIV,):
+        u_eu = Divider(latencies=self.latencies, threads=self.threads, config=self.config)
+      else:
+        u_eu = ExecutionUnit(classes=classes, latencies=self.latencies, threads=self.threads, config=self.config)
+      m.submodules['u_eu{}'.format(idx)] = u_eu
+      u_eus.append(u_eu)
+    m.submodules.u_lsq = u_lsq = LoadStoreQueue(broadcastBuses=self.broadcastBuses,
+                                                threads=self.threads,
+                                                forwarding=self.storeForwarding,
+                                                speculation=self.speculativeLoads,
+                                                storeSetBits=self.storeSetBits if self.speculativeLoads else 0,
+                                                config=self.config)
+    m.submodules.u_icache = u_icache = Cache(indexBits=self.config.icacheIndexBits,
+                                             offsetBits=self.config.icacheOffsetBits,
+                                             wideRead=self.rvc or self.fetchWidth == 2,
+                                             prefetch=self.icachePrefetchDepth > 0)
+    m.submodules.u_dec = u_dec = Decoder(rvm=self.rvm)
+    m.submodules.u_bp = u_bp = BranchPredictor(indexBits=self.bpIndexBits,
+                                               historyBits=self.bpHistoryBits,
+                                               threads=self.threads)
+    u_rass = []
+    for t in range(self.threads):
+      m.submodules[named('u_ras', t)] = u_ras = ReturnAddressStack(depth=self.rasDepth)
+      u_rass.append(u_ras)
+    m.submodules.u_itp = u_itp = IndirectTargetPredictor(indexBits=self.itpIndexBits)
 
     with m.If(u_lsq.o_wb_cyc):
       m.d.comb += [
@@ -83,495 +242,795 @@ class MyOoO(Elaboratable):
           u_icache.i_wb_ack.eq(self.i_wb_ack)
       ] # yapf: disable
 
-    broadcast = Signal(BroadcastBusTypeLayout)
-    m.d.comb += [u_rob.i_broadcast.eq(broadcast), u_rs.i_broadcast.eq(broadcast), u_lsq.i_broadcast.eq(broadcast)]
-
-    flush = Signal()
-    m.d.comb += [
-        flush.eq(0),  # XXX: Is this needed or are unassigned comb signals 0 by default? Need to check the spec!!!
-        u_iq.i_flush_en.eq(flush),
-        u_rob.i_flush_en.eq(flush),
-        u_rat.i_flush_en.eq(flush),
-        u_rs.i_flush_en.eq(flush),
-        u_eu.i_flush_en.eq(flush),
-        u_lsq.i_flush_en.eq(flush)
+    broadcasts = [
+        Signal(BroadcastBusTypeLayout(self.config), name='broadcast{}'.format(idx))
+        for idx in range(self.broadcastBuses)
     ]
+    for idx, broadcast in enumerate(broadcasts):
+      m.d.comb += [u_rob.i_broadcast[idx].eq(broadcast) for u_rob in u_robs]
+      m.d.comb += [u_rs.i_broadcast[idx].eq(broadcast), u_lsq.i_broadcast[idx].eq(broadcast)]
+
+    # The ROB entry that each broadcast is for (from the ROB partition of its thread).
+    if self.threads == 1:
+      broadcast_entries = u_robs[0].o_broadcast_entry
+    else:
+      broadcast_entries = []
+      for idx, broadcast in enumerate(broadcasts):
+        entry = Signal(ReOrderBufferEntryLayout(self.config), name='broadcast{}_entry'.format(idx))
+        with m.Switch(threadOf(broadcast.robIdx, self.threads)):
+          for t, u_rob in enumerate(u_robs):
+            with m.Case(t):
+              m.d.comb += entry.eq(u_rob.o_broadcast_entry[idx])
+        broadcast_entries.append(entry)
+
+    # With a physical register file results are written to the register allocated to rd at rename (the results of
+    # branches only go to the ROB and JALR link registers are written at rename). The RS reads the operands of the uOPs
+    # it dispatches from it.
+    if self.physicalRegisters > 0:
+      for idx, (broadcast, entry) in enumerate(zip(broadcasts, broadcast_entries)):
+        m.d.comb += [
+            u_prf.i_wr_en[idx].eq(broadcast.valid & (entry.type == ROBType.OTHER) & (entry.rd != 0)),
+            u_prf.i_wr_idx[idx].eq(entry.preg),
+            u_prf.i_wr_data[idx].eq(broadcast.data)
+        ]
+      for rs_idx, rs_data, prf_idx, prf_data in zip(u_rs.o_read_idx, u_rs.i_read_data, u_prf.i_read_idx,
+                                                    u_prf.o_read_data):
+        m.d.comb += [prf_idx.eq(rs_idx), rs_data.eq(prf_data)]
+
+    # Squash everything of a thread younger than its mispredicted branch (see branch resolution below). The shared units
+    # have a squash port per thread.
+    squash = [Signal(name=named('squash', t)) for t in range(self.threads)]
+    squash_robidx = [Signal(self.config.robIdxBits, name=named('squash_robidx', t)) for t in range(self.threads)]
+    # A load replayed by the LSQ squashes everything after it when it commits (see commit and branch resolution).
+    replay = [Signal(name=named('replay', t)) for t in range(self.threads)]
+    for t, (u_iq, u_rat, u_rob) in enumerate(zip(u_iqs, u_rats, u_robs)):
+      m.d.comb += [
+          u_iq.i_flush_en.eq(squash[t]),
+          u_rob.i_squash_en.eq(squash[t]),
+          u_rob.i_squash_robidx.eq(squash_robidx[t]),
+          u_rob.i_replay_en.eq(u_lsq.o_replay_en[t]),
+          u_rob.i_replay_robidx.eq(u_lsq.o_replay_robidx[t]),
+          u_rat.i_head_robidx.eq(u_rob.o_commit_robidx)
+      ]
+      for u_unit in [u_rs, u_lsq] + u_eus:
+        m.d.comb += [
+            u_unit.i_squash_en[t].eq(squash[t]),
+            u_unit.i_squash_robidx[t].eq(squash_robidx[t]),
+            u_unit.i_head_robidx[t].eq(u_rob.o_commit_robidx)
+        ]
 
     #
     # FETCH
     #
-    PC = Signal(32)
-    m.d.comb += [u_icache.i_cpu_addr.eq(PC), u_icache.i_cpu_valid.eq(1)]
-    fetch_b = Signal(BTypeInstrTypeLayout)
-    m.d.comb += fetch_b.eq(u_icache.o_cpu_data)
-    fetch_j = Signal(JTypeInstrTypeLayout)
-    m.d.comb += fetch_j.eq(u_icache.o_cpu_data)
-    with m.If(u_icache.o_cpu_rdy & u_iq.o_w_rdy & ~flush):
-      m.d.comb += [u_iq.i_w_data.instr.eq(u_icache.o_cpu_data), u_iq.i_w_data.pc.eq(PC), u_iq.i_w_en.eq(1)]
-      with m.Switch(fetch_b.opcode):
-        with m.Case(RV32I_OP_BRANCH):
-          # XXX: For now predict all branches as taken.
-          m.d.sync += PC.eq(
-              PC +
-              Cat(Const(0, unsigned(1)), fetch_b.imm_4_1, fetch_b.imm_10_5, fetch_b.imm_11, fetch_b.imm_12).as_signed())
-        with m.Case(RV32I_OP_JAL):
-          m.d.sync += PC.eq(PC + Cat(Const(0, unsigned(1)), fetch_j.imm_10_1, fetch_j.imm_11, fetch_j.imm_19_12,
-                                     fetch_j.imm_20).as_signed())
-        with m.Default():
-          m.d.sync += PC.eq(PC + 4)
-
+    # The word holding PC and the one after it are read from the I-cache (or the loop buffer) and instructions are
+    # extracted from them. With rvc instructions may be compressed (and 16-bit aligned). An instruction that straddles
+    # the end of a cache line is handled by holding its first half (fetch_hw) while the next word is read.
     #
-    # ISSUE
+    # With fetchWidth == 2 the instruction following the first one is also fetched if it is available, the first one
+    # falls through and there is room for both in the IQ. The first slot must not be a jump so that only one slot
+    # updates the RAS per cycle.
     #
+    # With several threads one of them is fetched from in each cycle (see fetch policy below). PC, fetch_hw and
+    # fetch_hw_valid are then those of that thread and the instructions are written to its IQ.
+    fetch_thread = Signal(range(self.threads))
+    pcs = [Signal(32, reset=self.resetPcs[t], name=named('PC', t)) for t in range(self.threads)]
+    fetch_hws = [Signal(16, name=named('fetch_hw', t)) for t in range(self.threads)]
+    fetch_hw_valids = [Signal(name=named('fetch_hw_valid', t)) for t in range(self.threads)]
 
-    jalr_ongoing = Signal()
-    jalr_a = Signal(32)
-    jalr_b = Signal()
-    jalr_c = Signal(3)
-
-    # Feed IQ from outside.
-    instr_r = Signal(RTypeInstrTypeLayout)
-    m.d.comb += instr_r.eq(u_iq.o_r_data.instr)
-    instr_u = Signal(UTypeInstrTypeLayout)
-    m.d.comb += instr_u.eq(u_iq.o_r_data.instr)
-    instr_i = Signal(ITypeInstrTypeLayout)
-    m.d.comb += instr_i.eq(u_iq.o_r_data.instr)
-    instr_s = Signal(STypeInstrTypeLayout)
-    m.d.comb += instr_s.eq(u_iq.o_r_data.instr)
-    instr_b = Signal(BTypeInstrTypeLayout)
-    m.d.comb += instr_b.eq(u_iq.o_r_data.instr)
-    instr_j = Signal(JTypeInstrTypeLayout)
-    m.d.comb += instr_j.eq(u_iq.o_r_data.instr)
+    def fetched(signals):
+      return signals[0] if self.threads == 1 else Array(signals)[fetch_thread]
 
-    m.d.comb += [
-        u_rob.i_alloc_rd.eq(instr_r.rd),
-        u_rob.i_alloc_pc.eq(u_iq.o_r_data.pc),
-        u_rob.i_alloc_type.eq(ROBType.OTHER),
-        u_rs.i_issue.opcode.eq(instr_r.opcode),
-        u_rs.i_issue.robIdx.eq(u_rob.o_alloc_idx),
-    ]
+    PC = fetched(pcs)
+    fetch_hw = fetched(fetch_hws)
+    fetch_hw_valid = fetched(fetch_hw_valids)
+    fetch_squash = fetched(squash)  # Nothing is fetched from a thread that squashes (its PC is redirected).
+    iq_w_rdy = Signal()
+    iq_w_data = Signal(InstructionQueueEntryLayout)
+    iq_w_en = Signal()
+    iq_w2_rdy = Signal()
+    iq_w2_data = Signal(InstructionQueueEntryLayout)
+    iq_w2_en = Signal()
+    for t, u_iq in enumerate(u_iqs):
+      m.d.comb += [
+          u_iq.i_w_data.eq(iq_w_data),
+          u_iq.i_w_en.eq(iq_w_en & (fetch_thread == t)),
+          u_iq.i_w2_data.eq(iq_w2_data),
+          u_iq.i_w2_en.eq(iq_w2_en & (fetch_thread == t))
+      ]
+      with m.If(fetch_thread == t):
+        m.d.comb += [iq_w_rdy.eq(u_iq.o_w_rdy), iq_w2_rdy.eq(u_iq.o_w2_rdy)]
+
+    # Fetch predicts with the RAS and the branch history of the thread fetched from.
+    ras_top = fetched([u_ras.o_top for u_ras in u_rass])
+    ras_tos = fetched([u_ras.o_tos for u_ras in u_rass])
+    ras_push_en = Signal()
+    ras_push_addr = Signal(32)
+    ras_pop_en = Signal()
+    for t, u_ras in enumerate(u_rass):
+      m.d.comb += [
+          u_ras.i_push_en.eq(ras_push_en & (fetch_thread == t)),
+          u_ras.i_push_addr.eq(ras_push_addr),
+          u_ras.i_pop_en.eq(ras_pop_en & (fetch_thread == t))
+      ]
+    m.d.comb += u_bp.i_thread.eq(fetch_thread)
 
-    # Drive alloc port of RAT.
+    # Fetch policy. Threads that have halted (see commit), squash or have no room in their IQ are not fetched from. Of
+    # the others the one not fetched from in the previous cycle is picked ('roundrobin') or the one with the fewest
+    # instructions waiting in its IQ and in the RS ('icount', ties are broken round robin). A thread that could not be
+    # fetched from in the previous cycle (an I-cache miss) is kept so that the line it waits for is not evicted by the
+    # other thread before it has been read.
+    halted = [Signal(name=named('halted', t)) for t in range(self.threads)]
+    if self.threads > 1:
+      last = Signal(range(self.threads))
+      fetchable = [~h & ~q & u_iq.o_w_rdy for h, q, u_iq in zip(halted, squash, u_iqs)]
+      turn = last == 0
+      if self.fetchPolicy == 'icount':
+        counts = [u_iq.o_count + u_rs.o_count[t] for t, u_iq in enumerate(u_iqs)]
+        turn = (counts[1] < counts[0]) | ((counts[1] == counts[0]) & turn)
+      pending = Signal()
+      m.d.comb += fetch_thread.eq(Mux(pending & Array(fetchable)[last], last, fetchable[1] & (~fetchable[0] | turn)))
+      m.d.sync += [last.eq(fetch_thread), pending.eq(Array(fetchable)[fetch_thread] & ~iq_w_en & ~fetch_squash)]
+
+    fetch_addr = Signal(32)
     m.d.comb += [
-        u_rat.i_alloc_idx.eq(instr_r.rd),  # Map rd rd robidx
-        u_rat.i_alloc_robidx.eq(u_rob.o_alloc_idx),
-        u_rob.i_rd1_idx.eq(u_rat.o_rd1_robidx),
-        u_rob.i_rd2_idx.eq(u_rat.o_rd2_robidx)
+        fetch_addr.eq(Mux(fetch_hw_valid, PC + 2, PC)),
+        u_icache.i_cpu_addr.eq(fetch_addr),
+        u_bp.i_predict_pc.eq(PC),
+        u_itp.i_predict_pc.eq(PC)
     ]
 
-    with m.Switch(instr_r.opcode):
-      with m.Case(RV32I_OP_LUI):
-        m.d.comb += [
-            u_rs.i_issue.rs1Value.eq(instr_u.imm << 12),
-            u_rs.i_issue.rs2Value.eq(0),
-            u_rs.i_issue.rs1ValueValid.eq(1),
-            u_rs.i_issue.rs2ValueValid.eq(1),
-            u_rs.i_issue.rs1RobIdx.eq(0),
-            u_rs.i_issue.rs2RobIdx.eq(0),
-            u_rob.i_alloc_rd.eq(instr_u.rd)
-        ]
-        m.d.comb += u_rs.i_issue.opcode.eq(uOPOpcode.LUI)
+    def fetchExpand(name, raw):
+      # Return the (possibly expanded) instruction starting at the bottom of raw and if it was compressed.
+      instr = Signal(32, name=name + '_instr')
+      rvc = Signal(name=name + '_rvc')
+      if self.rvc:
+        m.submodules[name + '_exp'] = exp = CompressedExpander()
+        m.d.comb += [exp.i_instr.eq(raw[0:16]), rvc.eq(isCompressed(raw)), instr.eq(Mux(rvc, exp.o_instr, raw))]
+      else:
+        m.d.comb += instr.eq(raw)
+      return instr, rvc
+
+    def fetchSlot(name, pc, instr, rvc, bp_taken, itp_hit, itp_target):
+      # Predict the PC following instr (fetched from pc).
+      b = Signal(BTypeInstrTypeLayout, name=name + '_b')
+      j = Signal(JTypeInstrTypeLayout, name=name + '_j')
+      i = Signal(ITypeInstrTypeLayout, name=name + '_i')
+      m.d.comb += [b.eq(instr), j.eq(instr), i.eq(instr)]
+      ras_push, ras_pop = rasPushPop(i.opcode, i.rd, i.rs1)
+      fallthrough = pc + Mux(rvc, 2, 4)
+      npc = Signal(32, name=name + '_npc')
+      with m.Switch(b.opcode):
+        with m.Case(RV32I_OP_BRANCH):
+          with m.If(bp_taken):
+            m.d.comb += npc.eq(pc + Cat(Const(0, unsigned(1)), b.imm_4_1, b.imm_10_5, b.imm_11, b.imm_12).as_signed())
+          with m.Else():
+            m.d.comb += npc.eq(fallthrough)
+        with m.Case(RV32I_OP_JAL):
+          m.d.comb += npc.eq(pc + Cat(Const(0, unsigned(1)), j.imm_10_1, j.imm_11, j.imm_19_12, j.imm_20).as_signed())
+        with m.Case(RV32I_OP_JALR):
+          # Returns are predicted by the RAS, other indirect jumps by the target table (or fall through on miss).
+          with m.If(ras_pop):
+            m.d.comb += npc.eq(ras_top)
+          with m.Elif(itp_hit):
+            m.d.comb += npc.eq(itp_target)
+          with m.Else():
+            m.d.comb += npc.eq(fallthrough)
+        with m.Default():
+          m.d.comb += npc.eq(fallthrough)
+      return b, npc, ras_push, ras_pop
 
-        with m.If(u_iq.o_r_rdy & ~flush & u_rob.o_alloc_rdy & u_rs.o_issue_rdy):
+    def fetchWrite(w_data, uop, pc, npc, rvc, history, b, ras_push, ras_pop, bp_predict_en):
+      m.d.comb += [
+          w_data.uop.eq(uop),
+          w_data.pc.eq(pc),
+          w_data.pred.npc.eq(npc),
+          w_data.pred.bpHistory.eq(history),
+          w_data.pred.rasTos.eq(ras_tos)
+      ]
+      with m.Switch(b.opcode):
+        with m.Case(RV32I_OP_BRANCH):
+          m.d.comb += bp_predict_en.eq(1)
+        with m.Case(RV32I_OP_JAL, RV32I_OP_JALR):
           m.d.comb += [
-              u_iq.i_r_en.eq(1),  # Consume the IQ entry.
-              u_rs.i_issue_en.eq(1),  # Strobe RS to add issue.
-              u_rob.i_alloc_en.eq(1),  # Strobe ROB to allocate entry.
-              u_rat.i_alloc_en.eq(1)  # Strobe RAT to allocate entry.
+              ras_push_en.eq(ras_push),
+              ras_pop_en.eq(ras_pop),
+              ras_push_addr.eq(pc + Mux(rvc, 2, 4))
           ]
 
-      with m.Case(RV32I_OP_AUIPC):
+    if self.icachePrefetchDepth > 0:
+      m.submodules.u_pf = u_pf = StreamPrefetcher(depth=self.icachePrefetchDepth,
+                                                  offsetBits=self.config.icacheOffsetBits)
+      m.d.comb += [
+          u_pf.i_fetch_addr.eq(fetch_addr),
+          u_icache.i_pf_addr.eq(u_pf.o_pf_addr),
+          u_icache.i_pf_valid.eq(u_pf.o_pf_valid),
+          u_pf.i_pf_rdy.eq(u_icache.o_pf_rdy)
+      ]
+
+    # Instructions come from the loop buffer if it holds fetch_addr, otherwise from the I-cache (which is then not
+    # accessed).
+    fetch_rdy = Signal()
+    fetch_data = Signal(32)
+    fetch_rdy2 = Signal()
+    fetch_data2 = Signal(32)
+    m.d.comb += [
+        u_icache.i_cpu_valid.eq(1),
+        fetch_rdy.eq(u_icache.o_cpu_rdy),
+        fetch_data.eq(u_icache.o_cpu_data),
+        fetch_rdy2.eq(u_icache.o_cpu_rdy2),
+        fetch_data2.eq(u_icache.o_cpu_data2)
+    ]
+    if self.loopBufferDepth > 0:
+      m.submodules.u_lb = u_lb = LoopBuffer(depth=self.loopBufferDepth)
+      m.d.comb += [
+          u_lb.i_pc.eq(fetch_addr),
+          u_lb.i_capture_en.eq(u_icache.o_cpu_rdy),
+          u_lb.i_capture_data.eq(u_icache.o_cpu_data),
+          u_lb.i_capture2_en.eq(u_icache.o_cpu_rdy2),
+          u_lb.i_capture2_data.eq(u_icache.o_cpu_data2)
+      ]
+      with m.If(u_lb.o_hit):
         m.d.comb += [
-            u_rs.i_issue.rs1Value.eq(instr_u.imm << 12),
-            u_rs.i_issue.rs2Value.eq(u_iq.o_r_data.pc),
-            u_rs.i_issue.rs1ValueValid.eq(1),
-            u_rs.i_issue.rs2ValueValid.eq(1),
-            u_rs.i_issue.rs1RobIdx.eq(0),
-            u_rs.i_issue.rs2RobIdx.eq(0),
-            u_rob.i_alloc_rd.eq(instr_u.rd)
+            u_icache.i_cpu_valid.eq(0),
+            fetch_rdy.eq(1),
+            fetch_data.eq(u_lb.o_data),
+            fetch_rdy2.eq(u_lb.o_hit2),
+            fetch_data2.eq(u_lb.o_data2)
         ]
-        m.d.comb += u_rs.i_issue.opcode.eq(uOPOpcode.ADD)
 
-        with m.If(u_iq.o_r_rdy & ~flush & u_rob.o_alloc_rdy & u_rs.o_issue_rdy):
-          m.d.comb += [
-              u_iq.i_r_en.eq(1),  # Consume the IQ entry.
-              u_rs.i_issue_en.eq(1),  # Strobe RS to add issue.
-              u_rob.i_alloc_en.eq(1),  # Strobe ROB to allocate entry.
-              u_rat.i_alloc_en.eq(1)  # Strobe RAT to allocate entry.
-          ]
-
-      with m.Case(RV32I_OP_JAL):
+    # The instruction bytes from PC onwards (and how many halfwords of them are valid).
+    fetch_window = Signal(64)
+    fetch_avail = Signal(range(5))
+    if self.rvc:
+      with m.If(fetch_hw_valid):
         m.d.comb += [
-            u_rs.i_issue.rs1Value.eq(4),
-            u_rs.i_issue.rs2Value.eq(u_iq.o_r_data.pc),
-            u_rs.i_issue.rs1ValueValid.eq(1),
-            u_rs.i_issue.rs2ValueValid.eq(1),
-            u_rs.i_issue.rs1RobIdx.eq(0),
-            u_rs.i_issue.rs2RobIdx.eq(0),
-            u_rob.i_alloc_rd.eq(instr_j.rd)
+            fetch_window.eq(Cat(fetch_hw, fetch_data, fetch_data2[0:16])),
+            fetch_avail.eq(Mux(fetch_rdy, Mux(fetch_rdy2, 4, 3), 1))
         ]
-        m.d.comb += u_rs.i_issue.opcode.eq(uOPOpcode.ADD)
-
-        with m.If(u_iq.o_r_rdy & ~flush & u_rob.o_alloc_rdy & u_rs.o_issue_rdy):
-          m.d.comb += [
-              u_iq.i_r_en.eq(1),  # Consume the IQ entry.
-              u_rs.i_issue_en.eq(1),  # Strobe RS to add issue.
-              u_rob.i_alloc_en.eq(1),  # Strobe ROB to allocate entry.
-              u_rat.i_alloc_en.eq(1)  # Strobe RAT to allocate entry.
-          ]
-
-      with m.Case(RV32I_OP_JALR):
-        # Use rs1 to index both RAT and ARF.
+      with m.Elif(PC[1]):
         m.d.comb += [
-            u_arf.i_rd1_idx.eq(instr_i.rs1),
-            u_rat.i_rd1_idx.eq(instr_i.rs1),
+            fetch_window.eq(Cat(fetch_data[16:32], fetch_data2)),
+            fetch_avail.eq(Mux(fetch_rdy, Mux(fetch_rdy2, 3, 1), 0))
         ]
-        with m.If(~jalr_ongoing):
+      with m.Else():
+        m.d.comb += [
+            fetch_window.eq(Cat(fetch_data, fetch_data2)),
+            fetch_avail.eq(Mux(fetch_rdy, Mux(fetch_rdy2, 4, 2), 0))
+        ]
+    else:
+      m.d.comb += [
+          fetch_window.eq(Cat(fetch_data, fetch_data2)),
+          fetch_avail.eq(Mux(fetch_rdy, Mux(fetch_rdy2, 4, 2), 0))
+      ]
+
+    fetch_instr, fetch_rvc = fetchExpand('fetch', fetch_window[0:32])
+    fetch_ok = Signal()
+    m.d.comb += fetch_ok.eq(fetch_avail >= Mux(fetch_rvc, 1, 2))
+    fetch_b, fetch_npc, fetch_ras_push, fetch_ras_pop = fetchSlot('fetch', PC, fetch_instr, fetch_rvc,
+                                                                  u_bp.o_predict_taken, u_itp.o_predict_hit,
+                                                                  u_itp.o_predict_target)
+    m.d.comb += [u_dec.i_instr.eq(fetch_instr), u_dec.i_rvc.eq(fetch_rvc)]
+    if self.fetchWidth == 2:
+      fetch2_pc = Signal(32)
+      m.d.comb += [
+          fetch2_pc.eq(PC + Mux(fetch_rvc, 2, 4)),
+          u_bp.i_predict2_pc.eq(fetch2_pc),
+          u_itp.i_predict2_pc.eq(fetch2_pc)
+      ]
+      fetch2_instr, fetch2_rvc = fetchExpand('fetch2', Mux(fetch_rvc, fetch_window[16:48], fetch_window[32:64]))
+      m.submodules.u_dec2 = u_dec2 = Decoder(rvm=self.rvm)
+      m.d.comb += [u_dec2.i_instr.eq(fetch2_instr), u_dec2.i_rvc.eq(fetch2_rvc)]
+      fetch2_b, fetch2_npc, fetch2_ras_push, fetch2_ras_pop = fetchSlot('fetch2', fetch2_pc, fetch2_instr, fetch2_rvc,
+                                                                        u_bp.o_predict2_taken, u_itp.o_predict2_hit,
+                                                                        u_itp.o_predict2_target)
+      fetch2 = Signal()
+      m.d.comb += fetch2.eq((fetch_avail >= Mux(fetch_rvc, 1, 2) + Mux(fetch2_rvc, 1, 2)) & iq_w2_rdy
+                            & (fetch_npc == fetch2_pc) & (fetch_b.opcode != RV32I_OP_JAL)
+                            & (fetch_b.opcode != RV32I_OP_JALR))
+
+    def fetchLoop(pc, npc, b):
+      # A backward taken branch (re)starts capture of the loop body.
+      with m.If((b.opcode == RV32I_OP_BRANCH) & (npc < pc)):
+        m.d.comb += [u_lb.i_loop_en.eq(1), u_lb.i_loop_pc.eq(pc), u_lb.i_loop_target.eq(npc)]
+
+    with m.If(fetch_ok & iq_w_rdy & ~fetch_squash):
+      fetchWrite(iq_w_data, u_dec.o_uop, PC, fetch_npc, fetch_rvc, u_bp.o_history, fetch_b, fetch_ras_push,
+                 fetch_ras_pop, u_bp.i_predict_en)
+      m.d.comb += iq_w_en.eq(1)
+      m.d.sync += [PC.eq(fetch_npc), fetch_hw_valid.eq(0)]
+      if self.loopBufferDepth > 0:
+        fetchLoop(PC, fetch_npc, fetch_b)
+      if self.fetchWidth == 2:
+        with m.If(fetch2):
+          fetchWrite(iq_w2_data, u_dec2.o_uop, fetch2_pc, fetch2_npc, fetch2_rvc, u_bp.o_history2, fetch2_b,
+                     fetch2_ras_push, fetch2_ras_pop, u_bp.i_predict2_en)
+          m.d.comb += iq_w2_en.eq(1)
+          m.d.sync += PC.eq(fetch2_npc)
+          if self.loopBufferDepth > 0:
+            fetchLoop(fetch2_pc, fetch2_npc, fetch2_b)
+    with m.Elif(~fetch_hw_valid & (fetch_avail == 1) & ~fetch_rvc & ~fetch_squash):
+      # First half of an instruction that continues in the next cache line.
+      m.d.sync += [fetch_hw.eq(fetch_window[0:16]), fetch_hw_valid.eq(1)]
+
+    for t in range(self.threads):
+      with m.If(squash[t]):
+        m.d.sync += fetch_hw_valids[t].eq(0)
+
+    #
+    # ISSUE
+    #
+    # Every thread renames and issues from its own IQ. The RS and the LSQ have two issue ports, used by the two
+    # instructions of an issue group or by the two threads, and the second one takes the entry after the one taken by
+    # the first (if it is used).
+    rs_ports = [(u_rs.i_issue, u_rs.i_issue_en, u_rs.o_issue_rdy),
+                (u_rs.i_issue2, u_rs.i_issue2_en, Mux(u_rs.i_issue_en, u_rs.o_issue2_rdy, u_rs.o_issue_rdy))]
+    lsq_ports = [(u_lsq.i_issue, u_lsq.i_issue_en, u_lsq.o_issue_rdy, u_lsq.o_issue_idx),
+                 (u_lsq.i_issue2, u_lsq.i_issue2_en, Mux(u_lsq.i_issue_en, u_lsq.o_issue2_rdy, u_lsq.o_issue_rdy),
+                  u_lsq.o_issue2_idx)]
+
+    def issueThread(t):
+      u_iq, u_fuse, u_rat, u_rob = u_iqs[t], u_fuses[t], u_rats[t], u_robs[t]
+      u_arf = u_arfs[t] if self.physicalRegisters == 0 else None
+
+      # After a squash the RAT may map registers to squashed ROB entries. With checkpoints the RAT is restored in the
+      # same cycle (see branch resolution). Without, or when a replayed load squashes, rename is held off until the ROB
+      # has drained at which point every register lives in the ARF (or is committed to a physical register) and the RAT
+      # can simply be cleared. Nothing is issued by a thread that squashes (while the other one may issue, see the RS
+      # and LSQ) or that has halted.
+      rat_stale = Signal()
+      stall = Signal()
+      m.d.comb += stall.eq(squash[t] | rat_stale | halted[t])
+      with m.If(squash[t] if self.ratCheckpoints == 0 else replay[t]):
+        m.d.sync += rat_stale.eq(1)
+      with m.Elif(rat_stale & u_rob.o_empty):
+        m.d.comb += u_rat.i_flush_en.eq(1)
+        m.d.sync += rat_stale.eq(0)
+
+      # Feed IQ from outside. Every record is renamed the same way (unused operands and rd are x0). JALR is issued as
+      # a single BRANCH2 uOP, the link register (pc + 4) is known here and written to the ROB entry at allocation while
+      # the EU computes the target (rs1 + imm). If the two entries at the head of the IQ can be fused they are issued as
+      # one.
+      m.d.comb += [u_fuse.i_entry.eq(u_iq.o_r_data), u_fuse.i_entry2.eq(u_iq.o_r2_data)]
+      fuse = Signal()
+      m.d.comb += fuse.eq(u_iq.o_r2_rdy & u_fuse.o_fuse)
+      entry = Signal(InstructionQueueEntryLayout)
+      m.d.comb += entry.eq(Mux(fuse, u_fuse.o_entry, u_iq.o_r_data))
+      uop = Signal(DecodedInstrLayout)
+      m.d.comb += uop.eq(entry.uop)
+
+      def readOperand(name, reg, port, older):
+        # Read register reg from RAT/ROB/ARF (or RAT/PRF) through read port number port. An older instruction of the
+        # same issue group that writes reg takes precedence (its result is only available if known at rename).
+        rat_robidx = getattr(u_rat, 'o_rd{}_robidx'.format(port))
+        rat_valid = getattr(u_rat, 'o_rd{}_valid'.format(port))
+        rat_preg = getattr(u_rat, 'o_rd{}_preg'.format(port))
+        value = Signal(32, name=name + '_value')
+        valid = Signal(name=name + '_valid')
+        robidx = Signal(self.config.robIdxBits, name=name + '_robidx')
+        preg = Signal(6, name=name + '_preg')
+        m.d.comb += [getattr(u_rat, 'i_rd{}_idx'.format(port)).eq(reg), robidx.eq(rat_robidx), preg.eq(rat_preg)]
+        if self.physicalRegisters > 0:
+          # The value is valid once written to the physical register (whether committed or not).
           m.d.comb += [
-              u_rs.i_issue.rs1Value.eq(4),
-              u_rs.i_issue.rs2Value.eq(u_iq.o_r_data.pc),
-              u_rs.i_issue.rs1ValueValid.eq(1),
-              u_rs.i_issue.rs2ValueValid.eq(1),
-              u_rs.i_issue.rs1RobIdx.eq(0),
-              u_rs.i_issue.rs2RobIdx.eq(0),
-              u_rob.i_alloc_rd.eq(instr_i.rd)
+              getattr(u_prf, 'i_rd{}_idx'.format(port)).eq(rat_preg),
+              value.eq(getattr(u_prf, 'o_rd{}_data'.format(port))),
+              valid.eq(getattr(u_prf, 'o_rd{}_ready'.format(port)))
           ]
-          m.d.comb += u_rs.i_issue.opcode.eq(uOPOpcode.ADD)
-          m.d.sync += [
-              jalr_a.eq(Mux(u_rat.o_rd1_valid, u_rob.o_rd1_data, u_arf.o_rd1_data)),
-              jalr_b.eq(~u_rat.o_rd1_valid | u_rob.o_rd1_valid),
-              jalr_c.eq(u_rat.o_rd1_robidx)
-          ]
-          # Override if broadcast
-          with m.If(broadcast.valid & ~(~u_rat.o_rd1_valid | u_rob.o_rd1_valid)
-                    & (u_rat.o_rd1_robidx == broadcast.robIdx)):
-            m.d.sync += [jalr_a.eq(broadcast.data), jalr_b.eq(1)]
-        with m.Else():
+        else:
+          arf_data = getattr(u_arf, 'o_rd{}_data'.format(port))
+          rob_data = getattr(u_rob, 'o_rd{}_data'.format(port))
+          rob_valid = getattr(u_rob, 'o_rd{}_valid'.format(port))
           m.d.comb += [
-              u_rs.i_issue.rs1Value.eq(jalr_a),
-              u_rs.i_issue.rs1ValueValid.eq(jalr_b),
-              u_rs.i_issue.rs2Value.eq(instr_i.imm.as_signed()),
-              u_rs.i_issue.rs2ValueValid.eq(1),
-              u_rs.i_issue.rs1RobIdx.eq(jalr_c),
-              u_rs.i_issue.rs2RobIdx.eq(0),
-              u_rob.i_alloc_type.eq(ROBType.BRANCH2),
-              u_rob.i_alloc_rd.eq(0)
+              getattr(u_arf, 'i_rd{}_idx'.format(port)).eq(reg),
+              getattr(u_rob, 'i_rd{}_idx'.format(port)).eq(rat_robidx),
+              value.eq(Mux(rat_valid, rob_data, arf_data)),
+              valid.eq(~rat_valid | rob_valid)
           ]
-          m.d.comb += u_rs.i_issue.opcode.eq(uOPOpcode.ADD)
-          # Override if broadcast
-          with m.If(broadcast.valid & ~jalr_b & (jalr_c == broadcast.robIdx)):
-            m.d.sync += [jalr_a.eq(broadcast.data), jalr_b.eq(1)]
+        for o_rd, o_robidx, o_preg, o_done, o_value in older:
+          with m.If((o_rd != 0) & (o_rd == reg)):
+            m.d.comb += [value.eq(o_value), valid.eq(o_done), robidx.eq(o_robidx), preg.eq(o_preg)]
+        return value, valid, robidx, preg
 
-        with m.If(u_iq.o_r_rdy & ~flush & u_rob.o_alloc_rdy & u_rs.o_issue_rdy):
-          m.d.sync += jalr_ongoing.eq(~jalr_ongoing)
-          m.d.comb += [
-              u_iq.i_r_en.eq(jalr_ongoing),  # Consume the IQ entry.
-              u_rs.i_issue_en.eq(1),  # Strobe RS to add issue.
-              u_rob.i_alloc_en.eq(1),  # Strobe ROB to allocate entry.
-              u_rat.i_alloc_en.eq(~jalr_ongoing)  # Strobe RAT to allocate entry.
-          ]
+      def issueSlot(name, entry, uop, ports, older, robidx, preg, lsqidx, rob_alloc, rs_issue, lsq_issue):
+        # Rename uop into ROB entry robidx (and physical register preg) and drive the ROB, RS and LSQ ports with it.
+        # Returns if the result is already known (eliminated) and the (rd, robidx, preg, done, value) seen by younger
+        # instructions of the same issue group.
+        rs1_value, rs1_valid, rs1_robidx, rs1_preg = readOperand(name + '_rs1', uop.rs1, ports[0], older)
+        rs2_value, rs2_valid, rs2_robidx, rs2_preg = readOperand(name + '_rs2', uop.rs2, ports[1], older)
 
-      with m.Case(RV32I_OP_IMM):
-        # Use rs1 to index both RAT and ARF.
+        # Drive issue port of RS. With a physical register file it only takes the constant operands (register ones are
+        # read at dispatch).
+        rs1_copy, rs2_copy = (0, 0) if self.physicalRegisters > 0 else (rs1_value, rs2_value)
         m.d.comb += [
-            u_arf.i_rd1_idx.eq(instr_i.rs1),
-            u_rat.i_rd1_idx.eq(instr_i.rs1),
+            rs_issue.opcode.eq(uop.opcode),
+            rs_issue.robIdx.eq(robidx),
+            rs_issue.rs1Value.eq(Mux(uop.op1Imm, uop.imm, rs1_copy)),
+            rs_issue.rs1ValueValid.eq(uop.op1Imm | rs1_valid),
+            rs_issue.rs1RobIdx.eq(rs1_robidx),
+            rs_issue.rs2Value.eq(Mux(uop.op2Pc, entry.pc, Mux(uop.op2Imm, uop.imm, rs2_copy))),
+            rs_issue.rs2ValueValid.eq(uop.op2Pc | uop.op2Imm | rs2_valid),
+            rs_issue.rs2RobIdx.eq(rs2_robidx),
+            rs_issue.rs1Reg.eq(~uop.op1Imm),
+            rs_issue.rs2Reg.eq(~uop.op2Pc & ~uop.op2Imm),
+            rs_issue.rs1Preg.eq(rs1_preg),
+            rs_issue.rs2Preg.eq(rs2_preg),
+            rs_issue.rvc.eq(uop.rvc),
+            rs_issue.imm.eq(uop.imm[1:13])
         ]
-        # Drive issue port of RS.
+
+        # Drive issue port of LSQ.
         m.d.comb += [
-            u_rs.i_issue.rs1Value.eq(Mux(u_rat.o_rd1_valid, u_rob.o_rd1_data, u_arf.o_rd1_data)),
-            u_rs.i_issue.rs2Value.eq(instr_i.imm.as_signed()),
-            u_rs.i_issue.rs1ValueValid.eq(~u_rat.o_rd1_valid | u_rob.o_rd1_valid),
-            u_rs.i_issue.rs2ValueValid.eq(1),
-            u_rs.i_issue.rs1RobIdx.eq(u_rat.o_rd1_robidx),
-            u_rob.i_alloc_rd.eq(instr_i.rd)
+            lsq_issue.type.eq(uop.lsqType),
+            lsq_issue.size.eq(uop.lsqSize),
+            lsq_issue.signed.eq(uop.lsqSigned),
+            lsq_issue.addr.eq(rs1_value),
+            lsq_issue.addr_valid.eq(rs1_valid),
+            lsq_issue.addr_robidx.eq(rs1_robidx),
+            lsq_issue.addr_offset.eq(uop.imm),
+            lsq_issue.data.eq(rs2_value),
+            lsq_issue.data_valid.eq(rs2_valid),
+            lsq_issue.data_robidx.eq(rs2_robidx),
+            lsq_issue.robidx.eq(robidx),
+            lsq_issue.pc.eq(entry.pc)
         ]
-        with m.Switch(instr_i.funct3):
-          with m.Case(0b000):  # ADDI
-            m.d.comb += u_rs.i_issue.opcode.eq(uOPOpcode.ADD)
-          with m.Case(0b010):  # SLTI
-            m.d.comb += u_rs.i_issue.opcode.eq(uOPOpcode.SLT)
-          with m.Case(0b011):  # SLTIU
-            m.d.comb += u_rs.i_issue.opcode.eq(uOPOpcode.SLTU)
-          with m.Case(0b100):  # XORI
-            m.d.comb += u_rs.i_issue.opcode.eq(uOPOpcode.XOR)
-          with m.Case(0b110):  # ORI
-            m.d.comb += u_rs.i_issue.opcode.eq(uOPOpcode.OR)
-          with m.Case(0b111):  # ANDI
-            m.d.comb += u_rs.i_issue.opcode.eq(uOPOpcode.AND)
-          with m.Case(0b001):  # SLLI
-            m.d.comb += u_rs.i_issue.opcode.eq(uOPOpcode.SLL)
-          with m.Case(0b101):  # SRLI or SRAI
-            with m.If(instr_i.imm[10]):
-              m.d.comb += u_rs.i_issue.opcode.eq(uOPOpcode.SRA)
-            with m.Else():
-              m.d.comb += u_rs.i_issue.opcode.eq(uOPOpcode.SRL)
-
-        with m.If(u_iq.o_r_rdy & ~flush & u_rob.o_alloc_rdy & u_rs.o_issue_rdy):
-          m.d.comb += [
-              u_iq.i_r_en.eq(1),  # Consume the IQ entry.
-              u_rs.i_issue_en.eq(1),  # Strobe RS to add issue.
-              u_rob.i_alloc_en.eq(1),  # Strobe ROB to allocate entry.
-              u_rat.i_alloc_en.eq(1)  # Strobe RAT to allocate entry.
-          ]
 
-      with m.Case(RV32I_OP_OP):
-        # Use rs1 and rs2 to index both RAT and ARF.
+        # Rename resolves instructions whose result it already knows (constants, moves of available values and zero
+        # idioms). Their ROB entry is allocated as done so they take no RS entry, EU slot or broadcast.
+        eliminate = Signal(name=name + '_eliminate')
+        eliminate_value = Signal(32, name=name + '_eliminate_value')
+        if self.renameElimination:
+          op2_zero = Mux(uop.op2Imm, uop.imm == 0, uop.rs2 == 0) & ~uop.op2Pc
+          op2_value = Mux(uop.op2Imm, uop.imm, rs2_value)
+          op2_valid = uop.op2Imm | rs2_valid
+          op2_same = ~uop.op2Imm & ~uop.op2Pc & (uop.rs2 == uop.rs1)
+          with m.If((uop.unit == IssueUnit.RS) & (uop.robType == ROBType.OTHER)):
+            with m.Switch(uop.opcode):
+              with m.Case(uOPOpcode.LUI):
+                m.d.comb += [eliminate.eq(1), eliminate_value.eq(uop.imm)]
+              with m.Case(uOPOpcode.ADD, uOPOpcode.OR, uOPOpcode.XOR):
+                with m.If(uop.op1Imm & uop.op2Pc):  # AUIPC and JAL
+                  m.d.comb += [eliminate.eq(1), eliminate_value.eq(uop.imm + entry.pc)]
+                with m.Elif((uop.opcode == uOPOpcode.XOR) & op2_same):
+                  m.d.comb += [eliminate.eq(1), eliminate_value.eq(0)]
+                with m.Elif(uop.rs1 == 0):
+                  m.d.comb += [eliminate.eq(op2_valid), eliminate_value.eq(op2_value)]
+                with m.Elif(op2_zero):
+                  m.d.comb += [eliminate.eq(rs1_valid), eliminate_value.eq(rs1_value)]
+              with m.Case(uOPOpcode.SUB):
+                with m.If(op2_same):
+                  m.d.comb += [eliminate.eq(1), eliminate_value.eq(0)]
+                with m.Elif(op2_zero):
+                  m.d.comb += [eliminate.eq(rs1_valid), eliminate_value.eq(rs1_value)]
+
+        # Drive alloc port of ROB.
         m.d.comb += [
-            u_arf.i_rd1_idx.eq(instr_r.rs1),
-            u_arf.i_rd2_idx.eq(instr_r.rs2),
-            u_rat.i_rd1_idx.eq(instr_r.rs1),
-            u_rat.i_rd2_idx.eq(instr_r.rs2)
+            rob_alloc.rd.eq(uop.rd),
+            rob_alloc.preg.eq(preg),
+            rob_alloc.pc.eq(entry.pc),
+            rob_alloc.rvc.eq(uop.rvc),
+            rob_alloc.type.eq(uop.robType),
+            rob_alloc.lsqidx.eq(lsqidx),
+            rob_alloc.pred.eq(entry.pred),
+            rob_alloc.ckpt.eq(u_rat.o_checkpoint_idx),
+            rob_alloc.rasPush.eq(uop.rasPush),
+            rob_alloc.rasPop.eq(uop.rasPop),
+            rob_alloc.done.eq(eliminate),
+            rob_alloc.rdValue.eq(Mux(uop.jalr, entry.pc + Mux(uop.rvc, 2, 4), eliminate_value))
         ]
-        # Drive issue port of RS.
+        return eliminate, (uop.rd, robidx, preg, eliminate | uop.jalr, rob_alloc.rdValue)
+
+      # With a physical register file every instruction that writes rd is allocated a register from its free list.
+      # Results known at rename are written to it right away (through the write ports following those of the buses).
+      def allocatePhysical(port, uop, eliminate, alloc_en, preg, value):
         m.d.comb += [
-            u_rs.i_issue.rs1Value.eq(Mux(u_rat.o_rd1_valid, u_rob.o_rd1_data, u_arf.o_rd1_data)),
-            u_rs.i_issue.rs2Value.eq(Mux(u_rat.o_rd2_valid, u_rob.o_rd2_data, u_arf.o_rd2_data)),
-            u_rs.i_issue.rs1ValueValid.eq(~u_rat.o_rd1_valid | u_rob.o_rd1_valid),
-            u_rs.i_issue.rs2ValueValid.eq(~u_rat.o_rd2_valid | u_rob.o_rd2_valid),
-            u_rs.i_issue.rs1RobIdx.eq(u_rat.o_rd1_robidx),
-            u_rs.i_issue.rs2RobIdx.eq(u_rat.o_rd2_robidx),
-            u_rob.i_alloc_rd.eq(instr_r.rd)
+            alloc_en.eq(uop.rd != 0),
+            u_prf.i_wr_en[self.broadcastBuses + port].eq((uop.rd != 0) & (eliminate | uop.jalr)),
+            u_prf.i_wr_idx[self.broadcastBuses + port].eq(preg),
+            u_prf.i_wr_data[self.broadcastBuses + port].eq(value)
         ]
 
-        with m.Switch(Cat(instr_r.funct3, instr_r.funct7)):
-          with m.Case(0b0000000_000):  # ADD
-            m.d.comb += u_rs.i_issue.opcode.eq(uOPOpcode.ADD)
-          with m.Case(0b0100000_000):  # SUB
-            m.d.comb += u_rs.i_issue.opcode.eq(uOPOpcode.SUB)
-          with m.Case(0b0000000_001):  # SLL
-            m.d.comb += u_rs.i_issue.opcode.eq(uOPOpcode.SLL)
-          with m.Case(0b0000000_010):  # SLT
-            m.d.comb += u_rs.i_issue.opcode.eq(uOPOpcode.SLT)
-          with m.Case(0b0000000_011):  # SLTU
-            m.d.comb += u_rs.i_issue.opcode.eq(uOPOpcode.SLTU)
-          with m.Case(0b0000000_100):  # XOR
-            m.d.comb += u_rs.i_issue.opcode.eq(uOPOpcode.XOR)
-          with m.Case(0b0000000_101):  # SRL
-            m.d.comb += u_rs.i_issue.opcode.eq(uOPOpcode.SRL)
-          with m.Case(0b0100000_101):  # SRA
-            m.d.comb += u_rs.i_issue.opcode.eq(uOPOpcode.SRA)
-          with m.Case(0b0000000_110):  # OR
-            m.d.comb += u_rs.i_issue.opcode.eq(uOPOpcode.OR)
-          with m.Case(0b0000000_111):  # AND
-            m.d.comb += u_rs.i_issue.opcode.eq(uOPOpcode.AND)
-
-        with m.If(u_iq.o_r_rdy & ~flush & u_rob.o_alloc_rdy & u_rs.o_issue_rdy):
-          m.d.comb += [
-              u_iq.i_r_en.eq(1),  # Consume the IQ entry.
-              u_rs.i_issue_en.eq(1),  # Strobe RS to add issue.
-              u_rob.i_alloc_en.eq(1),  # Strobe ROB to allocate entry.
-              u_rat.i_alloc_en.eq(1)  # Strobe RAT to allocate entry.
-          ]
+      if self.physicalRegisters > 0:
+        preg, preg_rdy = u_prf.o_alloc_idx, (uop.rd == 0) | u_prf.o_alloc_rdy
+      else:
+        preg, preg_rdy = 0, 1
+      rs_issue, rs_issue_en, rs_issue_rdy = rs_ports[t]
+      lsq_issue, lsq_issue_en, lsq_issue_rdy, lsq_issue_idx = lsq_ports[t]
+      eliminate, result = issueSlot('issue', entry, uop, [1, 2], [], u_rob.o_alloc_idx, preg, lsq_issue_idx,
+                                    u_rob.i_alloc, rs_issue, lsq_issue)
+      m.d.comb += [
+          u_rat.i_alloc_idx.eq(uop.rd),
+          u_rat.i_alloc_robidx.eq(u_rob.o_alloc_idx),
+          u_rat.i_alloc_preg.eq(preg)
+      ]
 
-      with m.Case(RV32I_OP_LOAD):
-        # Use rs1 to index both RAT and ARF.
-        m.d.comb += [u_arf.i_rd1_idx.eq(instr_i.rs1), u_rat.i_rd1_idx.eq(instr_i.rs1)]
-        # Drive issue port of LSQ.
-        m.d.comb += [
-            u_lsq.i_issue.type.eq(LSQType.LOAD),
-            u_lsq.i_issue.addr.eq(Mux(u_rat.o_rd1_valid, u_rob.o_rd1_data, u_arf.o_rd1_data)),
-            u_lsq.i_issue.addr_valid.eq(~u_rat.o_rd1_valid | u_rob.o_rd1_valid),
-            u_lsq.i_issue.addr_robidx.eq(u_rat.o_rd1_robidx),
-            u_lsq.i_issue.addr_offset.eq(instr_i.imm),
-            u_lsq.i_issue.robidx.eq(u_rob.o_alloc_idx),
-            u_rob.i_alloc_rd.eq(instr_i.rd),
-        ]
+      # Branches take a RAT checkpoint (JALR including its link register mapping).
+      def needsCheckpoint(uop):
+        return (uop.robType == ROBType.BRANCH) | (uop.robType == ROBType.BRANCH2)
 
-        with m.Switch(instr_i.funct3):
-          with m.Case(0b000):  # BYTE
-            m.d.comb += [u_lsq.i_issue.size.eq(LSQSize.BYTE), u_lsq.i_issue.signed.eq(1)]
-          with m.Case(0b001):  # HALF
-            m.d.comb += [u_lsq.i_issue.size.eq(LSQSize.HALF), u_lsq.i_issue.signed.eq(1)]
-          with m.Case(0b010):  # WORD
-            m.d.comb += [u_lsq.i_issue.size.eq(LSQSize.WORD), u_lsq.i_issue.signed.eq(1)]
-          with m.Case(0b100):  # BYTE unsigned
-            m.d.comb += [u_lsq.i_issue.size.eq(LSQSize.BYTE), u_lsq.i_issue.signed.eq(0)]
-          with m.Case(0b101):  # HALF unsigned
-            m.d.comb += [u_lsq.i_issue.size.eq(LSQSize.HALF), u_lsq.i_issue.signed.eq(0)]
-
-        with m.If(u_iq.o_r_rdy & ~flush & u_rob.o_alloc_rdy & u_lsq.o_issue_rdy):
-          m.d.comb += [
-              u_iq.i_r_en.eq(1),  # Consume the IQ entry.
-              u_lsq.i_issue_en.eq(1),  # Strobe LSQ to add issue.
-              u_rob.i_alloc_en.eq(1),  # Strobe ROB to allocate entry.
-              u_rat.i_alloc_en.eq(1)  # Strobe RAT to allocate entry.
-          ]
+      checkpoint = Signal()
+      m.d.comb += checkpoint.eq(needsCheckpoint(uop))
+      unit_rdy = Mux(uop.unit == IssueUnit.LSQ, lsq_issue_rdy, eliminate | rs_issue_rdy)
 
-      with m.Case(RV32I_OP_STORE):
-        # Use rs1 to index both RAT and ARF.
+      issue = Signal()
+      m.d.comb += issue.eq(u_iq.o_r_rdy & uop.valid & ~stall & u_rob.o_alloc_rdy & unit_rdy & preg_rdy
+                           & (~checkpoint | u_rat.o_checkpoint_rdy))
+      with m.If(issue):
         m.d.comb += [
-            u_arf.i_rd1_idx.eq(instr_s.rs1),
-            u_rat.i_rd1_idx.eq(instr_s.rs1),
-            u_arf.i_rd2_idx.eq(instr_s.rs2),
-            u_rat.i_rd2_idx.eq(instr_s.rs2)
+            u_iq.i_r_en.eq(1),  # Consume the IQ entry.
+            u_iq.i_r2_en.eq(fuse),  # Consume the entry fused with it.
+            rs_issue_en.eq((uop.unit == IssueUnit.RS) & ~eliminate),  # Strobe RS to add issue.
+            lsq_issue_en.eq(uop.unit == IssueUnit.LSQ),  # Strobe LSQ to add issue.
+            u_rob.i_alloc_en.eq(1),  # Strobe ROB to allocate entry.
+            u_rat.i_alloc_en.eq(1),  # Strobe RAT to allocate entry.
+            u_rat.i_checkpoint_en.eq(checkpoint)  # Strobe RAT to checkpoint.
         ]
-        # Drive issue port of LSQ.
+        if self.physicalRegisters > 0:
+          allocatePhysical(0, uop, eliminate, u_prf.i_alloc_en, preg, u_rob.i_alloc.rdValue)
+
+      # With issueWidth == 2 the next IQ entry is issued together with the first one if there is room for both. A fused
+      # pair is issued alone and a branch must be the last instruction of the group (the RAT checkpoint it takes has to
+      # include the translations of everything older). The second instruction reads the operands it shares with the
+      # first one from the first one's ROB entry (or its value if known at rename).
+      if self.issueWidth == 2:
+        entry2 = u_iq.o_r2_data
+        uop2 = Signal(DecodedInstrLayout)
+        m.d.comb += uop2.eq(entry2.uop)
+        if self.physicalRegisters > 0:
+          preg2 = u_prf.o_alloc2_idx
+          preg2_rdy = (uop2.rd == 0) | Mux(uop.rd != 0, u_prf.o_alloc2_rdy, u_prf.o_alloc_rdy)
+        else:
+          preg2, preg2_rdy = 0, 1
+        rs_issue2, rs_issue2_en, rs_issue2_rdy = rs_ports[1]
+        lsq_issue2, lsq_issue2_en, lsq_issue2_rdy, lsq_issue2_idx = lsq_ports[1]
+        eliminate2, _ = issueSlot('issue2', entry2, uop2, [3, 4], [result], u_rob.o_alloc2_idx, preg2, lsq_issue2_idx,
+                                  u_rob.i_alloc2, rs_issue2, lsq_issue2)
         m.d.comb += [
-            u_lsq.i_issue.type.eq(LSQType.STORE),
-            u_lsq.i_issue.addr.eq(Mux(u_rat.o_rd1_valid, u_rob.o_rd1_data, u_arf.o_rd1_data)),
-            u_lsq.i_issue.addr_valid.eq(~u_rat.o_rd1_valid | u_rob.o_rd1_valid),
-            u_lsq.i_issue.addr_robidx.eq(u_rat.o_rd1_robidx),
-            u_lsq.i_issue.addr_offset.eq(Cat(instr_s.imm_4_0, instr_s.imm_11_5)),
-            u_lsq.i_issue.data.eq(Mux(u_rat.o_rd2_valid, u_rob.o_rd2_data, u_arf.o_rd2_data)),
-            u_lsq.i_issue.data_valid.eq(~u_rat.o_rd2_valid | u_rob.o_rd2_valid),
-            u_lsq.i_issue.data_robidx.eq(u_rat.o_rd2_robidx),
-            u_lsq.i_issue.robidx.eq(u_rob.o_alloc_idx),
-            u_rob.i_alloc_rd.eq(0),
-            u_rob.i_alloc_lsqidx.eq(u_lsq.o_issue_idx),
-            u_rob.i_alloc_type.eq(ROBType.STORE),
+            u_rat.i_alloc2_idx.eq(uop2.rd),
+            u_rat.i_alloc2_robidx.eq(u_rob.o_alloc2_idx),
+            u_rat.i_alloc2_preg.eq(preg2)
         ]
 
-        with m.Switch(instr_s.funct3):
-          with m.Case(0b000):  # BYTE
-            m.d.comb += u_lsq.i_issue.size.eq(LSQSize.BYTE)
-          with m.Case(0b001):  # HALF
-            m.d.comb += u_lsq.i_issue.size.eq(LSQSize.HALF)
-          with m.Case(0b010):  # WORD
-            m.d.comb += u_lsq.i_issue.size.eq(LSQSize.WORD)
+        checkpoint2 = Signal()
+        m.d.comb += checkpoint2.eq(needsCheckpoint(uop2))
+        unit2_rdy = Mux(uop2.unit == IssueUnit.LSQ, lsq_issue2_rdy, eliminate2 | rs_issue2_rdy)
 
-        with m.If(u_iq.o_r_rdy & ~flush & u_rob.o_alloc_rdy & u_lsq.o_issue_rdy):
+        with m.If(issue & ~fuse & ~checkpoint & u_iq.o_r2_rdy & uop2.valid & u_rob.o_alloc2_rdy & unit2_rdy & preg2_rdy
+                  & (~checkpoint2 | u_rat.o_checkpoint_rdy)):
           m.d.comb += [
-              u_iq.i_r_en.eq(1),  # Consume the IQ entry.
-              u_lsq.i_issue_en.eq(1),  # Strobe LSQ to add issue.
-              u_rob.i_alloc_en.eq(1),  # Strobe ROB to allocate entry.
+              u_iq.i_r2_en.eq(1),
+              rs_issue2_en.eq((uop2.unit == IssueUnit.RS) & ~eliminate2),
+              lsq_issue2_en.eq(uop2.unit == IssueUnit.LSQ),
+              u_rob.i_alloc2_en.eq(1),
+              u_rat.i_alloc2_en.eq(1),
+              u_rat.i_checkpoint_en.eq(checkpoint2)
           ]
+          if self.physicalRegisters > 0:
+            allocatePhysical(1, uop2, eliminate2, u_prf.i_alloc2_en, preg2, u_rob.i_alloc2.rdValue)
 
-      with m.Case(RV32I_OP_MISC_MEM):
-        # Drive issue port of LSQ.
-        m.d.comb += [
-            u_lsq.i_issue.type.eq(LSQType.FENCE),
-            u_lsq.i_issue.robidx.eq(u_rob.o_alloc_idx),
-            u_rob.i_alloc_rd.eq(0),
-            u_rob.i_alloc_lsqidx.eq(u_lsq.o_issue_idx),
-            u_rob.i_alloc_type.eq(ROBType.FENCE),
-        ]
+      addDebugSignals(m, uop)
+
+    for t in range(self.threads):
+      issueThread(t)
 
-        with m.If(u_iq.o_r_rdy & ~flush & u_rob.o_alloc_rdy & u_lsq.o_issue_rdy):
+    # The free list of the physical register file is checkpointed, restored and flushed together with the RAT.
+    if self.physicalRegisters > 0:
+      m.d.comb += [
+          u_prf.i_checkpoint_en.eq(u_rats[0].i_checkpoint_en),
+          u_prf.i_checkpoint_idx.eq(u_rats[0].o_checkpoint_idx),
+          u_prf.i_restore_en.eq(u_rats[0].i_restore_en),
+          u_prf.i_restore_idx.eq(u_rats[0].i_restore_idx),
+          u_prf.i_flush_en.eq(u_rats[0].i_flush_en)
+      ]
+      m.d.comb += [flush_preg.eq(committed) for flush_preg, committed in zip(u_rats[0].i_flush_preg, u_prf.o_committed)]
+
+    #
+    # Commit
+    #
+    # Every thread commits from its own ROB partition. The LSQ commit port and the predictor training ports are shared
+    # so a store or branch is only committed if no thread before it commits one in the same cycle. With several
+    # threads a thread that commits EBREAK halts (everything after it is squashed, see branch resolution) and the core
+    # halts once all of them have.
+    def commitThread(t, shared_used):
+      u_rat, u_rob = u_rats[t], u_robs[t]
+      u_arf = u_arfs[t] if self.physicalRegisters == 0 else None
+      ebreak = Signal(name=named('ebreak', t))
+
+      commit_type = u_rob.o_commit.type
+      shared = (commit_type == ROBType.STORE) | (commit_type == ROBType.BRANCH) | (commit_type == ROBType.BRANCH2)
+      commit = Signal(name=named('commit', t))
+      m.d.comb += commit.eq(u_rob.o_commit_rdy & ~(shared & shared_used))
+      with m.If(commit):
+        m.d.comb += u_rob.i_commit_en.eq(1)
+        #XXX: Should OTHER be called normal or value produceing? JALR (BRANCH2) also writes its link register.
+        with m.If((u_rob.o_commit.type == ROBType.OTHER) | (u_rob.o_commit.type == ROBType.BRANCH2)):
           m.d.comb += [
-              u_iq.i_r_en.eq(1),  # Consume the IQ entry.
-              u_lsq.i_issue_en.eq(1),  # Strobe LSQ to add issue.
-              u_rob.i_alloc_en.eq(1),  # Strobe ROB to allocate entry.
+              u_rat.i_commit_idx.eq(u_rob.o_commit.rd),
+              u_rat.i_commit_robidx.eq(u_rob.o_commit_robidx),
+              u_rat.i_commit_en.eq(1)
           ]
+          if self.physicalRegisters > 0:
+            m.d.comb += [
+                u_prf.i_commit_en.eq(u_rob.o_commit.rd != 0),
+                u_prf.i_commit_rd.eq(u_rob.o_commit.rd),
+                u_prf.i_commit_preg.eq(u_rob.o_commit.preg)
+            ]
+          else:
+            m.d.comb += [
+                u_arf.i_wr_idx.eq(u_rob.o_commit.rd),
+                u_arf.i_wr_data.eq(u_rob.o_commit.rdValue),
+                u_arf.i_wr_we.eq(1),
+            ]
 
-      with m.Case(RV32I_OP_BRANCH):
-        # Use rs1 and rs2 to index both RAT and ARF.
-        m.d.comb += [
-            u_arf.i_rd1_idx.eq(instr_b.rs1),
-            u_arf.i_rd2_idx.eq(instr_b.rs2),
-            u_rat.i_rd1_idx.eq(instr_b.rs1),
-            u_rat.i_rd2_idx.eq(instr_b.rs2)
-        ]
-        # Drive issue port of RS.
-        m.d.comb += [
-            u_rs.i_issue.rs1Value.eq(Mux(u_rat.o_rd1_valid, u_rob.o_rd1_data, u_arf.o_rd1_data)),
-            u_rs.i_issue.rs2Value.eq(Mux(u_rat.o_rd2_valid, u_rob.o_rd2_data, u_arf.o_rd2_data)),
-            u_rs.i_issue.rs1ValueValid.eq(~u_rat.o_rd1_valid | u_rob.o_rd1_valid),
-            u_rs.i_issue.rs2ValueValid.eq(~u_rat.o_rd2_valid | u_rob.o_rd2_valid),
-            u_rs.i_issue.rs1RobIdx.eq(u_rat.o_rd1_robidx),
-            u_rs.i_issue.rs2RobIdx.eq(u_rat.o_rd2_robidx),
-            u_rs.i_issue.imm.eq(Cat(instr_b.imm_4_1, instr_b.imm_10_5, instr_b.imm_11, instr_b.imm_12)),
-            u_rob.i_alloc_rd.eq(0),
-            u_rob.i_alloc_type.eq(ROBType.BRANCH),
-        ]
+        with m.If((u_rob.o_commit.type == ROBType.BRANCH) | (u_rob.o_commit.type == ROBType.BRANCH2)):
+          m.d.comb += u_rat.i_checkpoint_free_en.eq(1)
 
-        with m.Switch(instr_b.funct3):
-          with m.Case(0b000):  # BEQ
-            m.d.comb += u_rs.i_issue.opcode.eq(uOPOpcode.BEQ)
-          with m.Case(0b001):  # BNE
-            m.d.comb += u_rs.i_issue.opcode.eq(uOPOpcode.BNE)
-          with m.Case(0b100):  # BLT
-            m.d.comb += u_rs.i_issue.opcode.eq(uOPOpcode.BLT)
-          with m.Case(0b101):  # BGE
-            m.d.comb += u_rs.i_issue.opcode.eq(uOPOpcode.BGE)
-          with m.Case(0b110):  # BLTU
-            m.d.comb += u_rs.i_issue.opcode.eq(uOPOpcode.BLTU)
-          with m.Case(0b111):  # BGEU
-            m.d.comb += u_rs.i_issue.opcode.eq(uOPOpcode.BGEU)
-
-        with m.If(u_iq.o_r_rdy & ~flush & u_rob.o_alloc_rdy & u_rs.o_issue_rdy):
+        with m.If(u_rob.o_commit.type == ROBType.BRANCH):
+          # Train predictor with the outcome resolved by the execution unit (rdValue is the PC increment).
           m.d.comb += [
-              u_iq.i_r_en.eq(1),  # Consume the IQ entry.
-              u_rs.i_issue_en.eq(1),  # Strobe RS to add issue.
-              u_rob.i_alloc_en.eq(1)  # Strobe ROB to allocate entry.
+              u_bp.i_train_en.eq(1),
+              u_bp.i_train_pc.eq(u_rob.o_commit.pc),
+              u_bp.i_train_history.eq(u_rob.o_commit.pred.bpHistory),
+              u_bp.i_train_taken.eq(u_rob.o_commit.rdValue != Mux(u_rob.o_commit.rvc, 2, 4))
           ]
 
-      with m.Case(RV32I_OP_SYSTEM):
-        # Drive issue port of RS.
-        m.d.comb += [
-            u_rs.i_issue.rs1ValueValid.eq(1),
-            u_rs.i_issue.rs2ValueValid.eq(1),
-            u_rs.i_issue.opcode.eq(uOPOpcode.EBREAK),
-            u_rob.i_alloc_type.eq(ROBType.EBREAK),
-        ]
+        with m.If(u_rob.o_commit.type == ROBType.BRANCH2):
+          # Non-return JALR train the indirect target predictor.
+          m.d.comb += [
+              u_itp.i_train_en.eq(~u_rob.o_commit.rasPop),
+              u_itp.i_train_pc.eq(u_rob.o_commit.pc),
+              u_itp.i_train_target.eq(Cat(Const(0, unsigned(1)), u_rob.o_commit.target[1:32]))
+          ]
+
+        with m.If(u_rob.o_commit.type == ROBType.EBREAK):
+          if self.threads == 1:
+            m.d.comb += self.o_ebreak.eq(1)
+          else:
+            m.d.comb += ebreak.eq(1)
+            m.d.sync += halted[t].eq(1)
+
+        with m.If(u_rob.o_commit.type == ROBType.STORE):
+          m.d.comb += [u_lsq.i_commit_en.eq(1), u_lsq.i_commit_idx.eq(u_rob.o_commit.lsqidx)]
+
+        # Instructions after a replayed load may have used its early result (see branch resolution).
+        m.d.comb += replay[t].eq(u_rob.o_commit.replay)
 
-        with m.If(u_iq.o_r_rdy & ~flush & u_rob.o_alloc_rdy & u_rs.o_issue_rdy):
+      # With commitWidth == 2 the entry following the head is committed in the same cycle if it only writes a
+      # register. Stores, branches, fences, EBREAK and replayed loads are thereby still committed one at a time and in
+      # order (and nothing follows an EBREAK or a replayed load).
+      if self.commitWidth == 2:
+        with m.If(commit & (u_rob.o_commit.type != ROBType.EBREAK) & ~u_rob.o_commit.replay & u_rob.o_commit2_rdy
+                  & (u_rob.o_commit2.type == ROBType.OTHER) & ~u_rob.o_commit2.replay):
           m.d.comb += [
-              u_iq.i_r_en.eq(1),  # Consume the IQ entry.
-              u_rs.i_issue_en.eq(1),  # Strobe RS to add issue.
-              u_rob.i_alloc_en.eq(1)  # Strobe ROB to allocate entry.
+              u_rob.i_commit2_en.eq(1),
+              u_rat.i_commit2_idx.eq(u_rob.o_commit2.rd),
+              u_rat.i_commit2_robidx.eq(u_rob.o_commit2_robidx),
+              u_rat.i_commit2_en.eq(1)
           ]
+          if self.physicalRegisters > 0:
+            m.d.comb += [
+                u_prf.i_commit2_en.eq(u_rob.o_commit2.rd != 0),
+                u_prf.i_commit2_rd.eq(u_rob.o_commit2.rd),
+                u_prf.i_commit2_preg.eq(u_rob.o_commit2.preg)
+            ]
+          else:
+            m.d.comb += [
+                u_arf.i_wr2_idx.eq(u_rob.o_commit2.rd),
+                u_arf.i_wr2_data.eq(u_rob.o_commit2.rdValue),
+                u_arf.i_wr2_we.eq(1),
+            ]
 
-    with m.If(flush):
-      m.d.sync += jalr_ongoing.eq(0)
+      return commit & shared, ebreak
+
+    shared_used = Const(0)
+    ebreaks = []
+    for t in range(self.threads):
+      shared, ebreak = commitThread(t, shared_used)
+      shared_used = shared_used | shared
+      ebreaks.append(ebreak)
+    if self.threads > 1:
+      m.d.comb += self.o_ebreak.eq(Cat(h | e for h, e in zip(halted, ebreaks)).all())
+
+    # Execution Units
+    for idx, u_eu in enumerate(u_eus):
+      m.d.comb += [
+          u_rs.i_dispatch_rdy[idx].eq(u_eu.o_dispatch_rdy),
+          u_eu.i_dispatch_en.eq(u_rs.o_dispatch_en[idx]),
+          u_eu.i_dispatch_uop.eq(u_rs.o_dispatch_uop[idx])
+      ]
+
+    # Early wakeups (by the LSQ and every execution unit).
+    if self.earlyWakeup:
+      for idx, wakeup in enumerate([u_lsq.o_wakeup] + [u_eu.o_wakeup for u_eu in u_eus]):
+        m.d.comb += u_rs.i_wakeup[idx].eq(wakeup)
+
+    # Broadcast arbitration. The LSQ and then the execution units in order take the first free bus, a unit that finds
+    # them all taken is halted (and keeps its result) until the next cycle.
+    used = Const(0, range(len(u_eus) + 2))
+    for idx, source in enumerate([u_lsq.o_broadcast] + [u_eu.o_broadcast for u_eu in u_eus]):
+      if idx > 0:
+        m.d.comb += u_eus[idx - 1].i_halt_en.eq(used >= len(broadcasts))
+      for bus, broadcast in enumerate(broadcasts):
+        with m.If(source.valid & (used == bus)):
+          m.d.comb += broadcast.eq(source)
+      used = used + source.valid
 
     #
-    # Commit
+    # Branch resolution
     #
-    prev_branch_target = Signal(32)
-    prev_branch_valid = Signal()
-    mispredict = Signal()
+    # The target of a branch is compared with the one predicted by fetch as soon as it is broadcast. On a mispredict
+    # everything younger (of the same thread) is squashed and fetch restarts at the real target (with the predictor
+    # state that the branch was fetched with). If branches of a thread on several buses mispredict in the same cycle
+    # the oldest one wins.
+    mispredicts = []
+    for idx, (bus, entry) in enumerate(zip(broadcasts, broadcast_entries)):
+      target = Signal(32, name='broadcast{}_target'.format(idx))
+      with m.Switch(entry.type):
+        with m.Case(ROBType.BRANCH):
+          m.d.comb += target.eq(entry.pc + bus.data)
+        with m.Case(ROBType.BRANCH2):
+          m.d.comb += target.eq(Cat(Const(0, unsigned(1)), bus.data[1:32]))
+      bus_mispredict = Signal(name='broadcast{}_mispredict'.format(idx))
+      m.d.comb += bus_mispredict.eq(bus.valid & ((entry.type == ROBType.BRANCH) | (entry.type == ROBType.BRANCH2))
+                                    & (target != entry.pred.npc))
+      mispredicts.append((bus_mispredict, target))
+
+    for t, (u_rat, u_rob, u_ras) in enumerate(zip(u_rats, u_robs, u_rass)):
+      broadcast = Signal(BroadcastBusTypeLayout(self.config), name=named('bc', t))
+      bc_entry = Signal(ReOrderBufferEntryLayout(self.config), name=named('bc_entry', t))
+      bc_target = Signal(32, name=named('bc_target', t))
+      mispredict = Signal(name=named('mispredict', t))
+      oldest_valid = Const(0)
+      oldest_robidx = Const(0, self.config.robIdxBits)
+      for bus, entry, (bus_mispredict, target) in zip(broadcasts, broadcast_entries, mispredicts):
+        if self.threads > 1:
+          bus_mispredict = bus_mispredict & (threadOf(bus.robIdx, self.threads) == t)
+        oldest = bus_mispredict & (~oldest_valid
+                                   | isYounger(oldest_robidx, bus.robIdx, u_rob.o_commit_robidx, self.threads))
+        with m.If(oldest):
+          m.d.comb += [mispredict.eq(1), broadcast.eq(bus), bc_entry.eq(entry), bc_target.eq(target)]
+        oldest_valid = oldest_valid | bus_mispredict
+        oldest_robidx = Mux(oldest, bus.robIdx, oldest_robidx)
 
-    with m.If(u_rob.o_commit_rdy):
-      m.d.comb += u_rob.i_commit_en.eq(~flush)
-      with m.If(u_rob.o_commit.type == ROBType.OTHER):  #XXX: Should be called normal or value produceing?
+      # A replayed load squashes everything after it as it commits and fetch restarts after it (it is older than any
+      # mispredicting branch of the thread). Without a checkpoint the RAT is recovered by draining the ROB (see issue).
+      with m.If(replay[t]):
+        m.d.comb += [squash[t].eq(1), squash_robidx[t].eq(u_rob.o_commit_robidx)]
+        m.d.sync += pcs[t].eq(u_rob.o_commit.pc + Mux(u_rob.o_commit.rvc, 2, 4))
         m.d.comb += [
-            u_rat.i_commit_idx.eq(u_rob.o_commit.rd),
-            u_rat.i_commit_robidx.eq(u_rob.o_commit_robidx),
-            u_rat.i_commit_en.eq(~flush),
-            u_arf.i_wr_idx.eq(u_rob.o_commit.rd),
-            u_arf.i_wr_data.eq(u_rob.o_commit.rdValue),
-            u_arf.i_wr_we.eq(~flush),
+            u_bp.i_restore_en[t].eq(1),
+            u_bp.i_restore_history[t].eq(u_rob.o_commit.pred.bpHistory),
+            u_ras.i_restore_en.eq(1),
+            u_ras.i_restore_tos.eq(u_rob.o_commit.pred.rasTos),
+            u_ras.i_push_en.eq(0),
+            u_ras.i_pop_en.eq(0)
         ]
-      with m.If(prev_branch_valid & (prev_branch_target != u_rob.o_commit.pc)):
-        m.d.comb += mispredict.eq(1)
-        # Restart PC at real branch target.
-        m.d.sync += PC.eq(prev_branch_target)
-        # Flush everything.
-        m.d.comb += flush.eq(1)
-
-      m.d.sync += prev_branch_valid.eq(0)
-      with m.If((u_rob.o_commit.type == ROBType.BRANCH) & ~mispredict):
-        m.d.sync += [prev_branch_target.eq(u_rob.o_commit.pc + u_rob.o_commit.rdValue), prev_branch_valid.eq(1)]
-        m.d.comb += u_arf.i_wr_we.eq(0)
-
-      with m.If((u_rob.o_commit.type == ROBType.BRANCH2) & ~mispredict):
-        m.d.sync += [
-            prev_branch_target.eq(Cat(Const(0, unsigned(1)), u_rob.o_commit.rdValue[1:32])),
-            prev_branch_valid.eq(1)
+      with m.Elif(mispredict):
+        m.d.comb += [squash[t].eq(1), squash_robidx[t].eq(broadcast.robIdx)]
+        m.d.sync += pcs[t].eq(bc_target)
+        m.d.comb += [
+            u_bp.i_restore_en[t].eq(1),
+            u_bp.i_restore_history[t].eq(
+                Mux(bc_entry.type == ROBType.BRANCH,
+                    Cat(broadcast.data != Mux(bc_entry.rvc, 2, 4), bc_entry.pred.bpHistory), bc_entry.pred.bpHistory)),
+            u_ras.i_restore_en.eq(1),
+            u_ras.i_restore_tos.eq(bc_entry.pred.rasTos),
+            u_ras.i_push_en.eq(bc_entry.rasPush),
+            u_ras.i_push_addr.eq(bc_entry.pc + Mux(bc_entry.rvc, 2, 4)),
+            u_ras.i_pop_en.eq(bc_entry.rasPop),
+            u_rat.i_restore_en.eq(1),
+            u_rat.i_restore_idx.eq(bc_entry.ckpt),
+            u_rat.i_restore_robidx.eq(broadcast.robIdx)
         ]
-        m.d.comb += u_arf.i_wr_we.eq(0)
-
-      with m.If(u_rob.o_commit.type == ROBType.EBREAK):
-        m.d.comb += self.o_ebreak.eq(1)
-
-      with m.If(u_rob.o_commit.type == ROBType.STORE):
-        m.d.comb += [u_lsq.i_commit_en.eq(1), u_lsq.i_commit_idx.eq(u_rob.o_commit.lsqidx)]
-
-    # Execution Unit
-    m.d.comb += [
-        u_rs.i_dispatch_rdy.eq(u_eu.o_dispatch_rdy),
-        u_eu.i_dispatch_en.eq(u_rs.o_dispatch_en),
-        u_eu.i_dispatch_uop.eq(u_rs.o_dispatch_uop),
-        u_eu.i_halt_en.eq(u_lsq.o_broadcast.valid)
-    ]
 
-    # Broadcast arbitration.
-    m.d.comb += broadcast.eq(Mux(u_lsq.o_broadcast.valid, u_lsq.o_broadcast, u_eu.o_broadcast))
+      # A thread that halts squashes everything after its EBREAK (highest priority).
+      if self.threads > 1:
+        with m.If(ebreaks[t]):
+          m.d.comb += [squash[t].eq(1), squash_robidx[t].eq(u_rob.o_commit_robidx)]
 
-    addDebugSignals(m, broadcast)
-    addDebugSignals(m, u_rob.o_commit)
+    for broadcast in broadcasts:
+      addDebugSignals(m, broadcast)
+    for u_rob in u_robs:
+      addDebugSignals(m, u_rob.o_commit)
     addDebugSignals(m, fetch_b)
-    addDebugSignals(m, instr_r, 'instr_b')
 
     return m
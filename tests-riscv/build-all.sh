@@ -1,8 +1,22 @@
 #!/bin/bash
 
-for tpath in ../thirdparty/riscv-tests/isa/rv32ui/*.S; do
+function build() {
+  tpath=$1
+  march=$2
   echo $tpath;
   tname=$(basename $tpath .S)
-  clang --target=riscv64-unknown-elf -mabi=ilp32 -march=rv32i -o $tname.out  $tpath -I. -I../thirdparty/riscv-tests/isa/macros/scalar/ -nostdlib -Wl,--build-id=none,-Bstatic,-T,sections.lds
+  clang --target=riscv64-unknown-elf -mabi=ilp32 -march=$march -o $tname.out  $tpath -I. -I../thirdparty/riscv-tests/isa/macros/scalar/ -nostdlib -Wl,--build-id=none,-Bstatic,-T,sections.lds
   llvm-objcopy --only-section=.mem --output-target=binary $tname.out $tname.bin
+}
+
+for tpath in ../thirdparty/riscv-tests/isa/rv32ui/*.S; do
+  build $tpath rv32i
+done
+
+for tpath in ../thirdparty/riscv-tests/isa/rv32uc/*.S; do
+  build $tpath rv32ic
+done
+
+for tpath in ../thirdparty/riscv-tests/isa/rv32um/*.S; do
+  build $tpath rv32im
 done
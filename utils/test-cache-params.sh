@@ -2,9 +2,9 @@
 for ((i=1;i<=6;i++));
 do
   echo "=================================="
-  echo "Testing with cfgAddrIndexBits = $i"
+  echo "Testing with cache index bits = $i"
   echo "----------------------------------"
-  sed -i "s/^cfgAddrIndexBits = [0-9]$/cfgAddrIndexBits = $i/" components/Cache.py
+  sed -i "s/cacheIndexBits=[0-9],$/cacheIndexBits=$i,/" components/CoreConfig.py
   git diff
   time ./build-myooo-verilator.sh
   time ./myooo-sim tests-riscv/*.bin